@@ -0,0 +1,61 @@
+# beacon.py
+# UDP discovery beacon for the Pico firmware.
+#
+# Every device announces itself with a small JSON datagram broadcast to
+# DISCOVERY_PORT every BEACON_INTERVAL_MS, and answers a QUERY datagram sent
+# to that port (broadcast or not) straight away. Host tools (see fleet.py) use
+# the query to find the whole fleet in well under a second, and the beacons to
+# notice devices that come online later. The payload is /health's JSON plus
+# the HTTP port, so a host learns everything it needs without an HTTP request.
+
+import asyncio
+import socket
+import time
+
+import devlog
+
+DISCOVERY_PORT = 4210
+QUERY = b"PICO?"
+BROADCAST_ADDRESS = "255.255.255.255"
+
+BEACON_INTERVAL_MS = 10000
+POLL_MS = 100  # How often the socket is checked for queries
+
+
+async def run(payload, port=DISCOVERY_PORT, interval_ms=BEACON_INTERVAL_MS):
+    """Broadcasts payload every interval_ms and answers queries, forever.
+
+    MicroPython's asyncio has no datagram streams, so the socket is
+    non-blocking and polled every POLL_MS.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    except (AttributeError, OSError):
+        pass  # Some ports broadcast without being asked to
+    sock.bind(("0.0.0.0", port))
+    sock.setblocking(False)
+    devlog.info("Discovery beacon on UDP port %d", port)
+
+    last_beacon = time.ticks_add(time.ticks_ms(), -interval_ms)  # type: ignore[attr-defined]
+    while True:
+        now = time.ticks_ms()  # type: ignore[attr-defined]
+        if time.ticks_diff(now, last_beacon) >= interval_ms:  # type: ignore[attr-defined]
+            last_beacon = now
+            try:
+                sock.sendto(payload, (BROADCAST_ADDRESS, port))
+            except OSError as e:
+                devlog.warning("Beacon not sent: %s", e)
+
+        # Answer every query that has arrived since the last poll
+        while True:
+            try:
+                data, address = sock.recvfrom(64)
+            except OSError:
+                break  # Nothing waiting
+            if data == QUERY:
+                try:
+                    sock.sendto(payload, address)
+                except OSError:
+                    pass  # The host will ask again
+        await asyncio.sleep_ms(POLL_MS)  # type: ignore[attr-defined]
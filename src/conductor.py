@@ -2,14 +2,39 @@
 # To be run on a student's computer (not the Pico)
 # Requires the 'requests' library: pip install requests
 
-import requests
+import json
+import socket
 import time
+from concurrent.futures import wait
+
+import requests
+
+import fleet
+import notecast
+import score
 
 # --- Configuration ---
-# Students should populate this list with the IP address(es of their Picos
-PICO_IPS = [
-    "192.168.1.101",
-]
+# Devices on the local network are discovered automatically. Picos discovery
+# can't reach are listed in fleet.PICO_IPS.
+
+# How long a single device may take to accept a note before we give up on it.
+# Every device is contacted at the same time, so this bounds the whole dispatch.
+REQUEST_TIMEOUT = 0.1
+
+# Clock synchronization. Each Pico's time.ticks_ms() counter wraps at TICKS_PERIOD.
+# We probe every device SYNC_ROUNDS times and keep the sample with the shortest
+# round trip, then schedule each note SCHEDULE_LEAD_MS ahead of when it should sound.
+TICKS_PERIOD = 2**30
+SYNC_ROUNDS = 8
+SYNC_TIMEOUT = 0.5
+SCHEDULE_LEAD_MS = 150
+
+# Send notes as one UDP broadcast datagram (see notecast.py) instead of an HTTP
+# request per device, so a note costs the same however many devices there are.
+# Every device hears the datagram at the same moment, so no clock sync is needed.
+USE_NOTECAST = False
+NOTECAST_ADDRESS = "255.255.255.255"
+NOTECAST_REPEATS = 2  # Copies of each datagram; devices drop the duplicates
 
 # --- Music Definition ---
 # Notes mapped to frequencies (in Hz)
@@ -41,34 +66,222 @@ SONG = [
     (C4, 800),
 ]
 
+# Silence between consecutive notes of a melody
+MELODY_GAP_MS = 40
+
+JSON_CONTENT_TYPE = "application/json"
+
 # --- Conductor Logic ---
 
 
-def play_note_on_all_picos(freq, ms):
-    """Sends a /tone POST request to every Pico in the list."""
+# Estimated (device ticks_ms - conductor clock) for each device, in ms
+_clock_offsets: dict[str, float] = {}
+
+# Songs already packed into the binary score format, keyed on (notes, gap_ms)
+_compiled_songs: dict[tuple, bytes] = {}
+
+# The live devices, discovered and kept up to date in the background
+registry = fleet.registry
+
+_notecast_socket = None
+# Starts from the wall clock, so a restarted conductor still counts upwards
+_notecast_seq = int(time.time() * 1000) & 0xFFFFFFFF
+
+
+def _post(ip, path, body, content_type):
+    """Posts an already-encoded body to one Pico."""
+    try:
+        fleet.get_session(ip).post(
+            f"http://{ip}{path}",
+            data=body,
+            headers={"Content-Type": content_type},
+            timeout=REQUEST_TIMEOUT,
+        )
+    except requests.exceptions.Timeout:
+        # We don't need to wait for a reply, so this is expected and harmless
+        pass
+    except requests.exceptions.RequestException as e:
+        print(f"Error contacting {ip}: {e}")
+
+
+def now_ms():
+    """Returns the conductor's monotonic clock in milliseconds."""
+    return time.monotonic() * 1000
+
+
+def sync_clock(ip, rounds=SYNC_ROUNDS):
+    """Estimates one Pico's clock offset with several NTP-style /sync round trips.
+
+    The device stamps its ticks_ms() between our send (t0) and receive (t3)
+    times, so it was most likely taken around (t0 + t3) / 2. The sample with the
+    shortest round trip has the least uncertainty, so it wins.
+    """
+    session = fleet.get_session(ip)
+    best_rtt = None
+    for _ in range(rounds):
+        try:
+            t0 = now_ms()
+            res = session.get(f"http://{ip}/sync", timeout=SYNC_TIMEOUT)
+            t3 = now_ms()
+            device_ms = res.json()["ticks_ms"]
+        except (requests.exceptions.RequestException, ValueError, KeyError):
+            # A lost probe just costs us one sample; the summary reports total failure
+            continue
+        rtt = t3 - t0
+        if best_rtt is None or rtt < best_rtt:
+            best_rtt = rtt
+            _clock_offsets[ip] = device_ms - (t0 + t3) / 2
+    return best_rtt
+
+
+def sync_all_clocks():
+    """Synchronizes with every Pico at once and reports the achieved accuracy."""
+    ips = registry.addresses()
+    for ip, rtt in zip(ips, fleet.get_executor().map(sync_clock, ips)):
+        if rtt is None:
+            print(f"{ip}: no clock sync, notes will play on arrival")
+        else:
+            print(f"{ip}: clock synced to within {rtt / 2:.1f} ms")
+
+
+def device_time(ip, at_ms):
+    """Converts a conductor time into the device's ticks_ms() clock, or None."""
+    offset = _clock_offsets.get(ip)
+    if offset is None:
+        return None
+    return int(at_ms + offset) % TICKS_PERIOD
+
+
+def _with_start_time(body, content_type, ip, at_ms):
+    """Adds a device-local start time to a JSON object or score body, if we can."""
+    if at_ms is None:
+        return body
+    device_at = device_time(ip, at_ms)
+    if device_at is None:
+        return body
+    if content_type == score.CONTENT_TYPE:
+        return score.with_start(body, device_at)
+    return body[:-1] + b', "at": %d}' % device_at
+
+
+def send_to_all_picos(path, body, at_ms=None, content_type=JSON_CONTENT_TYPE):
+    """Sends the same body to every Pico at once and waits at most one timeout.
+
+    If at_ms (a conductor time from now_ms()) is given, each device is told to
+    start at that moment on its own clock.
+    """
+    executor = fleet.get_executor()
+    futures = [
+        executor.submit(
+            _post, ip, path, _with_start_time(body, content_type, ip, at_ms), content_type
+        )
+        for ip in registry.addresses()
+    ]
+    wait(futures, timeout=REQUEST_TIMEOUT * 2)
+
+
+def cast_to_all_picos(melody, at_ms=None):
+    """Broadcasts a packed score to every Pico in one UDP datagram.
+
+    If at_ms (a conductor time from now_ms()) is given, the devices start it
+    then; otherwise they start it as soon as it arrives. Raises ValueError if
+    at_ms is more than notecast.MAX_LEAD_MS away.
+    """
+    global _notecast_socket, _notecast_seq
+    if _notecast_socket is None:
+        _notecast_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        _notecast_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    lead_ms = 0 if at_ms is None else max(0, int(at_ms - now_ms()))
+    _notecast_seq = (_notecast_seq + 1) & 0xFFFFFFFF
+    datagram = notecast.encode(_notecast_seq, melody, lead_ms)
+    for _ in range(NOTECAST_REPEATS):
+        try:
+            _notecast_socket.sendto(datagram, (NOTECAST_ADDRESS, notecast.NOTE_PORT))
+        except OSError as e:
+            print(f"Error broadcasting notes: {e}")
+
+
+def play_note_on_all_picos(freq, ms, at_ms=None, voice=None):
+    """Sends a /tone POST request to every Pico in the list.
+
+    On devices with two buzzers, voice (0 or 1) picks the buzzer that plays it.
+    With USE_NOTECAST the note is broadcast instead, and goes to a free buzzer.
+    """
     print(f"Playing note: {freq}Hz for {ms}ms on all devices.")
+    if USE_NOTECAST:
+        cast_to_all_picos(score.encode([(freq, ms)]), at_ms)
+        return
 
+    # The payload is encoded once and shared by every device.
     payload = {"freq": freq, "ms": ms, "duty": 0.5}
+    if voice is not None:
+        payload["voice"] = voice
+    send_to_all_picos("/tone", json.dumps(payload).encode("utf-8"), at_ms)
 
-    for ip in PICO_IPS:
-        url = f"http://{ip}/tone"
-        try:
-            # We use a short timeout because we don't need to wait for a response
-            # This makes the orchestra play more in sync.
-            requests.post(url, json=payload, timeout=0.1)
-        except requests.exceptions.Timeout:
-            # This is expected, we can ignore it
-            pass
-        except requests.exceptions.RequestException as e:
-            print(f"Error contacting {ip}: {e}")
+
+def play_chord_on_all_picos(freqs, ms, at_ms=None):
+    """Sends a /chord POST request, one note per buzzer, to every Pico in the list."""
+    print(f"Playing chord: {freqs}Hz for {ms}ms on all devices.")
+    if USE_NOTECAST:
+        frequency = freqs[0] if len(freqs) == 1 else tuple(freqs)
+        cast_to_all_picos(score.encode([(frequency, ms)]), at_ms)
+        return
+
+    body = json.dumps({"freqs": list(freqs), "ms": ms, "duty": 0.5}).encode("utf-8")
+    send_to_all_picos("/chord", body, at_ms)
+
+
+def compile_song(song, gap_ms=MELODY_GAP_MS):
+    """Packs a song into the binary score format, reusing earlier results.
+
+    A note's frequency may be a (frequency, frequency2) pair to play a second
+    part on devices with two buzzers.
+    """
+    key = (tuple(song), gap_ms)
+    packed = _compiled_songs.get(key)
+    if packed is None:
+        packed = _compiled_songs[key] = score.encode(song, gap_ms)
+    return packed
+
+
+def play_song_on_all_picos(song, gap_ms=MELODY_GAP_MS, at_ms=None, voice=None):
+    """Uploads a whole song as a single /melody request to every Pico.
+
+    The devices time the notes themselves, so the song costs one network round
+    trip instead of one per note. A song with single notes only can be sent to
+    one buzzer with voice (0 or 1). Returns the song's length in milliseconds.
+    """
+    print(f"Sending {len(song)} notes to all devices.")
+
+    if USE_NOTECAST:
+        cast_to_all_picos(compile_song(song, gap_ms), at_ms)
+        return sum(ms + gap_ms for _, ms in song)
+    path = "/melody" if voice is None else f"/melody?voice={voice}"
+    send_to_all_picos(path, compile_song(song, gap_ms), at_ms, score.CONTENT_TYPE)
+    return sum(ms + gap_ms for _, ms in song)
+
+
+def close_connections():
+    """Closes every device session and socket, stops the worker pool and the registry."""
+    global _notecast_socket
+    if _notecast_socket is not None:
+        _notecast_socket.close()
+        _notecast_socket = None
+    fleet.close()
 
 
 if __name__ == "__main__":
     print("--- Pico Light Orchestra Conductor ---")
-    print(f"Found {len(PICO_IPS)} devices in the orchestra.")
+    registry.load()
+    registry.start()
+    registry.wait_ready()
+    print(f"Found {len(registry.addresses())} devices in the orchestra.")
     print("Press Ctrl+C to stop.")
 
     try:
+        if not USE_NOTECAST:
+            sync_all_clocks()  # Broadcast notes are timed from when they arrive
+
         # Give a moment for everyone to get ready
         print("\nStarting in 3...")
         time.sleep(1)
@@ -78,13 +291,15 @@ if __name__ == "__main__":
         time.sleep(1)
         print("Go!\n")
 
-        # Play the song
-        for note, duration in SONG:
-            play_note_on_all_picos(note, duration)
-            # Wait for the note's duration plus a small gap before playing the next one
-            time.sleep(duration / 1000 * 1.1)
+        # Send the whole song at once. It carries its start time, so every device
+        # begins together and then keeps time on its own.
+        start_at = now_ms() + SCHEDULE_LEAD_MS
+        song_ms = play_song_on_all_picos(SONG, MELODY_GAP_MS, start_at)
+        time.sleep(max(0, start_at + song_ms - now_ms()) / 1000)
 
         print("\nSong finished!")
 
     except KeyboardInterrupt:
         print("\nConductor stopped by user.")
+    finally:
+        close_connections()
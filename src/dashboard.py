@@ -1,39 +1,109 @@
 # dashboard.py
 # To be run on a student's computer (not the Pico)
+#
+# Usage: python dashboard.py [--push]
+#
+# By default every device is polled for its /status once a second. With --push
+# the dashboard instead keeps one GET /events stream open per device, all on a
+# single asyncio loop, and redraws a device's row only when it sends an event.
+# Devices without an event stream are polled on that loop instead.
 
-import requests
+import argparse
+import asyncio
+import json
+import sys
 import time
+from concurrent.futures import Future, wait
+
+import requests
+
+import fleet
 
 # --- Configuration ---
-# Students should populate this list with the IP address(es) of their Pico
-PICO_IPS = [
-    "192.168.1.101",
-]
+# Devices on the local network are discovered automatically. Picos discovery
+# can't reach are listed in fleet.PICO_IPS.
+
+# Every device is polled at once, and each refresh waits at most this long for
+# the replies. A device that hasn't answered by then is shown as not replying,
+# so a few offline devices don't slow the refresh down for everybody else.
+REFRESH_INTERVAL = 1.0
+REQUEST_TIMEOUT = 1.0
+
+# Push mode. Devices send a heartbeat event at least every 5 s, so a stream
+# that stays quiet for STREAM_TIMEOUT has gone away and is reconnected.
+STREAM_TIMEOUT = 12.0
+RECONNECT_DELAY = 2.0
+FRAME_INTERVAL = 0.05  # Changed rows are redrawn together at most this often
+EVENTS_DELTA = 0.01
+
+# Polls still running from an earlier refresh, by IP. A device is not polled
+# again until its last poll has finished, so a slow one can't pile them up.
+_in_flight: dict[str, Future] = {}
+
+# The live devices, discovered and kept up to date in the background
+registry = fleet.registry
 
 
 def get_device_status(ip):
-    """Fetches /health and /sensor data from a single device."""
+    """Fetches the combined health and sensor data from a single device's /status."""
     status = {"ip": ip, "device_id": "N/A", "status": "Error", "norm": 0.0}
     try:
-        # Get health status
-        health_res = requests.get(f"http://{ip}/health", timeout=1)
-        health_res.raise_for_status()
-        health_data = health_res.json()
-        status.update(health_data)
-        status["status"] = health_data.get("status", "Unknown")
-
-        # Get sensor data
-        sensor_res = requests.get(f"http://{ip}/sensor", timeout=1)
-        sensor_res.raise_for_status()
-        sensor_data = sensor_res.json()
-        status["norm"] = sensor_data.get("norm", 0.0)
+        res = fleet.get_session(ip).get(f"http://{ip}/status", timeout=REQUEST_TIMEOUT)
+        res.raise_for_status()
+        data = res.json()
+        status.update(data)
+        status["status"] = data.get("status", "Unknown")
+        status["norm"] = data.get("norm", 0.0)
 
     except requests.exceptions.RequestException as e:
         status["status"] = f"Offline ({type(e).__name__})"
+    except ValueError:
+        status["status"] = "Bad reply"
 
     return status
 
 
+def poll_all_devices(statuses, deadline=REFRESH_INTERVAL):
+    """Polls every device at once and updates statuses (keyed by IP) in place.
+
+    Waits at most deadline seconds. Devices that are still being polled keep
+    their last status, marked as not replying.
+    """
+    ips = registry.addresses()
+    executor = fleet.get_executor()
+    for ip in ips:
+        if ip not in _in_flight:
+            _in_flight[ip] = executor.submit(get_device_status, ip)
+
+    wait(list(_in_flight.values()), timeout=deadline)
+
+    for ip in list(_in_flight):
+        if ip not in ips and _in_flight[ip].done():
+            del _in_flight[ip]  # Dropped from the registry while being polled
+    for ip in ips:
+        future = _in_flight[ip]
+        if future.done():
+            del _in_flight[ip]
+            statuses[ip] = future.result()
+        else:
+            status = statuses.setdefault(ip, {"ip": ip, "device_id": "N/A", "norm": 0.0})
+            status["status"] = "No reply"
+    return [statuses[ip] for ip in ips]
+
+
+def format_row(status):
+    """Formats one device's line of the dashboard."""
+    # Create a simple bar graph for the light level
+    light_level = status.get("norm", 0.0)
+    bar_length = int(light_level * 10)
+    bar = "█" * bar_length + "─" * (10 - bar_length)
+
+    return (
+        f"{status['ip']:<16} {status['device_id']:<25} {status['status'].capitalize():<10} "
+        f"[{bar}] {light_level:.2f}"
+    )
+
+
 def render_dashboard(statuses):
     """Renders the collected statuses to the console."""
 
@@ -43,27 +113,197 @@ def render_dashboard(statuses):
     print("-" * 60)
 
     for status in statuses:
-        # Create a simple bar graph for the light level
-        light_level = status.get("norm", 0.0)
-        bar_length = int(light_level * 10)
-        bar = "█" * bar_length + "─" * (10 - bar_length)
-
-        print(
-            f"{status['ip']:<16} {status['device_id']:<25} {status['status'].capitalize():<10} "
-            f"[{bar}] {light_level:.2f}"
-        )
+        print(format_row(status))
 
     print("-" * 60)
 
 
+# --- Push mode ---
+
+
+class LiveTable:
+    """The dashboard table, redrawn in place one changed row at a time.
+
+    The whole table is printed once. After that a row is rewritten by moving
+    the cursor up to it with ANSI escape codes, so an event from one device
+    costs one line of output however many devices there are.
+    """
+
+    def __init__(self, ips, out=sys.stdout):
+        self.ips = list(ips)
+        self.out = out
+        self.statuses = {
+            ip: {"ip": ip, "device_id": "N/A", "status": "Connecting", "norm": 0.0}
+            for ip in self.ips
+        }
+        self.rows = {ip: i for i, ip in enumerate(self.ips)}
+        self.dirty = set()
+        self.changed = asyncio.Event()
+
+    def update(self, ip, **fields):
+        """Changes some of a device's fields; the row is redrawn on the next frame."""
+        status = self.statuses[ip]
+        for key, value in fields.items():
+            if status.get(key) != value:
+                status[key] = value
+                self.dirty.add(ip)
+        if self.dirty:
+            self.changed.set()
+
+    def draw(self):
+        """Prints the whole table, leaving the cursor on the line below it."""
+        render_dashboard([self.statuses[ip] for ip in self.ips])
+        self.out.flush()
+
+    def redraw_changed(self):
+        """Rewrites just the rows that changed since the last redraw."""
+        parts = []
+        for ip in self.dirty:
+            # The cursor sits below the footer line, so row i is this far up
+            up = len(self.ips) - self.rows[ip] + 1
+            parts.append(f"\x1b[{up}A\r{format_row(self.statuses[ip])}\x1b[K\x1b[{up}B\r")
+        self.dirty.clear()
+        self.out.write("".join(parts))
+        self.out.flush()
+
+    async def run(self):
+        """Redraws changed rows as events come in, at most once per frame."""
+        self.draw()
+        while True:
+            await self.changed.wait()
+            self.changed.clear()
+            self.redraw_changed()
+            await asyncio.sleep(FRAME_INTERVAL)
+
+
+async def _read_head(reader):
+    """Reads a response's status line and headers; returns (status, headers)."""
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("connection closed")
+    status = int(status_line.split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            return status, headers
+        name, _, value = line.decode().partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+
+async def _connect(host, port):
+    """Opens a connection to a device; returns (reader, writer)."""
+    return await asyncio.wait_for(asyncio.open_connection(host, port), REQUEST_TIMEOUT)
+
+
+async def _read_status(reader, ip, table):
+    """Reads a /status response and shows it in the device's row."""
+    status, headers = await asyncio.wait_for(_read_head(reader), REQUEST_TIMEOUT)
+    body = await reader.readexactly(int(headers.get("content-length", 0)))
+    if status == 200:
+        data = json.loads(body)
+        table.update(
+            ip,
+            device_id=data.get("device_id", "N/A"),
+            status=data.get("status", "Unknown"),
+            norm=data.get("norm", 0.0),
+        )
+
+
+async def _poll_status(reader, writer, host, ip, table):
+    """Polls /status over the connection every REFRESH_INTERVAL, until it fails."""
+    request = f"GET /status HTTP/1.1\r\nHost: {host}\r\n\r\n".encode()
+    while True:
+        await asyncio.sleep(REFRESH_INTERVAL)
+        writer.write(request)
+        await writer.drain()
+        await _read_status(reader, ip, table)
+
+
+async def follow_device(ip, table):
+    """Keeps one connection to a device: reads its /status once, then its /events.
+
+    A device without an event stream (src2 has none) or with no room for
+    another subscriber has its /status polled instead, as without --push.
+    """
+    host, _, port = ip.partition(":")
+    port = int(port or 80)
+    while True:
+        writer = None
+        try:
+            reader, writer = await _connect(host, port)
+            # Both requests go down the same keep-alive connection
+            requests_head = (
+                f"GET /status HTTP/1.1\r\nHost: {host}\r\n\r\n"
+                f"GET /events?delta={EVENTS_DELTA} HTTP/1.1\r\nHost: {host}\r\n\r\n"
+            )
+            writer.write(requests_head.encode())
+            await writer.drain()
+
+            await _read_status(reader, ip, table)
+            status, headers = await asyncio.wait_for(_read_head(reader), REQUEST_TIMEOUT)
+            if status != 200:
+                await reader.readexactly(int(headers.get("content-length", 0)))
+                if headers.get("connection", "").lower() == "close":
+                    writer.close()
+                    reader, writer = await _connect(host, port)
+                await _poll_status(reader, writer, host, ip, table)
+
+            while True:
+                line = await asyncio.wait_for(reader.readline(), STREAM_TIMEOUT)
+                if not line:
+                    raise ConnectionError("stream closed")
+                if line.startswith(b"data:"):
+                    table.update(ip, status="ok", norm=json.loads(line[5:])["norm"])
+
+        except (OSError, EOFError, ValueError, KeyError, asyncio.TimeoutError) as e:
+            table.update(ip, status=f"Offline ({type(e).__name__})")
+        finally:
+            if writer is not None:
+                writer.close()
+        await asyncio.sleep(RECONNECT_DELAY)
+
+
+async def push_dashboard():
+    """Runs the push-mode dashboard until it is interrupted.
+
+    It follows the devices known when it starts; restart it to pick up more.
+    """
+    ips = registry.addresses()
+    table = LiveTable(ips)
+    followers = [asyncio.create_task(follow_device(ip, table)) for ip in ips]
+    try:
+        await table.run()
+    finally:
+        for task in followers:
+            task.cancel()
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show the status of every Pico.")
+    parser.add_argument(
+        "--push", action="store_true", help="follow event streams instead of polling"
+    )
+    args = parser.parse_args()
+
+    registry.load()
+    registry.start()
+    registry.wait_ready()
+
+    statuses: dict[str, dict] = {}
     try:
-        while True:
-            all_statuses = [get_device_status(ip) for ip in PICO_IPS]
-            render_dashboard(all_statuses)
-            time.sleep(1)  # Refresh every second
+        if args.push:
+            asyncio.run(push_dashboard())
+        else:
+            while True:
+                started = time.monotonic()
+                render_dashboard(poll_all_devices(statuses))
+                # Refresh every second, however long this round took
+                time.sleep(max(0, started + REFRESH_INTERVAL - time.monotonic()))
 
     except KeyboardInterrupt:
         print("\nDashboard stopped.")
     except Exception as e:
         print(f"\nAn error occurred: {e}")
+    finally:
+        fleet.close()
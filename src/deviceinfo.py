@@ -0,0 +1,44 @@
+# deviceinfo.py
+# Identity and sensor bodies for GET /health, /sensor and /status, and the
+# discovery beacon (see beacon.py).
+#
+# The identity never changes, so its part of the JSON is built once at boot.
+# /status is /health and /sensor in a single object, so a dashboard needs one
+# request per device instead of two.
+
+import machine
+
+API_VERSION = b"1.0.0"
+DEVICE_ID = b"pico-w-" + "".join("%02X" % b for b in machine.unique_id()).encode()
+
+LUX_FULL_SCALE = 1000  # Rough lux at a raw reading of 65535; the sensor is uncalibrated
+
+# Everything of the /health object but its closing brace
+_IDENTITY = (
+    b'{"status": "ok", "device_id": "' + DEVICE_ID + b'", "api": "' + API_VERSION + b'"'
+)
+HEALTH_BODY = _IDENTITY + b"}"
+
+
+def _sensor_fields(raw):
+    norm = raw / 65535
+    return b'"raw": %d, "norm": %.3f, "lux_est": %.1f}' % (
+        raw,
+        norm,
+        norm * LUX_FULL_SCALE,
+    )
+
+
+def beacon_body(port=80):
+    """Returns the discovery beacon payload: the /health fields plus the HTTP port."""
+    return _IDENTITY + b', "port": %d}' % port
+
+
+def sensor_body(raw):
+    """Returns the /sensor JSON for a read_u16() light value."""
+    return b"{" + _sensor_fields(raw)
+
+
+def status_body(raw):
+    """Returns the /status JSON: the /health fields plus the /sensor ones."""
+    return _IDENTITY + b", " + _sensor_fields(raw)
@@ -0,0 +1,90 @@
+# devlog.py
+# Leveled logger for the Pico firmware, with an in-RAM ring buffer.
+#
+# Printing over USB serial blocks until the bytes are written, which is slow
+# enough to hold up the event loop. Messages are instead kept in a fixed-size
+# ring buffer that can be read back over HTTP (GET /logs, which can also change
+# the level); only messages at echo_level or above are also printed. A message
+# below the current level returns before anything is formatted, so disabled
+# debug logging costs one comparison.
+
+import time
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+_NAMES = {DEBUG: "DEBUG", INFO: "INFO", WARNING: "WARNING", ERROR: "ERROR"}
+
+RING_SIZE = 64  # How many recent messages are kept
+
+# Messages below level are dropped
+level = INFO
+# Messages at or above echo_level are also printed to the serial console
+echo_level = WARNING
+
+_ring = [""] * RING_SIZE
+_head = 0  # The slot the next message goes into
+_count = 0  # How many slots hold a message
+
+
+def set_level(new_level, new_echo_level=None):
+    """Changes which messages are kept and, optionally, which are printed."""
+    global level, echo_level
+    level = new_level
+    if new_echo_level is not None:
+        echo_level = new_echo_level
+
+
+def level_named(name):
+    """Returns the level called name (in any case); raises ValueError if there is none."""
+    name = name.upper()
+    for value in _NAMES:
+        if _NAMES[value] == name:
+            return value
+    raise ValueError("no such level")
+
+
+def _write(msg_level, msg, args):
+    """Formats a message into the ring buffer, printing it if it is important."""
+    global _head, _count
+    if args:
+        msg = msg % args
+    line = "%d %s %s" % (time.ticks_ms(), _NAMES[msg_level], msg)  # type: ignore[attr-defined]
+    _ring[_head] = line
+    _head = (_head + 1) % RING_SIZE
+    if _count < RING_SIZE:
+        _count += 1
+    if msg_level >= echo_level:
+        print(line)
+
+
+def debug(msg, *args):
+    """Logs a %-style message at DEBUG level."""
+    if DEBUG >= level:
+        _write(DEBUG, msg, args)
+
+
+def info(msg, *args):
+    """Logs a %-style message at INFO level."""
+    if INFO >= level:
+        _write(INFO, msg, args)
+
+
+def warning(msg, *args):
+    """Logs a %-style message at WARNING level."""
+    if WARNING >= level:
+        _write(WARNING, msg, args)
+
+
+def error(msg, *args):
+    """Logs a %-style message at ERROR level."""
+    if ERROR >= level:
+        _write(ERROR, msg, args)
+
+
+def recent():
+    """Returns the buffered messages, oldest first."""
+    start = (_head - _count) % RING_SIZE
+    return [_ring[(start + i) % RING_SIZE] for i in range(_count)]
@@ -0,0 +1,95 @@
+# events.py
+# Server-Sent Events (GET /events) for live light readings.
+#
+# There is one sampler, the firmware's main loop, which calls publish() with
+# every reading. publish() decides per subscriber whether the reading is worth
+# sending: it must differ from the last one sent by at least the subscriber's
+# delta, or the heartbeat interval must have passed. The reading is then
+# parked in the subscriber's one-slot mailbox and its writer task is woken up.
+# If that task is still busy sending to a slow client, the parked reading is
+# simply replaced, so a slow client misses events instead of holding up the
+# sampler or anybody else.
+
+import asyncio
+import time
+
+import devlog
+import webserver
+
+SSE_HEADERS = (
+    b"HTTP/1.1 200 OK\r\n"
+    b"Content-Type: text/event-stream\r\n"
+    b"Cache-Control: no-cache\r\n"
+    b"Connection: keep-alive\r\n\r\n"
+)
+BUSY_RESPONSE = (
+    b"HTTP/1.1 503 Service Unavailable\r\n"
+    b"Content-Length: 0\r\nConnection: close\r\n\r\n"
+)
+
+DEFAULT_DELTA = 0.01  # Smallest change in norm (0.0 to 1.0) worth an event
+HEARTBEAT_MS = 5000  # Send the current reading at least this often anyway
+MAX_SUBSCRIBERS = 4
+
+
+class Subscriber:
+    """One client of the event stream, with room for a single pending event."""
+
+    def __init__(self, delta_raw):
+        self.delta_raw = delta_raw  # DEFAULT_DELTA in raw read_u16() units
+        self.wake = asyncio.Event()
+        self.pending = False  # Whether raw/ticks hold an event not yet sent
+        self.raw = 0
+        self.ticks = 0
+        self.last_raw = -65536  # Guarantees the first reading is sent
+        self.last_ticks = 0
+        self.dropped = 0  # Events replaced before they could be sent
+
+
+class EventStream:
+    """Fans readings from one sampler out to every subscribed client."""
+
+    def __init__(self, heartbeat_ms=HEARTBEAT_MS, max_subscribers=MAX_SUBSCRIBERS):
+        self.heartbeat_ms = heartbeat_ms
+        self.max_subscribers = max_subscribers
+        self.subscribers = []
+
+    def publish(self, raw, ticks):
+        """Offers a read_u16() value taken at ticks_ms() ticks to every subscriber."""
+        for sub in self.subscribers:
+            elapsed = time.ticks_diff(ticks, sub.last_ticks)  # type: ignore[attr-defined]
+            if abs(raw - sub.last_raw) < sub.delta_raw and elapsed < self.heartbeat_ms:
+                continue
+            if sub.pending:
+                sub.dropped += 1
+            sub.raw = sub.last_raw = raw
+            sub.ticks = sub.last_ticks = ticks
+            sub.pending = True
+            sub.wake.set()
+
+    async def serve(self, request, writer):
+        """Stream handler for GET /events[?delta=0.01]; runs until the client leaves."""
+        if len(self.subscribers) >= self.max_subscribers:
+            writer.write(BUSY_RESPONSE)
+            await writer.drain()
+            return
+        delta = float(webserver.query_param(request, "delta", DEFAULT_DELTA))
+        sub = Subscriber(int(delta * 65535))
+        self.subscribers.append(sub)
+        devlog.debug("Event subscriber added, %d total", len(self.subscribers))
+        try:
+            writer.write(SSE_HEADERS)
+            await writer.drain()
+            while True:
+                await sub.wake.wait()
+                sub.wake.clear()
+                sub.pending = False
+                writer.write(
+                    b'data: {"norm": %.3f, "ts": %d}\n\n' % (sub.raw / 65535, sub.ticks)
+                )
+                await writer.drain()
+        except OSError:
+            pass  # The client went away
+        finally:
+            self.subscribers.remove(sub)
+            devlog.debug("Event subscriber left after %d dropped events", sub.dropped)
@@ -0,0 +1,280 @@
+# fleet.py
+# To be run on a student's computer (not the Pico)
+# Requires the 'requests' library: pip install requests
+#
+# A registry of the devices in the orchestra, shared by conductor.py,
+# dashboard.py and scrape.py so none of them needs a hand-maintained list of
+# IPs, along with the keep-alive sessions and worker pool they talk to the
+# devices through.
+#
+# Devices answer a UDP discovery query and broadcast a beacon now and then
+# (see beacon.py). The registry broadcasts a query when it starts, which finds
+# a whole /24 in DISCOVERY_TIMEOUT, and then keeps listening on a background
+# thread. Every PROBE_INTERVAL it queries each known device directly; one that
+# hasn't been heard from in DEAD_AFTER is dropped, unless it is one of the
+# PICO_IPS, which stay listed whether they answer or not. Everything runs on that one
+# thread, so asking the registry for its devices never waits on the network.
+# Devices found are cached in CACHE_FILE, so the next run probes them at once,
+# but lists them only once they answer: one that never does would otherwise
+# cost every request a timeout until it was dropped.
+
+import json
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from beacon import DISCOVERY_PORT, QUERY
+
+# --- Configuration ---
+# Devices on the local network are discovered automatically.
+# Add IP addresses here only for Picos that discovery can't reach.
+PICO_IPS: list[str] = []
+
+# The most devices contacted at the same time
+MAX_WORKERS = 64
+
+CACHE_FILE = "fleet.json"
+
+DISCOVERY_TIMEOUT = 0.5  # How long the first broadcast query waits for replies
+PROBE_INTERVAL = 5.0
+DEAD_AFTER = 3 * PROBE_INTERVAL
+BROADCAST_ADDRESS = "<broadcast>"
+STOP_CHECK_INTERVAL = 0.25  # How quickly the background thread notices stop()
+
+
+class Registry:
+    """The devices currently known to be up, kept fresh in the background.
+
+    seeds are addresses ("ip" or "ip:port") to try even if they don't answer
+    discovery. Discovery may never hear from them, so unlike every other
+    device they are never dropped.
+    """
+
+    def __init__(self, seeds=(), cache_path=CACHE_FILE, port=DISCOVERY_PORT):
+        self.cache_path = cache_path
+        self.port = port
+        # address -> {"device_id", "api", "last_seen"}, where last_seen is None
+        # for a cached device that hasn't answered yet
+        self._devices = {}
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._sock = None
+        self._seeds = set(seeds)
+        now = time.monotonic()
+        for address in self._seeds:
+            self._devices[address] = {"device_id": None, "api": None, "last_seen": now}
+
+    def addresses(self):
+        """Returns the address of every live device, as used in URLs."""
+        with self._lock:
+            return sorted(
+                address
+                for address, info in self._devices.items()
+                if info["last_seen"] is not None
+            )
+
+    def devices(self):
+        """Returns a copy of what is known about every live device, by address."""
+        with self._lock:
+            return {
+                address: dict(info)
+                for address, info in self._devices.items()
+                if info["last_seen"] is not None
+            }
+
+    def load(self):
+        """Adds the devices cached by an earlier run, to be listed once they answer.
+
+        One still silent when the first discovery round is over is dropped.
+        """
+        try:
+            with open(self.cache_path, "r") as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return
+        with self._lock:
+            for address, info in cached.items():
+                self._devices.setdefault(
+                    address,
+                    {
+                        "device_id": info.get("device_id"),
+                        "api": info.get("api"),
+                        "last_seen": None,
+                    },
+                )
+
+    def save(self):
+        """Writes the live devices to the cache file."""
+        with self._lock:
+            cached = {
+                address: {"device_id": info["device_id"], "api": info["api"]}
+                for address, info in self._devices.items()
+                if info["last_seen"] is not None
+            }
+        try:
+            with open(self.cache_path, "w") as f:
+                json.dump(cached, f, indent=2)
+        except OSError as e:
+            print(f"Could not save {self.cache_path}: {e}")
+
+    def start(self):
+        """Starts discovery and probing on a background thread."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def wait_ready(self, timeout=DISCOVERY_TIMEOUT * 2):
+        """Waits until the first discovery round is over; returns whether it is."""
+        return self._ready.wait(timeout)
+
+    def stop(self):
+        """Stops the background thread and saves the cache, if it was started."""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self.save()
+
+    def _open_socket(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            # Listening on the discovery port also catches the periodic beacons
+            sock.bind(("", self.port))
+        except OSError:
+            sock.bind(("", 0))  # Another tool has it; replies to our queries still arrive
+        return sock
+
+    def _query(self, ip):
+        try:
+            self._sock.sendto(QUERY, (ip, self.port))
+        except OSError:
+            pass  # No route right now; the device will age out if it stays that way
+
+    def _heard(self, data, sender_ip):
+        """Records a beacon or a reply to a query."""
+        try:
+            info = json.loads(data)
+        except ValueError:
+            return  # A query from another host, or something else entirely
+        if not isinstance(info, dict) or "device_id" not in info:
+            return
+        port = info.get("port", 80)
+        address = sender_ip if port == 80 else f"{sender_ip}:{port}"
+        with self._lock:
+            # A device heard on a new address (say, after a DHCP renewal, or on
+            # another interface) is the same device, not a second one
+            for known, known_info in list(self._devices.items()):
+                if (
+                    known != address
+                    and known not in self._seeds
+                    and known_info["device_id"] == info["device_id"]
+                ):
+                    del self._devices[known]
+            self._devices[address] = {
+                "device_id": info["device_id"],
+                "api": info.get("api"),
+                "last_seen": time.monotonic(),
+            }
+
+    def _listen_until(self, deadline):
+        """Handles incoming datagrams until deadline (a time.monotonic() value)."""
+        while not self._stop.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            self._sock.settimeout(min(remaining, STOP_CHECK_INTERVAL))
+            try:
+                data, (sender_ip, _) = self._sock.recvfrom(512)
+            except socket.timeout:
+                continue
+            except OSError:
+                continue
+            self._heard(data, sender_ip)
+
+    def _probe(self):
+        """Queries every known device directly and drops the ones gone quiet, bar seeds."""
+        now = time.monotonic()
+        with self._lock:
+            for address, info in list(self._devices.items()):
+                if address in self._seeds:
+                    continue
+                if info["last_seen"] is None:
+                    # Cached, and silent all through the first discovery round
+                    if self._ready.is_set():
+                        del self._devices[address]
+                elif now - info["last_seen"] > DEAD_AFTER:
+                    del self._devices[address]
+            ips = {address.partition(":")[0] for address in self._devices}
+        for ip in ips:
+            self._query(ip)
+
+    def _run(self):
+        self._sock = self._open_socket()
+        try:
+            self._query(BROADCAST_ADDRESS)
+            self._probe()  # Cached and seeded devices might not hear the broadcast
+            self._listen_until(time.monotonic() + DISCOVERY_TIMEOUT)
+            self._ready.set()
+            self.save()
+            while not self._stop.is_set():
+                self._listen_until(time.monotonic() + PROBE_INTERVAL)
+                self._query(BROADCAST_ADDRESS)  # Catch devices that came up since
+                self._probe()
+        finally:
+            self._ready.set()
+            self._sock.close()
+
+
+# The live devices, discovered and kept up to date in the background
+registry = Registry(PICO_IPS)
+
+# One keep-alive session per device, so repeated requests reuse the same TCP
+# connection instead of paying a handshake every time.
+_sessions: dict[str, requests.Session] = {}
+_executor = None
+
+
+def get_session(ip):
+    """Returns the persistent session used to talk to a single Pico."""
+    session = _sessions.get(ip)
+    if session is None:
+        session = requests.Session()
+        _sessions[ip] = session
+    return session
+
+
+def get_executor():
+    """Returns the shared worker pool; it starts a thread per device as needed."""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    return _executor
+
+
+def close():
+    """Closes every device session, stops the worker pool and the registry."""
+    global _executor
+    for session in _sessions.values():
+        session.close()
+    _sessions.clear()
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+        _executor = None
+    registry.stop()
+
+
+if __name__ == "__main__":
+    registry.load()
+    registry.start()
+    registry.wait_ready()
+    for address, info in registry.devices().items():
+        print(f"{address:<22} {info['device_id'] or 'N/A':<25} {info['api'] or ''}")
+    registry.stop()
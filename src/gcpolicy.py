@@ -0,0 +1,74 @@
+# gcpolicy.py
+# Garbage collection at moments when its pause can't be heard, for the Pico firmware.
+#
+# MicroPython collects garbage whenever an allocation finds the heap full,
+# which may be in the middle of a melody: the next note then starts late by
+# however long the collection takes, a few milliseconds. Instead, once enough
+# has been allocated since the last collection, the firmware collects at the
+# next quiet moment: a rest or a gap between notes long enough to hide the
+# pause (gap()), or a time when no API sound is playing at all (idle()).
+# Collecting little and often also keeps each pause short.
+#
+# Every collection run here is timed. The last and the longest pause are in
+# /metrics (see metrics.py), and with report set, each new longest pause is
+# also logged.
+
+import gc
+import time
+
+import devlog
+import metrics
+
+COLLECT_EVERY_BYTES = 16 * 1024  # Allocated since the last collection for the next one
+LOW_FREE_BYTES = 16 * 1024  # With less heap free than this, any gap will do
+EXPECTED_PAUSE_US = 5000  # What a collection is assumed to take until one has been timed
+PAUSE_MARGIN_US = 2000  # Spare time a gap must have beyond the longest pause
+
+# Whether to log every new longest pause (at INFO level)
+report = False
+
+_collect_at = 0  # gc.mem_alloc() at which the next collection is due
+
+
+def due():
+    """Whether enough has been allocated since the last collection to run one."""
+    return gc.mem_alloc() >= _collect_at  # type: ignore[attr-defined]
+
+
+def collect():
+    """Runs a collection now, timing it."""
+    global _collect_at
+    start = time.ticks_us()  # type: ignore[attr-defined]
+    gc.collect()
+    pause = time.ticks_diff(time.ticks_us(), start)  # type: ignore[attr-defined]
+    _collect_at = gc.mem_alloc() + COLLECT_EVERY_BYTES  # type: ignore[attr-defined]
+
+    values = metrics.values
+    metrics.add(metrics.GC_SCHEDULED)
+    values[metrics.GC_PAUSE_US] = pause
+    if pause > values[metrics.GC_PAUSE_MAX_US]:
+        values[metrics.GC_PAUSE_MAX_US] = pause
+        if report:
+            devlog.info("Longest GC pause so far: %d us", pause)
+
+
+def gap(ms):
+    """Collects if one is due and fits in a silence of ms milliseconds.
+
+    Returns whether it collected. When the heap is nearly full, any gap is
+    used, however short: better a late note now than a heap full mid-note.
+    """
+    if not due():
+        return False
+    longest = max(metrics.values[metrics.GC_PAUSE_MAX_US], EXPECTED_PAUSE_US)
+    fits = ms * 1000 >= longest + PAUSE_MARGIN_US
+    if not fits and gc.mem_free() >= LOW_FREE_BYTES:  # type: ignore[attr-defined]
+        return False
+    collect()
+    return True
+
+
+def idle():
+    """Collects if one is due; for when nothing timing-sensitive is playing."""
+    if due():
+        collect()
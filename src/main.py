@@ -8,6 +8,20 @@ import network
 import json
 import asyncio
 
+import beacon
+import deviceinfo
+import devlog
+import events
+import gcpolicy
+import metrics
+import notecast
+import pitchmap
+import score
+import sensor
+import tone
+import voice
+import webserver
+
 # --- Pin Configuration ---
 # The photosensor is connected to an Analog-to-Digital Converter (ADC) pin.
 # We will read the voltage, which changes based on light.
@@ -16,11 +30,22 @@ photo_sensor_pin = machine.ADC(26)
 # The buzzer is connected to a GPIO pin that supports Pulse Width Modulation (PWM).
 # PWM allows us to create a square wave at a specific frequency to make a sound.
 buzzer_pin = machine.PWM(machine.Pin(18))
+# The buzzer is driven through this, which skips writes that change nothing
+buzzers = tone.ToneOutput((buzzer_pin,))
 
 # --- Global State ---
-# This variable will hold the task that plays a note from an API call.
-# This allows us to cancel it if a /stop request comes in.
-api_note_task = None
+# Everything the buzzer plays goes through this voice: API notes and melodies
+# take priority, and the ambient light sound fills the gaps between them.
+buzzer_voice = voice.Voice(buzzers)
+
+# Scale the ambient light sound is snapped to: "continuous", "chromatic",
+# "major" or "pentatonic" (see pitchmap.py)
+AMBIENT_SCALE = "chromatic"
+
+# Every light reading taken by the main loop, for GET /sensor/history
+light_history = sensor.SensorHistory()
+# Clients of GET /events, fed by the same main loop readings
+light_events = events.EventStream()
 
 # --- Core Functions ---
 
@@ -62,33 +87,13 @@ def connect_to_wifi(wifi_config: str = "wifi_config.json"):
 
 
 def play_tone(frequency: int, duration_ms: int) -> None:
-    """Plays a tone on the buzzer for a given duration."""
-    if frequency > 0:
-        buzzer_pin.freq(int(frequency))
-        buzzer_pin.duty_u16(32768)  # 50% duty cycle
-        time.sleep_ms(duration_ms)  # type: ignore[attr-defined]
-        stop_tone()
-    else:
-        time.sleep_ms(duration_ms)  # type: ignore[attr-defined]
+    """Plays a tone on the buzzer for a given duration, without waiting for it."""
+    buzzer_voice.play_note(frequency, duration_ms)
 
 
 def stop_tone():
     """Stops any sound from playing."""
-    buzzer_pin.duty_u16(0)  # 0% duty cycle means silence
-
-
-async def play_api_note(frequency, duration_s):
-    """Coroutine to play a note from an API call, can be cancelled."""
-    try:
-        print(f"API playing note: {frequency}Hz for {duration_s}s")
-        buzzer_pin.freq(int(frequency))
-        buzzer_pin.duty_u16(32768)  # 50% duty cycle
-        await asyncio.sleep(duration_s)
-        stop_tone()
-        print("API note finished.")
-    except asyncio.CancelledError:
-        stop_tone()
-        print("API note cancelled.")
+    buzzers.off()
 
 
 def map_value(x, in_min, in_max, out_min, out_max):
@@ -96,94 +101,205 @@ def map_value(x, in_min, in_max, out_min, out_max):
     return (x - in_min) * (out_max - out_min) // (in_max - in_min) + out_min
 
 
-async def handle_request(reader, writer):
-    """Handles incoming HTTP requests."""
-    global api_note_task
-
-    print("Client connected")
-    request_line = await reader.readline()
-    # Skip headers
-    while await reader.readline() != b"\r\n":
-        pass
-
-    try:
-        request = str(request_line, "utf-8")
-        method, url, _ = request.split()
-        print(f"Request: {method} {url}")
-    except (ValueError, IndexError):
-        writer.write(b"HTTP/1.0 400 Bad Request\r\n\r\n")
-        await writer.drain()
-        writer.close()
-        await writer.wait_closed()
-        return
-
-    # Read current sensor value
-    light_value = photo_sensor_pin.read_u16()
-
-    response = ""
-    content_type = "text/html"
-
-    # --- API Endpoint Routing ---
-    if method == "GET" and url == "/":
-        html = f"""
+# --- HTTP Endpoints ---
+# Everything that doesn't change between requests is encoded once, here. The
+# bodies with a number in them are templates, filled in place per request.
+INDEX_HEAD = b"""
         <html>
             <body>
                 <h1>Pico Light Orchestra</h1>
-                <p>Current light sensor reading: {light_value}</p>
+                <p>Current light sensor reading: """
+INDEX_TAIL = b"""</p>
             </body>
         </html>
         """
-        response = html
-    elif method == "POST" and url == "/play_note":
-        # This requires reading the request body, which is not trivial.
-        # A simple approach for a known content length:
-        # Note: A robust server would parse Content-Length header.
-        # For this student project, we'll assume a small, simple JSON body.
-        raw_data = await reader.read(1024)
-        try:
-            data = json.loads(raw_data)
-            freq = data.get("frequency", 0)
-            duration = data.get("duration", 0)
-
-            # If a note is already playing via API, cancel it first
-            if api_note_task:
-                api_note_task.cancel()
-
-            # Start the new note as a background task
-            api_note_task = asyncio.create_task(play_api_note(freq, duration))
-
-            response = '{"status": "ok", "message": "Note playing started."}'
-            content_type = "application/json"
-        except (ValueError, json.JSONDecodeError):
-            writer.write(b'HTTP/1.0 400 Bad Request\r\n\r\n{"error": "Invalid JSON"}\r\n')
-            await writer.drain()
-            writer.close()
-            await writer.wait_closed()
-            return
-
-    elif method == "POST" and url == "/stop":
-        if api_note_task:
-            api_note_task.cancel()
-            api_note_task = None
-        stop_tone()  # Force immediate stop
-        response = '{"status": "ok", "message": "All sounds stopped."}'
-        content_type = "application/json"
+INDEX_BODY = webserver.Template(INDEX_HEAD, INDEX_TAIL)
+TONE_BODY = webserver.Template(b'{"playing": true, "until_ms_from_now": ', b"}")
+PLAY_NOTE_RESPONSE = (
+    webserver.STATUS_200,
+    webserver.APPLICATION_JSON,
+    b'{"status": "ok", "message": "Note playing started."}',
+)
+STOP_RESPONSE = (
+    webserver.STATUS_200,
+    webserver.APPLICATION_JSON,
+    b'{"status": "ok", "message": "All sounds stopped."}',
+)
+HEALTH_RESPONSE = (
+    webserver.STATUS_200,
+    webserver.APPLICATION_JSON,
+    deviceinfo.HEALTH_BODY,
+)
+SCORE_CONTENT_TYPE = score.CONTENT_TYPE.encode()
+
+
+def route_index(request):
+    """GET /: a small status page showing the current light reading."""
+    INDEX_BODY.set(0, photo_sensor_pin.read_u16())
+    return webserver.STATUS_200, webserver.TEXT_HTML, INDEX_BODY.body
+
+
+def route_health(request):
+    """GET /health: the device's status and identity."""
+    return HEALTH_RESPONSE
+
+
+def route_sensor(request):
+    """GET /sensor: the current light reading."""
+    body = deviceinfo.sensor_body(photo_sensor_pin.read_u16())
+    return webserver.STATUS_200, webserver.APPLICATION_JSON, body
+
+
+def route_status(request):
+    """GET /status: /health and /sensor in one response, for dashboards."""
+    body = deviceinfo.status_body(photo_sensor_pin.read_u16())
+    return webserver.STATUS_200, webserver.APPLICATION_JSON, body
+
+
+def route_sync(request):
+    """GET /sync: clock probe for the conductor.
+
+    It brackets this timestamp with its own send/receive times to estimate
+    our clock offset (NTP-style).
+    """
+    body = b'{"ticks_ms": %d}' % time.ticks_ms()  # type: ignore[attr-defined]
+    return webserver.STATUS_200, webserver.APPLICATION_JSON, body
+
+
+def route_play_note(request):
+    """POST /play_note: plays {"frequency", "duration"} (in seconds) right away."""
+    # The numbers are read straight out of the body, so nothing is allocated
+    freq = webserver.json_number(request, b'"frequency"', 0)
+    if not tone.playable(freq):
+        return webserver.OUT_OF_RANGE
+    duration_ms = webserver.json_number(request, b'"duration"', 0, 1000)
+    if duration_ms < 0:
+        return webserver.OUT_OF_RANGE
+
+    # A new note replaces whatever the API is currently playing
+    buzzer_voice.play_note(freq, duration_ms)
+    return PLAY_NOTE_RESPONSE
+
+
+def route_tone(request):
+    """POST /tone: plays {"freq", "ms", "duty"}, optionally starting "at" a tick."""
+    freq = webserver.json_number(request, b'"freq"', 0)
+    if not tone.playable(freq):
+        return webserver.OUT_OF_RANGE
+    duration_ms = webserver.json_number(request, b'"ms"', 0)
+    duty = webserver.json_number(request, b'"duty"', tone.HALF_DUTY, tone.MAX_DUTY)
+    if duration_ms < 0 or not 0 <= duty <= tone.MAX_DUTY:
+        return webserver.OUT_OF_RANGE
+    start_at = webserver.json_number(request, b'"at"')
+    delay = voice.start_delay(start_at)
+    if delay is None:
+        return webserver.OUT_OF_RANGE
+
+    # Starting a new tone replaces whatever is currently playing
+    buzzer_voice.play_note(freq, duration_ms, duty, start_at)
+
+    TONE_BODY.set(0, delay + duration_ms)
+    return webserver.STATUS_202, webserver.APPLICATION_JSON, TONE_BODY.body
+
+
+def route_melody(request):
+    """POST /melody: plays a JSON note list or a packed binary score.
+
+    With only one buzzer, a two-voice score plays just its first voice.
+    """
+    # Both kinds of body become a packed score, so there is one playback path.
+    # The body lives in the connection's buffer, so the score gets its own copy.
+    if request.content_type == SCORE_CONTENT_TYPE:
+        melody = bytes(request.body)
     else:
-        writer.write(b"HTTP/1.0 404 Not Found\r\n\r\n")
-        await writer.drain()
-        writer.close()
-        await writer.wait_closed()
-        return
+        data = request.json()
+        try:
+            melody = score.from_json(data)
+        except ValueError:
+            return webserver.OUT_OF_RANGE
+    count, _, start_at = score.read_header(melody)
+    if voice.start_delay(start_at) is None:
+        return webserver.OUT_OF_RANGE
+    if not score.frequencies_within(melody, tone.MIN_FREQ, tone.MAX_FREQ):
+        return webserver.OUT_OF_RANGE
+
+    # A new melody replaces whatever is currently playing
+    buzzer_voice.play_melody(melody)
+
+    return webserver.STATUS_202, webserver.APPLICATION_JSON, b'{"queued": %d}' % count
+
+
+def route_stop(request):
+    """POST /stop: silences the buzzer and cancels any API note or melody."""
+    buzzer_voice.stop()
+    return STOP_RESPONSE
+
 
-    # Send response
-    writer.write(
-        f"HTTP/1.0 200 OK\r\nContent-type: {content_type}\r\n\r\n".encode("utf-8")
-    )
-    writer.write(response.encode("utf-8"))
-    await writer.drain()
-    writer.close()
-    await writer.wait_closed()
-    print("Client disconnected")
+def route_sensor_history(request):
+    """GET /sensor/history?window_ms=&buckets=: light readings, downsampled.
+
+    Each bucket is [min, max, mean] of the raw readings in it, or null.
+    """
+    try:
+        window_ms = webserver.query_int(request, "window_ms", 60000)
+        buckets = webserver.query_int(request, "buckets", 20)
+    except ValueError:
+        return webserver.INVALID_QUERY
+    if window_ms <= 0 or not 0 < buckets <= 200:
+        return webserver.INVALID_QUERY
+    summary = light_history.summarize(window_ms, buckets)
+    body = json.dumps({"bucket_ms": window_ms // buckets, "buckets": summary}).encode()
+    return webserver.STATUS_200, webserver.APPLICATION_JSON, body
+
+
+def route_logs(request):
+    """GET /logs[?level=]: the device's recent log messages, oldest first.
+
+    With ?level= (debug, info, warning or error), only messages at that level
+    or above are kept from then on.
+    """
+    name = webserver.query_param(request, "level")
+    if name is not None:
+        try:
+            devlog.set_level(devlog.level_named(name))
+        except ValueError:
+            return webserver.INVALID_QUERY
+    body = "\n".join(devlog.recent()).encode()
+    return webserver.STATUS_200, webserver.TEXT_PLAIN, body
+
+
+def route_metrics(request):
+    """GET /metrics: the device's counters and gauges, as text (see metrics.py)."""
+    return webserver.STATUS_200, webserver.TEXT_PLAIN, metrics.render()
+
+
+ROUTES = {
+    ("GET", "/"): route_index,
+    ("GET", "/health"): route_health,
+    ("GET", "/sensor"): route_sensor,
+    ("GET", "/status"): route_status,
+    ("GET", "/sync"): route_sync,
+    ("POST", "/play_note"): route_play_note,
+    ("POST", "/tone"): route_tone,
+    ("POST", "/melody"): route_melody,
+    ("POST", "/stop"): route_stop,
+    ("GET", "/sensor/history"): route_sensor_history,
+    ("GET", "/logs"): route_logs,
+    ("GET", "/metrics"): route_metrics,
+}
+
+# Endpoints that keep the connection and stream their response
+STREAMS = {
+    ("GET", "/events"): light_events.serve,
+}
+metrics.add_routes(ROUTES, STREAMS)
+
+
+async def handle_request(reader, writer):
+    """Handles an HTTP connection, serving requests until the client is done."""
+    devlog.debug("Client connected")
+    await webserver.serve(reader, writer, ROUTES, streams=STREAMS)
+    devlog.debug("Client disconnected")
 
 
 async def main():
@@ -192,37 +308,47 @@ async def main():
         ip = connect_to_wifi()
         print(f"Starting web server on {ip}...")
         asyncio.create_task(asyncio.start_server(handle_request, "0.0.0.0", 80))
+        # Let conductors and dashboards find this device without its IP
+        asyncio.create_task(beacon.run(deviceinfo.beacon_body(80)))
+        # Notes the conductor broadcasts over UDP instead of sending over HTTP
+        asyncio.create_task(notecast.run(buzzer_voice.play_melody))
     except Exception as e:
         print(f"Failed to initialize: {e}")
         return
+    buzzer_voice.start()
+    gcpolicy.collect()  # Start from a clean heap, and time a first collection
 
     # This loop runs the "default" behavior: playing sound based on light
+    # Map the light value to a frequency range (C4 to C6), once for every value.
+    # Adjust the range in pitchmap.py based on your room's lighting.
+    pitch_table = pitchmap.build_table(AMBIENT_SCALE)
+    light_filter = sensor.LightFilter(photo_sensor_pin)
+    pitch = sensor.Hysteresis()
+    # Samples faster while the light is changing, slower while it sits still
+    interval = sensor.AdaptiveInterval()
     while True:
-        # Only run this loop if no API note is currently scheduled to play
-        if api_note_task is None or api_note_task.done():
-            # Read the sensor. Values range from ~500 (dark) to ~65535 (bright)
-            light_value = photo_sensor_pin.read_u16()
-
-            # Map the light value to a frequency range (e.g., C4 to C6)
-            # Adjust the input range based on your room's lighting
-            min_light = 1000
-            max_light = 65000
-            min_freq = 261  # C4
-            max_freq = 1046  # C6
-
-            # Clamp the light value to the expected range
-            clamped_light = max(min_light, min(light_value, max_light))
-
-            if clamped_light > min_light:
-                frequency = map_value(
-                    clamped_light, min_light, max_light, min_freq, max_freq
-                )
-                buzzer_pin.freq(frequency)
-                buzzer_pin.duty_u16(32768)  # 50% duty cycle
-            else:
-                stop_tone()  # If it's very dark, be quiet
-
-        await asyncio.sleep_ms(50)  # type: ignore[attr-defined]
+        # Read the sensor. Values range from ~500 (dark) to ~65535 (bright)
+        light_value = light_filter.read()
+        now = time.ticks_ms()  # type: ignore[attr-defined]
+        light_history.add(light_value, now)
+        light_events.publish(light_value, now)
+
+        # The voice only plays the light while no API note or melody is playing
+        frequency = pitch_table[light_value >> pitchmap.LUT_SHIFT]
+        if frequency:
+            # The held pitch only moves on a real change, and buzzers skips
+            # the PWM writes entirely while it stays put
+            pitch.update(frequency)
+            buzzer_voice.set_ambient(pitch.value)
+        else:
+            buzzer_voice.set_ambient(0)  # If it's very dark, be quiet
+        if not buzzer_voice.busy():
+            gcpolicy.idle()  # Nothing is playing that a pause could be heard in
+
+        sleep_ms = interval.update(light_value, now)
+        metrics.loop_sleeping(sleep_ms)  # To record how late the loop wakes up
+        await asyncio.sleep_ms(sleep_ms)  # type: ignore[attr-defined]
+        metrics.loop_woke()
 
 
 # Run the main event loop
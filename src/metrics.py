@@ -0,0 +1,147 @@
+# metrics.py
+# Counters and gauges for the Pico firmware, served as text at GET /metrics.
+#
+# Every metric has a fixed slot in a list built at boot, so updating one from
+# the request handler or the sampling loop stores a small int and allocates
+# nothing. Text is only produced when /metrics is scraped, one
+# "name value" line per metric, in the format Prometheus reads:
+#
+#   device_info{id="pico-w-A1B2C3D4E5F6"} 1
+#   requests_total 1042
+#   route_requests_total{route="GET /sensor"} 17
+#   mem_free_bytes 81234
+#
+# Counters (the _total ones) count up from boot, so a scraper works out rates
+# from the difference between two scrapes. The rest are gauges, holding the
+# current value.
+#
+# MicroPython only stores ints below 2**30 without allocating, so counters
+# wrap around to 0 at COUNTER_WRAP. That leaves room for the sum before it
+# wraps, and is far more than a counter moves between two scrapes. A scraper
+# that sees a counter go down adds COUNTER_WRAP to the difference.
+
+import gc
+import time
+
+import deviceinfo
+
+# --- Slots ---
+REQUESTS = 0  # Requests answered, including those for unknown paths and streams
+NOT_FOUND = 1
+PARSE_ERRORS = 2  # Malformed HTTP requests and bodies that aren't valid JSON
+BYTES_IN = 3
+BYTES_OUT = 4  # Of plain responses; event streams aren't counted
+CONNECTIONS = 5  # Accepted since boot
+ACTIVE_CONNECTIONS = 6
+GC_COLLECTIONS = 7  # Seen by the sampling loop as the allocated heap shrinking
+LOOP_WAKES = 8  # Times the sampling loop has woken up
+LOOP_LAG_US_TOTAL = 9  # How late it woke, summed
+LOOP_LAG_US = 10  # How late it last woke
+LOOP_LAG_MAX_US = 11  # How late it has ever woken
+MEM_FREE = 12  # Read when scraped
+MEM_ALLOC = 13
+GC_SCHEDULED = 14  # Collections run by gcpolicy.py, in a gap or while idle
+GC_PAUSE_US = 15  # How long the last of those took
+GC_PAUSE_MAX_US = 16  # How long the longest of those took
+
+_NAMES = (
+    b"requests_total ",
+    b"not_found_total ",
+    b"parse_errors_total ",
+    b"bytes_in_total ",
+    b"bytes_out_total ",
+    b"connections_total ",
+    b"active_connections ",
+    b"gc_collections_total ",
+    b"loop_wakes_total ",
+    b"loop_lag_us_total ",
+    b"loop_lag_us ",
+    b"loop_lag_max_us ",
+    b"mem_free_bytes ",
+    b"mem_alloc_bytes ",
+    b"gc_scheduled_total ",
+    b"gc_pause_us ",
+    b"gc_pause_max_us ",
+)
+
+values = [0] * len(_NAMES)
+
+COUNTER_WRAP = 1 << 29
+
+_INFO = b'device_info{id="' + deviceinfo.DEVICE_ID + b'"} 1\n'
+
+# Requests per route, in slots given out by add_routes()
+_route_slots: dict = {}  # (method, path) -> slot
+_route_labels: list = []  # Slot -> 'route_requests_total{route="GET /"} '
+_route_counts: list = []
+
+_last_alloc = 0  # gc.mem_alloc() when the sampling loop last woke
+_wake_at = 0  # time.ticks_us() the sampling loop should wake up at
+
+
+def add(slot, n=1):
+    """Adds n to a counter, wrapping at COUNTER_WRAP (or to a gauge, if n is negative)."""
+    value = values[slot] + n
+    if value >= COUNTER_WRAP:
+        value -= COUNTER_WRAP
+    values[slot] = value
+
+
+def add_routes(*tables):
+    """Gives every (method, path) in the route tables a request counter."""
+    for table in tables:
+        for key in table:
+            if key not in _route_slots:
+                _route_slots[key] = len(_route_counts)
+                route = (key[0] + " " + key[1]).encode()
+                _route_labels.append(b'route_requests_total{route="' + route + b'"} ')
+                _route_counts.append(0)
+
+
+def count_route(key):
+    """Counts a request for a route given to add_routes(); others are ignored."""
+    slot = _route_slots.get(key)
+    if slot is not None:
+        count = _route_counts[slot] + 1
+        _route_counts[slot] = 0 if count == COUNTER_WRAP else count
+
+
+def loop_sleeping(ms):
+    """Called by the sampling loop just before it sleeps for ms milliseconds."""
+    global _wake_at
+    _wake_at = time.ticks_add(time.ticks_us(), ms * 1000)  # type: ignore[attr-defined]
+
+
+def loop_woke():
+    """Called by the sampling loop as it wakes, to record how late it is.
+
+    Each wake also samples the heap, counting a garbage collection whenever
+    less of it is allocated than on the previous wake. The two calls stand in
+    for wrapping asyncio.sleep_ms(), which would create a coroutine per sleep.
+    """
+    global _last_alloc
+    lag = max(0, time.ticks_diff(time.ticks_us(), _wake_at))  # type: ignore[attr-defined]
+    add(LOOP_WAKES)
+    add(LOOP_LAG_US_TOTAL, lag)
+    values[LOOP_LAG_US] = lag
+    if lag > values[LOOP_LAG_MAX_US]:
+        values[LOOP_LAG_MAX_US] = lag
+
+    alloc = gc.mem_alloc()  # type: ignore[attr-defined]
+    if alloc < _last_alloc:
+        add(GC_COLLECTIONS)
+    _last_alloc = alloc
+
+
+def render():
+    """Returns every metric as text, for GET /metrics."""
+    values[MEM_FREE] = gc.mem_free()  # type: ignore[attr-defined]
+    values[MEM_ALLOC] = gc.mem_alloc()  # type: ignore[attr-defined]
+    lines = [_INFO]
+    for i in range(len(values)):
+        lines.append(_NAMES[i])
+        lines.append(b"%d\n" % values[i])
+    for i in range(len(_route_counts)):
+        lines.append(_route_labels[i])
+        lines.append(b"%d\n" % _route_counts[i])
+    return b"".join(lines)
@@ -0,0 +1,102 @@
+# notecast.py
+# Notes broadcast over UDP, shared by the Pico firmware and the conductor.
+#
+# Instead of one HTTP request per device, the conductor can send a note or a
+# whole melody to every device at once as a single UDP broadcast datagram:
+#
+#   header: magic b"PN", version (u8), flags (u8), seq (u32), lead_ms (u16)
+#   then:   a packed score (see score.py)
+#
+# All fields are little-endian. Every device hears the datagram at the same
+# moment, so each one starts the score lead_ms after it arrived; no clock
+# sync is needed. seq goes up by one per datagram, and a device ignores any
+# datagram whose seq isn't newer than the last one it played, so duplicates
+# (the conductor sends each one more than once) and late arrivals are dropped.
+
+import asyncio
+import select
+import socket
+import struct
+import time
+
+import devlog
+import score
+
+NOTE_PORT = 4211
+MAGIC = b"PN"
+VERSION = 1
+
+HEADER_FORMAT = "<2sBBIH"
+HEADER_SIZE = 10
+MAX_DATAGRAM = 1472  # The most that fits in one Ethernet frame
+MAX_LEAD_MS = 0xFFFF  # The most lead_ms's u16 field holds
+
+POLL_MS = 5  # Also how far apart two devices may start the same note
+
+
+def encode(seq, melody, lead_ms):
+    """Wraps a packed score (without a start time) into a datagram."""
+    if not 0 <= lead_ms <= MAX_LEAD_MS:
+        raise ValueError("lead_ms out of range")
+    datagram = struct.pack(HEADER_FORMAT, MAGIC, VERSION, 0, seq, lead_ms) + melody
+    if len(datagram) > MAX_DATAGRAM:
+        raise ValueError("too many notes for one datagram")
+    return datagram
+
+
+def decode(datagram):
+    """Returns (seq, lead_ms, score) from a datagram, or raises ValueError."""
+    if len(datagram) < HEADER_SIZE:
+        raise ValueError("datagram too short")
+    magic, version, _, seq, lead_ms = struct.unpack_from(HEADER_FORMAT, datagram, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("not a note datagram")
+    melody = datagram[HEADER_SIZE:]
+    score.read_header(melody)  # Validates it
+    return seq, lead_ms, melody
+
+
+def is_newer(seq, last_seq):
+    """Whether seq comes after last_seq, allowing for the counter wrapping."""
+    return 0 < (seq - last_seq) & 0xFFFFFFFF < 0x80000000
+
+
+async def run(play, port=NOTE_PORT):
+    """Receives note datagrams forever, passing each new score to play().
+
+    The score passed on has its start time set, in time.ticks_ms(). As
+    MicroPython's asyncio has no datagram streams, the socket is checked
+    every POLL_MS, with a poll() that costs nothing while no datagram is
+    waiting; recvfrom() is only called once one is.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("0.0.0.0", port))
+    sock.setblocking(False)
+    poller = select.poll()
+    poller.register(sock, select.POLLIN)
+    # MicroPython's ipoll() reuses its result, where poll() allocates a list
+    ready = getattr(poller, "ipoll", poller.poll)
+    devlog.info("Listening for notes on UDP port %d", port)
+
+    last_seq = None
+    while True:
+        waiting = False
+        for _ in ready(0):
+            waiting = True
+        if not waiting:
+            await asyncio.sleep_ms(POLL_MS)  # type: ignore[attr-defined]
+            continue
+        try:
+            datagram, _ = sock.recvfrom(MAX_DATAGRAM)
+        except OSError:
+            continue
+        received = time.ticks_ms()  # type: ignore[attr-defined]
+        try:
+            seq, lead_ms, melody = decode(datagram)
+        except ValueError:
+            continue
+        if last_seq is not None and not is_newer(seq, last_seq):
+            continue  # A duplicate, or overtaken by a newer datagram
+        last_seq = seq
+        start_at = time.ticks_add(received, lead_ms)  # type: ignore[attr-defined]
+        play(score.with_start(melody, start_at))
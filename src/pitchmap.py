@@ -0,0 +1,67 @@
+# pitchmap.py
+# Precomputed light-to-pitch lookup table for the Pico firmware.
+#
+# The ambient loop maps a 16-bit light reading to a buzzer frequency on every
+# tick. The mapping never changes, so it is worked out once at boot for every
+# possible value of the reading's top LUT_BITS bits, and the loop does
+#
+#     frequency = table[light_value >> LUT_SHIFT]
+#
+# The table can also snap every pitch to the nearest note of a scale, so the
+# ambient sound is in tune. A frequency of 0 means "too dark, stay silent".
+
+import math
+from array import array
+
+LUT_BITS = 10  # 1024 entries, 2 KB
+LUT_SHIFT = 16 - LUT_BITS
+
+# Default mapping: light readings between these map onto C4..C6
+MIN_LIGHT = 1000
+MAX_LIGHT = 65000
+MIN_FREQ = 261  # C4
+MAX_FREQ = 1046  # C6
+
+# Semitones above C allowed by each scale. "continuous" doesn't snap at all.
+SCALES = {
+    "continuous": None,
+    "chromatic": (0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11),
+    "major": (0, 2, 4, 5, 7, 9, 11),
+    "pentatonic": (0, 2, 4, 7, 9),
+}
+
+
+def snap_to_scale(frequency, steps):
+    """Returns the frequency of the closest note whose pitch class is in steps."""
+    # MIDI note numbers: 69 is A4 = 440 Hz, and C is every multiple of 12
+    note = round(69 + 12 * math.log(frequency / 440) / math.log(2))
+    for distance in range(12):
+        for candidate in (note - distance, note + distance):
+            if candidate % 12 in steps:
+                return round(440 * 2 ** ((candidate - 69) / 12))
+    return frequency
+
+
+def build_table(
+    scale="continuous",
+    min_light=MIN_LIGHT,
+    max_light=MAX_LIGHT,
+    min_freq=MIN_FREQ,
+    max_freq=MAX_FREQ,
+):
+    """Builds the table mapping light_value >> LUT_SHIFT to a frequency in Hz."""
+    steps = SCALES[scale]
+    table = array("H", [0] * (1 << LUT_BITS))
+    half_bin = (1 << LUT_SHIFT) // 2
+    for i in range(len(table)):
+        # Use the middle of the range of readings this entry stands for
+        light = min((i << LUT_SHIFT) + half_bin, max_light)
+        if light <= min_light:
+            continue  # Too dark: silent
+        frequency = (light - min_light) * (max_freq - min_freq) // (
+            max_light - min_light
+        ) + min_freq
+        if steps is not None:
+            frequency = snap_to_scale(frequency, steps)
+        table[i] = frequency
+    return table
@@ -0,0 +1,161 @@
+# score.py
+# Packed binary score format, shared by the Pico firmware and the conductor.
+#
+# A score is a 12-byte header followed by one 4-byte record per note:
+#
+#   header: magic b"PS", version (u8), flags (u8), count (u16), gap_ms (u16), at (u32)
+#   record: freq (u16), ms (u16)
+#
+# All fields are little-endian. If bit 0 of flags is set, "at" is the device's
+# time.ticks_ms() value at which the first note should start. If bit 1 is set,
+# the score has two voices and every record is 6 bytes instead:
+#
+#   record: freq (u16), freq2 (u16), ms (u16)
+#
+# A frequency of 0 is a rest.
+
+import struct
+
+CONTENT_TYPE = "application/x-pico-score"
+
+MAGIC = b"PS"
+VERSION = 1
+FLAG_HAS_START = 0x01
+FLAG_TWO_VOICES = 0x02
+
+HEADER_FORMAT = "<2sBBHHI"
+HEADER_SIZE = 12
+RECORD_SIZE = 4
+CHORD_RECORD_SIZE = 6
+FLAGS_OFFSET = 3
+COUNT_OFFSET = 4
+START_OFFSET = 8
+MAX_U16 = 0xFFFF
+MAX_U32 = 0xFFFFFFFF
+
+
+def encode(notes, gap_ms=0, start_at=None):
+    """Packs a list of (frequency, duration_ms) notes into a score.
+
+    A frequency may also be a (frequency, frequency2) pair, to sound two notes
+    at once. Any pair makes it a two-voice score, where single notes leave the
+    second voice resting. Raises ValueError if a value doesn't fit its field.
+    """
+    _check_field(gap_ms, MAX_U16)
+    if start_at is not None:
+        _check_field(start_at, MAX_U32)
+    for frequency, duration_ms in notes:
+        for f in frequency if isinstance(frequency, (tuple, list)) else (frequency,):
+            _check_field(f, MAX_U16)
+        _check_field(duration_ms, MAX_U16)
+    two_voices = any(isinstance(frequency, (tuple, list)) for frequency, _ in notes)
+    flags = 0 if start_at is None else FLAG_HAS_START
+    record_size = RECORD_SIZE
+    if two_voices:
+        flags |= FLAG_TWO_VOICES
+        record_size = CHORD_RECORD_SIZE
+    buf = bytearray(HEADER_SIZE + record_size * len(notes))
+    struct.pack_into(
+        HEADER_FORMAT, buf, 0, MAGIC, VERSION, flags, len(notes), gap_ms, start_at or 0
+    )
+    offset = HEADER_SIZE
+    for frequency, duration_ms in notes:
+        if not two_voices:
+            struct.pack_into("<HH", buf, offset, frequency, duration_ms)
+        elif isinstance(frequency, (tuple, list)):
+            struct.pack_into("<HHH", buf, offset, frequency[0], frequency[1], duration_ms)
+        else:
+            struct.pack_into("<HHH", buf, offset, frequency, 0, duration_ms)
+        offset += record_size
+    return bytes(buf)
+
+
+def from_json(data):
+    """Packs a decoded /melody JSON body into a score.
+
+    Each note is {"freq": f, "ms": d} or {"freqs": [f, f2], "ms": d}. Raises
+    ValueError for a value that isn't a number or doesn't fit its field.
+    """
+    notes = []
+    for note in data["notes"]:
+        if "freqs" in note:
+            frequency = tuple(int(f) for f in note["freqs"])
+            if len(frequency) != 2:
+                raise ValueError("a note has one or two frequencies")
+        else:
+            frequency = int(note["freq"])
+        notes.append((frequency, int(note["ms"])))
+    start_at = data.get("at")
+    if start_at is not None:
+        start_at = int(start_at)
+    return encode(notes, int(data.get("gap_ms", 0)), start_at)
+
+
+def _check_field(value, high):
+    # CPython's struct.pack_into() raises struct.error out of range and MicroPython's
+    # silently truncates, so neither can be left to catch a bad value
+    if not 0 <= value <= high:
+        raise ValueError("value out of range")
+
+
+def with_start(score, start_at):
+    """Returns a copy of a score that starts at the given device ticks_ms() time."""
+    buf = bytearray(score)
+    buf[FLAGS_OFFSET] |= FLAG_HAS_START
+    struct.pack_into("<I", buf, START_OFFSET, start_at)
+    return bytes(buf)
+
+
+def read_header(score):
+    """Validates a score and returns (count, gap_ms, start_at or None)."""
+    if len(score) < HEADER_SIZE:
+        raise ValueError("score too short")
+    magic, version, flags, count, gap_ms, start_at = struct.unpack_from(
+        HEADER_FORMAT, score, 0
+    )
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("not a score")
+    if len(score) < HEADER_SIZE + count * _record_size(score):
+        raise ValueError("score truncated")
+    if not flags & FLAG_HAS_START:
+        start_at = None
+    return count, gap_ms, start_at
+
+
+# These read one field of one note straight out of the buffer. They only do
+# small-integer arithmetic, so stepping through a score allocates nothing.
+
+
+def _record_size(score):
+    if score[FLAGS_OFFSET] & FLAG_TWO_VOICES:
+        return CHORD_RECORD_SIZE
+    return RECORD_SIZE
+
+
+def voices(score):
+    """Returns how many notes each record of the score holds, 1 or 2."""
+    return 2 if score[FLAGS_OFFSET] & FLAG_TWO_VOICES else 1
+
+
+def frequency(score, index, voice=0):
+    """Returns the frequency one voice plays for the note at index."""
+    offset = HEADER_SIZE + index * _record_size(score) + 2 * voice
+    return score[offset] | (score[offset + 1] << 8)
+
+
+def duration_ms(score, index):
+    """Returns the duration of the note at index, in milliseconds."""
+    size = _record_size(score)
+    offset = HEADER_SIZE + index * size + size - 2
+    return score[offset] | (score[offset + 1] << 8)
+
+
+def frequencies_within(score, low, high):
+    """Whether every note of a validated score is a rest or from low to high Hz."""
+    count = score[COUNT_OFFSET] | (score[COUNT_OFFSET + 1] << 8)
+    for index in range(count):
+        for voice in range(voices(score)):
+            f = frequency(score, index, voice)
+            if f and not low <= f <= high:
+                return False
+    return True
@@ -0,0 +1,148 @@
+# scrape.py
+# To be run on a student's computer (not the Pico)
+#
+# Usage: python scrape.py [--every SECONDS] [--out FILE]
+#
+# Scrapes GET /metrics from every device at once and prints a line per device
+# with the numbers that show a Pico struggling: request rate, parse errors,
+# open connections, free memory, garbage collections and how late its
+# sampling loop wakes up. Rates are worked out from the previous scrape.
+# With --out, every scrape is also appended to FILE as one JSON object per
+# device and line, for graphing later.
+
+import argparse
+import json
+import re
+import time
+
+import requests
+
+import fleet
+
+# --- Configuration ---
+# Devices on the local network are discovered automatically. Picos discovery
+# can't reach are listed in fleet.PICO_IPS.
+REQUEST_TIMEOUT = 2.0
+
+# Must match metrics.py: counters start again from 0 when they reach this
+COUNTER_WRAP = 1 << 29
+
+# One line of /metrics: name, optional {labels}, value
+_LINE = re.compile(r"^(\w+)(\{[^}]*\})? (-?\d+)$")
+
+registry = fleet.registry
+
+
+def parse_metrics(text):
+    """Returns {name: value} from /metrics text; labelled names keep their labels."""
+    metrics = {}
+    for line in text.splitlines():
+        match = _LINE.match(line)
+        if match:
+            name, labels, value = match.groups()
+            metrics[name + (labels or "")] = int(value)
+    return metrics
+
+
+def scrape_device(ip):
+    """Returns one device's metrics, or None if it didn't answer."""
+    try:
+        res = fleet.get_session(ip).get(f"http://{ip}/metrics", timeout=REQUEST_TIMEOUT)
+        res.raise_for_status()
+    except requests.exceptions.RequestException:
+        return None
+    return parse_metrics(res.text)
+
+
+def scrape_all(ips):
+    """Scrapes every device at once; returns {ip: metrics or None}."""
+    return dict(zip(ips, fleet.get_executor().map(scrape_device, ips)))
+
+
+def device_id(metrics):
+    """Returns the device ID from a device's device_info metric, or "N/A"."""
+    for name in metrics:
+        if name.startswith('device_info{id="'):
+            return name[len('device_info{id="') : -2]
+    return "N/A"
+
+
+def format_row(ip, metrics, previous, seconds):
+    """Formats one device's line, with rates since its previous scrape."""
+    if metrics is None:
+        return f"{ip:<21} {'No reply':<25}"
+
+    def delta(name):
+        if previous is None:
+            return 0
+        value = metrics.get(name, 0)
+        difference = value - previous.get(name, 0)
+        if difference >= 0:
+            return difference
+        # A drop is a wrap only if the old value was near COUNTER_WRAP and the
+        # new one near 0; anything else means the device restarted from 0
+        if difference + COUNTER_WRAP < COUNTER_WRAP // 2:
+            return difference + COUNTER_WRAP
+        return value
+
+    def rate(name):
+        return delta(name) / seconds if seconds else 0.0
+
+    wakes = delta("loop_wakes_total")
+    mean_lag_ms = delta("loop_lag_us_total") / wakes / 1000 if wakes else 0.0
+    return (
+        f"{ip:<21} {device_id(metrics):<25} {rate('requests_total'):>7.1f} "
+        f"{metrics.get('parse_errors_total', 0):>6} "
+        f"{metrics.get('active_connections', 0):>5} "
+        f"{metrics.get('mem_free_bytes', 0) // 1024:>7} "
+        f"{rate('gc_collections_total'):>6.2f} "
+        f"{mean_lag_ms:>8.2f} {metrics.get('loop_lag_max_us', 0) / 1000:>8.2f}"
+    )
+
+
+def render(scrapes, previous, seconds):
+    print("--- Pico Orchestra Metrics --- (Press Ctrl+C to exit)")
+    print(
+        f"{'IP Address':<21} {'Device ID':<25} {'req/s':>7} {'errors':>6} {'conns':>5} "
+        f"{'free KB':>7} {'GC/s':>6} {'lag ms':>8} {'max ms':>8}"
+    )
+    for ip, metrics in scrapes.items():
+        print(format_row(ip, metrics, previous.get(ip), seconds))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scrape /metrics from every Pico.")
+    parser.add_argument(
+        "--every", type=float, default=5.0, help="seconds between scrapes (default 5)"
+    )
+    parser.add_argument("--out", help="file to append every scrape to, as JSON lines")
+    args = parser.parse_args()
+
+    registry.load()
+    registry.start()
+    registry.wait_ready()
+
+    previous: dict[str, dict] = {}
+    last_time = None
+    out = open(args.out, "a") if args.out else None
+    try:
+        while True:
+            started = time.monotonic()
+            scrapes = scrape_all(registry.addresses())
+            seconds = started - last_time if last_time else 0
+            render(scrapes, previous, seconds)
+            if out is not None:
+                now = time.time()
+                for ip, metrics in scrapes.items():
+                    if metrics is not None:
+                        out.write(json.dumps({"time": now, "ip": ip, **metrics}) + "\n")
+                out.flush()
+            previous = {ip: m for ip, m in scrapes.items() if m is not None}
+            last_time = started
+            time.sleep(max(0, started + args.every - time.monotonic()))
+    except KeyboardInterrupt:
+        print("\nScraper stopped.")
+    finally:
+        if out is not None:
+            out.close()
+        fleet.close()
@@ -0,0 +1,179 @@
+# sensor.py
+# Light sensor helpers for the Pico firmware.
+
+import time
+from array import array
+
+HISTORY_SIZE = 1200  # 60 s of readings at one every 50 ms; 24 s at the fastest
+
+OVERSAMPLE = 8  # ADC reads averaged into each filtered reading
+EMA_SHIFT = 2  # The EMA moves 1/2**EMA_SHIFT of the way to each new reading
+PITCH_HYSTERESIS_HZ = 6  # Smallest pitch change worth reprogramming the buzzer for
+
+# Sampling interval bounds for AdaptiveInterval, in ms
+MIN_INTERVAL_MS = 20  # While the light is changing quickly, e.g. a hand waving
+MAX_INTERVAL_MS = 250  # While it sits still
+START_INTERVAL_MS = 50
+# Change rates, in filtered read_u16() units per second
+FAST_RATE = 20000  # A single change this fast drops straight to MIN_INTERVAL_MS
+FLAT_RATE = 1500  # At or below this on average, the light counts as still
+RATE_SHIFT = 2  # The average rate moves 1/2**RATE_SHIFT of the way to each new one
+
+
+class LightFilter:
+    """Reads the light sensor with oversampling, a median-of-3 and an integer EMA.
+
+    Averaging a quick burst of reads removes most ADC noise, the median of the
+    last three bursts throws away single spikes, and the EMA smooths what is
+    left. Everything is integer arithmetic, so no reading allocates.
+    """
+
+    def __init__(self, adc, oversample=OVERSAMPLE, ema_shift=EMA_SHIFT):
+        self.adc = adc
+        self.oversample = oversample
+        self.ema_shift = ema_shift
+        self.prev1 = -1  # The previous two burst averages, -1 until we have them
+        self.prev2 = -1
+        self.acc = -1  # The EMA, scaled up by 2**ema_shift to keep precision
+
+    def read(self):
+        """Takes a burst of reads and returns the filtered 16-bit light value."""
+        total = 0
+        for _ in range(self.oversample):
+            total += self.adc.read_u16()
+        burst = total // self.oversample
+
+        if self.acc < 0:
+            # First reading: start every stage from it
+            self.prev1 = self.prev2 = burst
+            self.acc = burst << self.ema_shift
+            return burst
+
+        # Median of the last three bursts
+        a, b = self.prev1, self.prev2
+        self.prev2 = a
+        self.prev1 = burst
+        if a > b:
+            a, b = b, a
+        median = a if burst < a else (b if burst > b else burst)
+
+        self.acc += median - (self.acc >> self.ema_shift)
+        return self.acc >> self.ema_shift
+
+
+class Hysteresis:
+    """Holds a value steady until its input moves at least band away from it."""
+
+    def __init__(self, band=PITCH_HYSTERESIS_HZ):
+        self.band = band
+        self.value = -1  # Nothing held yet
+
+    def update(self, x):
+        """Feeds a new input; returns True if the held value changed."""
+        if self.value >= 0 and abs(x - self.value) < self.band:
+            return False
+        self.value = x
+        return True
+
+
+class AdaptiveInterval:
+    """Chooses how long the light loop sleeps from how fast the light is changing.
+
+    A sudden change drops the interval to min_ms at once, so a gesture is
+    followed closely from its start. While the average rate of change stays
+    high the interval keeps halving toward min_ms, and once the light is
+    still it grows by a quarter per reading up to max_ms, leaving the CPU to
+    the web server. Integer arithmetic only, so nothing is allocated.
+    """
+
+    def __init__(
+        self,
+        min_ms=MIN_INTERVAL_MS,
+        max_ms=MAX_INTERVAL_MS,
+        fast_rate=FAST_RATE,
+        flat_rate=FLAT_RATE,
+    ):
+        self.min_ms = min_ms
+        self.max_ms = max_ms
+        self.fast_rate = fast_rate
+        self.flat_rate = flat_rate
+        self.interval_ms = max(min_ms, min(START_INTERVAL_MS, max_ms))
+        self.rate = 0  # Average change per second
+        self.last_value = -1  # Nothing read yet
+        self.last_ticks = 0
+
+    def update(self, value, ticks):
+        """Feeds the reading taken at time.ticks_ms() ticks; returns the ms to sleep."""
+        if self.last_value >= 0:
+            elapsed = time.ticks_diff(ticks, self.last_ticks)  # type: ignore[attr-defined]
+            rate = abs(value - self.last_value) * 1000 // max(1, elapsed)
+            self.rate += (rate - self.rate) >> RATE_SHIFT
+            if rate >= self.fast_rate:
+                self.interval_ms = self.min_ms
+            elif self.rate > self.flat_rate:
+                self.interval_ms = max(self.min_ms, self.interval_ms >> 1)
+            else:
+                grown = self.interval_ms + (self.interval_ms >> 2) + 1
+                self.interval_ms = min(self.max_ms, grown)
+        self.last_value = value
+        self.last_ticks = ticks
+        return self.interval_ms
+
+
+class SensorHistory:
+    """A fixed-size ring buffer of light readings and when they were taken.
+
+    Readings go into preallocated arrays, so recording one allocates nothing
+    and the buffer never grows. Old readings are overwritten once it is full.
+    """
+
+    def __init__(self, size=HISTORY_SIZE):
+        self.size = size
+        self.values = array("H", [0] * size)  # read_u16() values
+        self.ticks = array("I", [0] * size)  # time.ticks_ms() of each reading
+        self.head = 0  # The slot the next reading goes into
+        self.count = 0  # How many slots hold a reading
+
+    def add(self, value, ticks):
+        """Records one reading taken at time.ticks_ms() value ticks."""
+        head = self.head
+        self.values[head] = value
+        self.ticks[head] = ticks
+        head += 1
+        self.head = 0 if head == self.size else head
+        if self.count < self.size:
+            self.count += 1
+
+    def summarize(self, window_ms, buckets, now=None):
+        """Downsamples the last window_ms of readings into equal time buckets.
+
+        Returns a list of (min, max, mean) tuples, oldest bucket first, with
+        None for buckets that have no readings.
+        """
+        if now is None:
+            now = time.ticks_ms()  # type: ignore[attr-defined]
+        lows = [65535] * buckets
+        highs = [0] * buckets
+        totals = [0] * buckets
+        counts = [0] * buckets
+
+        # Walk backwards from the newest reading until we leave the window
+        i = self.head
+        for _ in range(self.count):
+            i = self.size - 1 if i == 0 else i - 1
+            age = time.ticks_diff(now, self.ticks[i])  # type: ignore[attr-defined]
+            if age >= window_ms:
+                break
+            bucket = buckets - 1 - max(0, age) * buckets // window_ms
+            value = self.values[i]
+            if value < lows[bucket]:
+                lows[bucket] = value
+            if value > highs[bucket]:
+                highs[bucket] = value
+            totals[bucket] += value
+            counts[bucket] += 1
+
+        return [
+            (lows[b], highs[b], totals[b] // counts[b]) if counts[b] else None
+            for b in range(buckets)
+        ]
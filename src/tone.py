@@ -0,0 +1,50 @@
+# tone.py
+# Buzzer output driver for the Pico firmware.
+
+HALF_DUTY = 32768  # 50% duty cycle, the loudest square wave
+MAX_DUTY = 65535  # duty_u16()'s full scale
+MIN_FREQ = 8  # The RP2's PWM can't run slower: freq() raises ValueError below this
+MAX_FREQ = 65535  # Far above hearing, and the most a score's u16 field holds
+
+
+def playable(frequency):
+    """Whether frequency is 0 (silence) or one a buzzer's PWM can be set to."""
+    return frequency == 0 or MIN_FREQ <= frequency <= MAX_FREQ
+
+
+class ToneOutput:
+    """Drives one or more buzzer PWMs, touching hardware only on a real change.
+
+    The frequency and duty last written to each pin are remembered, so asking
+    for the sound that is already playing costs a couple of comparisons
+    instead of PWM register writes. A frequency of 0 means silence.
+    """
+
+    def __init__(self, pwms):
+        self.pwms = tuple(pwms)
+        self.freqs = [0] * len(self.pwms)
+        self.duties = [-1] * len(self.pwms)  # Unknown, so the first write happens
+
+    def set(self, index, frequency, duty=HALF_DUTY):
+        """Plays frequency on one buzzer, or silences it if frequency is 0."""
+        pwm = self.pwms[index]
+        if frequency <= 0:
+            duty = 0
+        elif self.freqs[index] != frequency:
+            pwm.freq(frequency)
+            self.freqs[index] = frequency
+        if self.duties[index] != duty:
+            pwm.duty_u16(duty)
+            self.duties[index] = duty
+
+    def set_all(self, frequency, duty=HALF_DUTY):
+        """Plays the same frequency on every buzzer at once."""
+        for i in range(len(self.pwms)):
+            self.set(i, frequency, duty)
+
+    def off(self):
+        """Silences every buzzer."""
+        for i in range(len(self.pwms)):
+            if self.duties[i] != 0:
+                self.pwms[i].duty_u16(0)
+                self.duties[i] = 0
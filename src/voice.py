@@ -0,0 +1,277 @@
+# voice.py
+# One long-lived player task per buzzer, for the Pico firmware.
+#
+# Every sound a buzzer makes goes through its Voice. API commands (a note, a
+# melody or stop) are parked in the voice's one-slot mailbox and its player
+# task is woken up; a newer command simply replaces an older one that hasn't
+# started yet. If the player is busy with a command, it is interrupted by
+# cancelling whatever it is sleeping on. The player catches that and goes on
+# to the newest command, so no task is ever created per note.
+#
+# The ambient light sound has the lowest priority. set_ambient() only records
+# the pitch, which the voice plays whenever it has no API command to play.
+#
+# A device with several buzzers has one Voice each, and a VoiceAllocator that
+# hands notes to whichever voice is free, so every buzzer plays its own part.
+#
+# Playing allocates nothing per note: deadlines are small ints, notes are read
+# straight out of the score buffer, and asyncio.sleep_ms() is awaited directly
+# rather than through a coroutine of our own. Rests and the silences between
+# notes are offered to gcpolicy.py for garbage collection.
+
+import asyncio
+import time
+
+import devlog
+import gcpolicy
+import score
+import tone
+
+# Commands, in the voice's mailbox
+NOTE = 1
+MELODY = 2
+STOP = 3
+
+MAX_LEAD_MS = 60000  # The furthest from now an API command's start time may be
+
+
+def ms_until(deadline):
+    """Milliseconds until a time.ticks_ms() deadline, or 0 if it has passed."""
+    return max(0, time.ticks_diff(deadline, time.ticks_ms()))  # type: ignore[attr-defined]
+
+
+def start_delay(start_at):
+    """Milliseconds until an API command's start time, or None if it is out of range.
+
+    start_at is a time.ticks_ms() value, or None to start right away. A start
+    time more than MAX_LEAD_MS before or after now is a mistake on the
+    sender's side, not a note to wait for.
+    """
+    if start_at is None:
+        return 0
+    delay = time.ticks_diff(start_at, time.ticks_ms())  # type: ignore[attr-defined]
+    if not -MAX_LEAD_MS <= delay <= MAX_LEAD_MS:
+        return None
+    return max(0, delay)
+
+
+class Voice:
+    """Plays API notes and melodies on one buzzer of a tone.ToneOutput.
+
+    start() must be called once from inside the event loop before any
+    command is played.
+    """
+
+    def __init__(self, output, index=0):
+        self.output = output
+        self.index = index
+        self.task = None
+        self.wake = asyncio.Event()
+        self.playing = False  # Whether the player is busy with an API command
+        self.ambient = 0  # Background frequency, 0 for silence
+
+        # The mailbox: the next command and its arguments
+        self.pending = 0  # NOTE, MELODY, STOP or 0 for none
+        self.frequency = 0
+        self.duration_ms = 0
+        self.duty = tone.HALF_DUTY
+        self.start_at = None
+        self.melody = None
+        self.part = 0  # Which voice of a two-voice score this one plays
+
+    def start(self):
+        """Creates the player task."""
+        self.task = asyncio.create_task(self.run())
+
+    def busy(self):
+        """Whether an API command is playing or waiting to be played."""
+        return self.playing or self.pending != 0
+
+    def _send(self, command):
+        """Posts a command to the player, interrupting what it is playing."""
+        self.pending = command
+        if self.playing:
+            self.task.cancel()  # The player catches this and reads the mailbox
+        else:
+            self.wake.set()
+
+    def play_note(self, frequency, duration_ms, duty=tone.HALF_DUTY, start_at=None):
+        """Plays one note, optionally starting at a time.ticks_ms() value."""
+        self.frequency = int(frequency)
+        self.duration_ms = int(duration_ms)
+        self.duty = duty
+        self.start_at = start_at
+        self._send(NOTE)
+
+    def play_melody(self, melody, part=0):
+        """Plays one part of a packed binary score (see score.py)."""
+        self.melody = melody
+        self.part = part
+        self._send(MELODY)
+
+    def stop(self):
+        """Stops any API note or melody; the ambient sound takes over again."""
+        self._send(STOP)
+        self.output.set(self.index, 0)  # Silence right away, not when the player runs
+
+    def set_ambient(self, frequency):
+        """Sets the background pitch, played while no API command is."""
+        self.ambient = frequency
+        if not self.busy():
+            self.output.set(self.index, frequency)
+
+    async def run(self):
+        """The player task: plays each command it is sent, forever."""
+        while True:
+            try:
+                if not self.pending:
+                    self.playing = False
+                    self.output.set(self.index, self.ambient)
+                    await self.wake.wait()
+                    self.wake.clear()
+                command = self.pending
+                self.pending = 0
+                self.playing = True
+                if command == NOTE:
+                    await self._play_note()
+                elif command == MELODY:
+                    await self._play_melody()
+                elif devlog.level <= devlog.DEBUG:
+                    devlog.debug("Voice %d stopped.", self.index)
+            except asyncio.CancelledError:
+                if not self.pending:
+                    raise  # Not one of ours: the whole program is shutting down
+                # A newer command interrupted this one; it's in the mailbox
+                self.output.set(self.index, 0)
+            except Exception as e:
+                # Say, a frequency the PWM refused. Only this command is lost:
+                # the task is the only one that plays this buzzer, so it goes on.
+                devlog.error("Voice %d: %s", self.index, e)
+                self.playing = False
+                self.output.set(self.index, 0)
+
+    async def _play_note(self):
+        # Logging is checked first, so that its arguments aren't even packed
+        debug = devlog.level <= devlog.DEBUG
+        if self.start_at is not None:
+            self.output.set(self.index, 0)  # Keep the ambient sound quiet while we wait
+            gcpolicy.gap(ms_until(self.start_at))
+            await asyncio.sleep_ms(ms_until(self.start_at))  # type: ignore[attr-defined]
+        if debug:
+            devlog.debug(
+                "Voice %d playing %dHz for %dms",
+                self.index,
+                self.frequency,
+                self.duration_ms,
+            )
+        self.output.set(self.index, self.frequency, self.duty)
+        await asyncio.sleep_ms(self.duration_ms)  # type: ignore[attr-defined]
+        self.output.set(self.index, 0)
+        if debug:
+            devlog.debug("Voice %d note finished.", self.index)
+
+    async def _play_melody(self):
+        # Every note boundary is a deadline computed from the melody's start
+        # time, so the timing does not drift however long the melody is, and a
+        # collection in a silence only uses up time the silence had anyway.
+        melody = self.melody
+        part = self.part
+        count, gap_ms, start_at = score.read_header(melody)
+        self.output.set(self.index, 0)
+        deadline = time.ticks_ms() if start_at is None else start_at  # type: ignore[attr-defined]
+        for i in range(count):
+            await asyncio.sleep_ms(ms_until(deadline))  # type: ignore[attr-defined]
+            frequency = score.frequency(melody, i, part)
+            self.output.set(self.index, frequency)
+            deadline = time.ticks_add(  # type: ignore[attr-defined]
+                deadline, score.duration_ms(melody, i)
+            )
+            if not frequency:
+                gcpolicy.gap(ms_until(deadline))  # A rest
+            await asyncio.sleep_ms(ms_until(deadline))  # type: ignore[attr-defined]
+            self.output.set(self.index, 0)
+            if gap_ms:
+                deadline = time.ticks_add(deadline, gap_ms)  # type: ignore[attr-defined]
+                gcpolicy.gap(ms_until(deadline))
+        if devlog.level <= devlog.DEBUG:
+            devlog.debug("Voice %d melody finished.", self.index)
+
+
+class VoiceAllocator:
+    """Hands API notes to a set of voices, so each buzzer plays its own note.
+
+    A note goes to a free voice if there is one, or else takes over the voice
+    that has been playing the longest. Notes can also be sent to a voice by
+    its index.
+    """
+
+    def __init__(self, voices):
+        self.voices = voices
+        self.started = [0] * len(voices)  # When each voice was last given a note
+        self.clock = 0
+
+    def _take(self, index):
+        """Marks a voice as just given a note and returns it."""
+        self.clock += 1
+        self.started[index] = self.clock
+        return self.voices[index]
+
+    def has_voice(self, index):
+        """Whether index, from an API request, names one of the voices."""
+        return isinstance(index, int) and 0 <= index < len(self.voices)
+
+    def allocate(self, index=None):
+        """Returns the voice with the given index, or the best one to play a new note."""
+        if index is not None:
+            if not self.has_voice(index):
+                raise ValueError("no such voice")
+            return self._take(index)
+        oldest = 0
+        for i in range(len(self.voices)):
+            if not self.voices[i].busy():
+                return self._take(i)
+            if self.started[i] < self.started[oldest]:
+                oldest = i
+        return self._take(oldest)
+
+    def play_note(
+        self, frequency, duration_ms, duty=tone.HALF_DUTY, start_at=None, index=None
+    ):
+        """Plays one note on a free voice, or on the voice with the given index."""
+        self.allocate(index).play_note(frequency, duration_ms, duty, start_at)
+
+    def play_chord(self, frequencies, duration_ms, duty=tone.HALF_DUTY, start_at=None):
+        """Plays up to one note per voice, all at once."""
+        if not 0 < len(frequencies) <= len(self.voices):
+            raise ValueError("too many notes in chord")
+        if start_at is None:
+            start_at = time.ticks_ms()  # type: ignore[attr-defined]
+        for i in range(len(frequencies)):
+            self._take(i).play_note(frequencies[i], duration_ms, duty, start_at)
+
+    def play_melody(self, melody, index=None):
+        """Plays a score: each part of a two-voice score gets its own voice."""
+        if score.voices(melody) == 1:
+            self.allocate(index).play_melody(melody)
+            return
+        if len(self.voices) < 2:
+            self._take(0).play_melody(melody)  # Only room for the first part
+            return
+        _, _, start_at = score.read_header(melody)
+        if start_at is None:
+            # Both parts must count their deadlines from the same moment
+            melody = score.with_start(melody, time.ticks_ms())  # type: ignore[attr-defined]
+        self._take(0).play_melody(melody, 0)
+        self._take(1).play_melody(melody, 1)
+
+    def busy(self):
+        """Whether any voice is playing an API command."""
+        for v in self.voices:
+            if v.busy():
+                return True
+        return False
+
+    def stop(self):
+        """Stops every voice."""
+        for v in self.voices:
+            v.stop()
@@ -0,0 +1,452 @@
+# webserver.py
+# Minimal HTTP/1.1 request parser and response writer for the Pico firmware.
+#
+# One Request object is created per connection and reused for every request
+# sent over it, so the header bytes always land in the same preallocated
+# buffer. Bodies are read according to Content-Length, and connections are
+# kept open between requests unless the client asks otherwise.
+#
+# Endpoints are looked up in a route table mapping (method, path) to a handler.
+# A handler takes the Request and returns (status, content_type, body), using
+# the byte constants below so that only dynamic fields are formatted per request.
+# Handlers on the playback path go further and allocate nothing: they read
+# numbers straight out of the body with json_number() and answer with a
+# Template, whose number fields are written into a preallocated buffer.
+
+import json
+import asyncio
+
+import devlog
+import metrics
+
+HEADER_BUFFER_SIZE = 1024  # Largest request line + headers we accept
+MAX_BODY_SIZE = 4096  # Bodies that don't fit in the header buffer are allocated
+IDLE_TIMEOUT_S = 5  # How long a kept-alive connection may sit idle
+
+# --- Pre-encoded Response Pieces ---
+STATUS_200 = b"HTTP/1.1 200 OK\r\n"
+STATUS_202 = b"HTTP/1.1 202 Accepted\r\n"
+STATUS_400 = b"HTTP/1.1 400 Bad Request\r\n"
+STATUS_404 = b"HTTP/1.1 404 Not Found\r\n"
+STATUS_413 = b"HTTP/1.1 413 Payload Too Large\r\n"
+STATUS_431 = b"HTTP/1.1 431 Request Header Fields Too Large\r\n"
+
+TEXT_HTML = b"Content-Type: text/html\r\n"
+TEXT_PLAIN = b"Content-Type: text/plain\r\n"
+APPLICATION_JSON = b"Content-Type: application/json\r\n"
+
+_KEEP_ALIVE = b"Connection: keep-alive\r\n\r\n"
+_CLOSE = b"Connection: close\r\n\r\n"
+
+NOT_FOUND = (STATUS_404, TEXT_PLAIN, b"")
+INVALID_JSON = (STATUS_400, APPLICATION_JSON, b'{"error": "Invalid JSON"}')
+INVALID_QUERY = (STATUS_400, APPLICATION_JSON, b'{"error": "Invalid query"}')
+OUT_OF_RANGE = (STATUS_400, APPLICATION_JSON, b'{"error": "Value out of range"}')
+
+FIELD_WIDTH = 10  # Digits in a Template field, enough for any 32-bit number
+JSON_FRACTION_DIGITS = 6  # Digits after the point json_number() takes notice of
+
+
+class RequestError(ValueError):
+    """A request we can't serve; status is the STATUS_ line to answer with."""
+
+    def __init__(self, status):
+        super().__init__(status)
+        self.status = status
+
+
+def _find_header_end(buf, start, end):
+    """Returns the index just past the blank line that ends the headers, or -1."""
+    i = max(start, 3)
+    while i < end:
+        if buf[i] == 10 and buf[i - 1] == 13 and buf[i - 2] == 10 and buf[i - 3] == 13:
+            return i + 1
+        i += 1
+    return -1
+
+
+class Template:
+    """A response body with fixed-width number fields, filled in place.
+
+    parts are the bytes around the fields, so there is one field fewer than
+    parts. The whole body is one preallocated bytearray and set() writes a
+    number into its field right-aligned and padded with spaces, which JSON
+    and HTML both ignore, so answering with new numbers allocates nothing.
+
+    A handler's body is written out before any other handler runs, so one
+    Template per route can be shared by every connection.
+    """
+
+    def __init__(self, *parts, width=FIELD_WIDTH):
+        self.width = width
+        self.offsets = []  # Where each field starts
+        body = bytearray()
+        for i in range(len(parts)):
+            if i:
+                self.offsets.append(len(body))
+                body.extend(b" " * width)
+            body.extend(parts[i])
+        self.body = body
+
+    def set(self, field, value):
+        """Writes an integer into a field; raises ValueError if it doesn't fit."""
+        body = self.body
+        start = self.offsets[field]
+        i = start + self.width
+        negative = value < 0
+        if negative:
+            value = -value
+        while True:
+            i -= 1
+            body[i] = 48 + value % 10
+            value //= 10
+            if not value or i == start:
+                break
+        if negative and i > start:
+            i -= 1
+            body[i] = 45  # "-"
+        elif value or negative:
+            raise ValueError("number too wide for field")
+        while i > start:
+            i -= 1
+            body[i] = 32  # " "
+
+
+_CONTENT_LENGTH = Template(b"Content-Length: ", b"\r\n")
+
+
+class Request:
+    """A parsed HTTP request, reused for every request on one connection."""
+
+    def __init__(self, buffer_size=HEADER_BUFFER_SIZE):
+        self.buf = bytearray(buffer_size)
+        self.mv = memoryview(self.buf)
+        self.start = 0  # Where unread bytes from the previous read begin
+        self.end = 0  # Where the bytes received so far end
+        self.method = ""
+        self.path = ""
+        self.query = ""
+        self.content_type = b""
+        self.content_length = 0
+        self.keep_alive = False
+        self.body = self.mv[0:0]
+        # Where body lies, for reading it without copying (see json_number())
+        self.body_buf = self.buf
+        self.body_start = 0
+        self.body_end = 0
+
+    async def _fill(self, reader):
+        """Reads more bytes from the stream into the buffer."""
+        if self.end == len(self.buf):
+            raise RequestError(STATUS_431)
+        n = await reader.readinto(self.mv[self.end :])
+        if not n:
+            raise EOFError
+        self.end += n
+        metrics.add(metrics.BYTES_IN, n)
+
+    async def read(self, reader):
+        """Reads the next request from the stream.
+
+        Returns False once the client has closed the connection between
+        requests. Raises RequestError if the request is malformed.
+        """
+        # Move any bytes the client already sent for this request to the front
+        leftover = self.end - self.start
+        if leftover:
+            self.buf[:leftover] = bytes(self.mv[self.start : self.end])
+        self.start = 0
+        self.end = leftover
+
+        scanned = 0
+        header_end = _find_header_end(self.buf, 0, self.end)
+        while header_end < 0:
+            scanned = self.end
+            try:
+                await self._fill(reader)
+            except EOFError:
+                if self.end:
+                    raise RequestError(STATUS_400)
+                return False
+            header_end = _find_header_end(self.buf, scanned, self.end)
+
+        self._parse_head(bytes(self.mv[:header_end]))
+        await self._read_body(reader, header_end)
+        return True
+
+    def _parse_head(self, head):
+        """Parses the request line and the headers we care about."""
+        line_end = head.find(b"\r\n")
+        try:
+            method, target, version = head[:line_end].split()
+        except ValueError:
+            raise RequestError(STATUS_400)
+        self.method = method.decode()
+        target = target.decode()
+        query_start = target.find("?")
+        if query_start >= 0:
+            self.path = target[:query_start]
+            self.query = target[query_start + 1 :]
+        else:
+            self.path = target
+            self.query = ""
+
+        self.content_type = b""
+        self.content_length = 0
+        # HTTP/1.1 connections stay open by default, HTTP/1.0 ones don't
+        self.keep_alive = version == b"HTTP/1.1"
+
+        pos = line_end + 2
+        while pos < len(head) - 2:
+            line_end = head.find(b"\r\n", pos)
+            colon = head.find(b":", pos, line_end)
+            if colon > 0:
+                name = head[pos:colon].lower()
+                if name == b"content-length":
+                    # Digits only: a sign would put the body's end before its
+                    # start, and the next request would be read from the wrong place
+                    value = head[colon + 1 : line_end].strip()
+                    if not value or not value.isdigit():
+                        raise RequestError(STATUS_400)
+                    self.content_length = int(value)
+                elif name == b"content-type":
+                    self.content_type = head[colon + 1 : line_end].strip()
+                elif name == b"connection":
+                    value = head[colon + 1 : line_end].strip().lower()
+                    if value == b"close":
+                        self.keep_alive = False
+                    elif value == b"keep-alive":
+                        self.keep_alive = True
+            pos = line_end + 2
+
+    async def _read_body(self, reader, header_end):
+        """Reads exactly content_length body bytes following the headers."""
+        length = self.content_length
+        body_end = header_end + length
+        if body_end <= len(self.buf):
+            # The body fits in the buffer right after the headers
+            while self.end < body_end:
+                try:
+                    await self._fill(reader)
+                except EOFError:
+                    raise RequestError(STATUS_400)
+            self.body = self.mv[header_end:body_end]
+            self.body_buf = self.buf
+            self.body_start = header_end
+            self.body_end = body_end
+            self.start = body_end
+            return
+
+        if length > MAX_BODY_SIZE:
+            raise RequestError(STATUS_413)
+        body = bytearray(length)
+        received = self.end - header_end
+        body[:received] = self.mv[header_end : self.end]
+        body_mv = memoryview(body)
+        while received < length:
+            n = await reader.readinto(body_mv[received:])
+            if not n:
+                raise RequestError(STATUS_400)
+            received += n
+            metrics.add(metrics.BYTES_IN, n)
+        self.body = body_mv
+        self.body_buf = body
+        self.body_start = 0
+        self.body_end = length
+        self.start = self.end = 0
+
+    def json(self):
+        """Decodes the body as JSON."""
+        return json.loads(bytes(self.body))
+
+
+def _find(buf, needle, start, end):
+    """bytes.find() for a bytearray, which MicroPython's lacks."""
+    first = needle[0]
+    n = len(needle)
+    for i in range(start, end - n + 1):
+        if buf[i] == first:
+            j = 1
+            while j < n and buf[i + j] == needle[j]:
+                j += 1
+            if j == n:
+                return i
+    return -1
+
+
+def _skip_space(buf, i, end):
+    """Returns the index of the first byte from i that isn't whitespace."""
+    while i < end:
+        c = buf[i]
+        if c != 32 and c != 9 and c != 13 and c != 10:
+            break
+        i += 1
+    return i
+
+
+def _skip_space_back(buf, i, start):
+    """Returns the index of the last byte up to i that isn't whitespace, or start."""
+    while i > start:
+        c = buf[i]
+        if c != 32 and c != 9 and c != 13 and c != 10:
+            break
+        i -= 1
+    return i
+
+
+def json_number(request, key, default=None, scale=1):
+    """Reads one number from a JSON object body, without decoding the body.
+
+    key is the member's name in quotes, e.g. b'"freq"'. Returns the number
+    times scale as an int, rounded down (so scale=1000 turns seconds into
+    ms), or default if the member is missing or null. Raises ValueError if
+    the body isn't an object or the member isn't a number. Meant for flat
+    objects: the key only counts where it follows "{" or "," and is followed
+    by ":", so the same text inside a string value is skipped. Nothing is
+    allocated.
+    """
+    buf = request.body_buf
+    start = request.body_start
+    end = request.body_end
+    i = _skip_space(buf, start, end)
+    if i == end or buf[i] != 123:  # "{"
+        raise ValueError("body is not a JSON object")
+    while True:
+        i = _find(buf, key, i, end)
+        if i < 0:
+            return default
+        before = buf[_skip_space_back(buf, i - 1, start)]
+        after = _skip_space(buf, i + len(key), end)
+        i += 1
+        if (before == 123 or before == 44) and after < end and buf[after] == 58:  # { , :
+            break
+    i = _skip_space(buf, after + 1, end)
+    if _find(buf, b"null", i, min(end, i + 4)) == i:
+        return default
+
+    negative = i < end and buf[i] == 45  # "-"
+    if negative:
+        i += 1
+    value = 0
+    divisor = 1
+    digits = 0
+    fraction = -1  # Digits seen after the point, -1 before it
+    while i < end:
+        c = buf[i]
+        if 48 <= c <= 57:
+            if fraction < JSON_FRACTION_DIGITS:
+                value = value * 10 + c - 48
+                if fraction >= 0:
+                    divisor *= 10
+                    fraction += 1
+            digits += 1
+        elif c == 46 and fraction < 0:  # "."
+            fraction = 0
+        else:
+            break
+        i += 1
+    if not digits:
+        raise ValueError("not a number")
+    value = value * scale // divisor
+    return -value if negative else value
+
+
+def query_param(request, name, default=None):
+    """Returns a parameter from the request's query string, or default."""
+    for pair in request.query.split("&"):
+        key, _, value = pair.partition("=")
+        if key == name:
+            return value
+    return default
+
+
+def query_int(request, name, default):
+    """Returns an integer parameter from the request's query string, or default."""
+    value = query_param(request, name)
+    return default if value is None else int(value)
+
+
+async def read_request(request, reader):
+    """Reads the next request, giving up if the client stays idle too long."""
+    try:
+        return await asyncio.wait_for(request.read(reader), IDLE_TIMEOUT_S)
+    except asyncio.TimeoutError:
+        return False
+
+
+async def send_response(writer, status, content_type, body, keep_alive):
+    """Writes a complete HTTP/1.1 response with an exact Content-Length."""
+    length = _CONTENT_LENGTH
+    length.set(0, len(body))
+    end = _KEEP_ALIVE if keep_alive else _CLOSE
+    writer.write(status)
+    writer.write(content_type)
+    writer.write(length.body)
+    writer.write(end)
+    writer.write(body)
+    metrics.add(
+        metrics.BYTES_OUT,
+        len(status) + len(content_type) + len(length.body) + len(end) + len(body),
+    )
+    await writer.drain()
+
+
+async def serve(reader, writer, routes, on_request=None, streams=None):
+    """Serves requests on one connection until the client is done.
+
+    routes maps (method, path) to a handler that takes the Request and
+    returns (status, content_type, body). If given, on_request is called with
+    each Request after it has been answered.
+
+    streams maps (method, path) to a coroutine function taking the Request
+    and the writer. It takes over the connection and writes the whole
+    response itself; the connection is closed when it returns.
+    """
+    request = Request()
+    metrics.add(metrics.CONNECTIONS)
+    metrics.add(metrics.ACTIVE_CONNECTIONS)
+    try:
+        while await read_request(request, reader):
+            if devlog.level <= devlog.DEBUG:  # Not even the arguments, otherwise
+                devlog.debug("Request: %s %s", request.method, request.path)
+            key = (request.method, request.path)
+            if streams is not None and key in streams:
+                # A stream is answered as it starts, and may then run for hours
+                metrics.add(metrics.REQUESTS)
+                metrics.count_route(key)
+                try:
+                    await streams[key](request, writer)
+                except ValueError:
+                    status, content_type, body = INVALID_QUERY
+                    await send_response(writer, status, content_type, body, False)
+                break
+            handler = routes.get(key)
+            if handler is None:
+                response = NOT_FOUND
+                metrics.add(metrics.NOT_FOUND)
+            else:
+                try:
+                    response = handler(request)
+                except (ValueError, TypeError, KeyError, AttributeError):
+                    response = INVALID_JSON
+                    metrics.add(metrics.PARSE_ERRORS)
+            status, content_type, body = response
+            await send_response(writer, status, content_type, body, request.keep_alive)
+            metrics.add(metrics.REQUESTS)
+            metrics.count_route(key)
+            if on_request is not None:
+                on_request(request)
+            if not request.keep_alive:
+                break
+    except RequestError as e:
+        metrics.add(metrics.PARSE_ERRORS)
+        await send_response(writer, e.status, TEXT_PLAIN, b"", False)
+    except OSError:
+        pass  # The client went away mid-request
+    finally:
+        metrics.add(metrics.ACTIVE_CONNECTIONS, -1)
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
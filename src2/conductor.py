@@ -1,6 +1,8 @@
 import uasyncio as asyncio
 from machine import Pin, PWM, ADC
 
+import devlog  # Shared firmware module from src/
+
 # --- Pins ---
 red_led = Pin(2, Pin.OUT)    
 green_led = Pin(3, Pin.OUT)
@@ -36,7 +38,7 @@ async def color_detector_loop():
         blue_led.value(0)
        
         val_green = photo_sensor.read_u16()
-        print("Green LED reading:", val_green)
+        devlog.debug("Green LED reading: %d", val_green)
        
         if val_green > GREEN_THRESHOLD:
             play_tone(LOW_FREQ)   # Green detected → low tone
@@ -53,7 +55,7 @@ async def color_detector_loop():
         blue_led.value(0)
 
         val_red = photo_sensor.read_u16()
-        print("Red LED reading:", val_red)
+        devlog.debug("Red LED reading: %d", val_red)
 
         if val_red > RED_THRESHOLD:
             play_tone(LOW_FREQ)
@@ -71,7 +73,7 @@ async def color_detector_loop():
         blue_led.value(1)     # ON
 
         val_blue = photo_sensor.read_u16()
-        print("Blue LED reading:", val_blue)
+        devlog.debug("Blue LED reading: %d", val_blue)
 
         if val_blue > BLUE_THRESHOLD:
             play_tone(LOW_FREQ)
@@ -1,17 +1,108 @@
-import ujson as json  # MicroPython’s lightweight json
 import uos
+import ustruct as struct
 import time
+import uasyncio as asyncio
+
+# logs.db is a sequence of fixed-width little-endian records, one per request:
+#   timestamp (u32, time.time()), method code (u8), URL id (u8), light value (u16)
+# Method codes index METHODS. URL ids index the lines of logs.urls, which lists
+# each distinct URL once. Code/id 255 means "not in the table".
+# read_logs.py reads this format on a computer.
+LOG_FILE = "logs.db"
+ROTATED_LOG_FILE = "logs.db.1"
+URL_FILE = "logs.urls"
+RECORD_FORMAT = "<IBBH"
+RECORD_SIZE = 8
+METHODS = ("GET", "POST", "PUT", "DELETE", "HEAD", "OPTIONS", "PATCH")
+OTHER = 255
+MAX_URLS = 255
+
+MAX_LOG_BYTES = 64 * 1024  # logs.db is rotated before it grows past this
+BATCH_SIZE = 32  # Entries are written as soon as this many are waiting
+FLUSH_INTERVAL_S = 10  # ...or at least this often
+
+# Entries waiting to be written, as (timestamp, method code, URL id, light_value)
+_pending: list = []
+# URL -> id for every URL in logs.urls, loaded on first use
+_url_ids = None
+# URLs given an id since the last flush, still to be appended to logs.urls
+_new_urls: list = []
+
+
+def _load_url_ids() -> dict:
+    """Read the URL table from logs.urls."""
+    url_ids: dict = {}
+    try:
+        with open(URL_FILE, "r") as f:
+            for line in f:
+                url_ids[line.rstrip("\n")] = len(url_ids)
+    except OSError:
+        pass  # No URLs logged yet
+    return url_ids
+
+
+def _url_id(url: str) -> int:
+    """Return the id for a URL, adding it to the table if it is new."""
+    global _url_ids
+    if _url_ids is None:
+        _url_ids = _load_url_ids()
+    url_id = _url_ids.get(url)
+    if url_id is None:
+        if len(_url_ids) >= MAX_URLS:
+            return OTHER
+        url_id = _url_ids[url] = len(_url_ids)
+        _new_urls.append(url)
+    return url_id
+
 
 def log_request(method: str, url: str, light_value: int) -> None:
-    """Append a request log entry to logs.db"""
-    entry = {
-        "timestamp": time.time(),
-        "method": method,
-        "url": url,
-        "light_value": light_value,
-    }
+    """Queue a request log entry; it reaches logs.db on the next flush."""
+    method_code = METHODS.index(method) if method in METHODS else OTHER
+    _pending.append((int(time.time()), method_code, _url_id(url), light_value))
+    if len(_pending) >= BATCH_SIZE:
+        flush()
+
+
+def _rotate_if_full(incoming: int) -> None:
+    """Move logs.db aside if appending incoming bytes would pass MAX_LOG_BYTES."""
+    try:
+        size = uos.stat(LOG_FILE)[6]
+    except OSError:
+        return  # No log file yet
+    if size + incoming <= MAX_LOG_BYTES:
+        return
+    try:
+        uos.remove(ROTATED_LOG_FILE)
+    except OSError:
+        pass
+    uos.rename(LOG_FILE, ROTATED_LOG_FILE)
+
+
+def flush() -> None:
+    """Write every queued entry to logs.db with a single write call."""
+    if not _pending:
+        return
+    data = bytearray(RECORD_SIZE * len(_pending))
+    for i, (timestamp, method_code, url_id, light_value) in enumerate(_pending):
+        struct.pack_into(
+            RECORD_FORMAT, data, i * RECORD_SIZE, timestamp, method_code, url_id, light_value
+        )
+    _pending.clear()
     try:
-        with open("logs.db", "a") as f:
-            f.write(json.dumps(entry) + "\n")
+        if _new_urls:
+            # The URL table must be on flash before any record refers to it
+            with open(URL_FILE, "a") as f:
+                f.write("\n".join(_new_urls) + "\n")
+            _new_urls.clear()
+        _rotate_if_full(len(data))
+        with open(LOG_FILE, "ab") as f:
+            f.write(data)
     except Exception as e:
         print("Logging failed:", e)
+
+
+async def flush_periodically(interval_s: float = FLUSH_INTERVAL_S) -> None:
+    """Background task that flushes queued entries on a timer."""
+    while True:
+        await asyncio.sleep(interval_s)
+        flush()
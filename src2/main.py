@@ -1,13 +1,29 @@
 # AI DISCLAIMER: GPT-5 was used to write documentation, all code was written by people 
 
 # main.py for Raspberry Pi Pico W
+# Imports shared firmware modules from src/ (see the imports below): copy them
+# to the Pico alongside this file.
 
 import machine
 import time
 import network
-import json
 import asyncio
 import math
+import ure
+
+import beacon
+import deviceinfo
+import devlog
+import gcpolicy
+import metrics
+import notecast
+import pitchmap
+import score
+import sensor
+import tone
+import voice
+import webserver
+from logging import log_request, flush, flush_periodically
 # --- RGB LED Pin Configuration ---
 # Common cathode RGB LED: GP2=Red, GP3=Green, GP4=Blue (each via 100 ohm resistor)
 red_pwm = machine.PWM(machine.Pin(2))
@@ -45,11 +61,19 @@ photo_sensor_pin = machine.ADC(26)
 # PWM allows us to create a square wave at a specific frequency to make a sound.
 buzzer_pin = machine.PWM(machine.Pin(10))
 buzzer_pin2 = machine.PWM(machine.Pin(13))
+# Both buzzers are driven through this, which skips writes that change nothing
+buzzers = tone.ToneOutput((buzzer_pin, buzzer_pin2))
+
+# Scale the ambient light sound is snapped to: "continuous", "chromatic",
+# "major" or "pentatonic" (see pitchmap.py)
+AMBIENT_SCALE = "chromatic"
 
 # --- Global State ---
-# This variable will hold the task that plays a note from an API call.
-# This allows us to cancel it if a /stop request comes in.
-api_note_task = None
+# One voice per buzzer plays everything that buzzer does: API notes take
+# priority, and the ambient light sound fills the gaps between them.
+voices = (voice.Voice(buzzers, 0), voice.Voice(buzzers, 1))
+# Gives each API note its own buzzer, so the device can play two at once
+allocator = voice.VoiceAllocator(voices)
 
 # --- Core Functions ---
 def connect_to_wifi(wifi_config: str = "wifi_config.json"):
@@ -69,38 +93,13 @@ def connect_to_wifi(wifi_config: str = "wifi_config.json"):
 
 
 def play_tone(frequency: int, duration_ms: int) -> None:
-    """Plays a tone on the buzzer for a given duration."""
-    if frequency > 0:
-        buzzer_pin.freq(int(frequency))
-        buzzer_pin2.freq(int(frequency))
-        buzzer_pin.duty_u16(32768)  # 50% duty cycle
-        buzzer_pin2.duty_u16(32768)  # 50% duty cycle
-        time.sleep_ms(duration_ms)  # type: ignore[attr-defined]
-        stop_tone()
-    else:
-        time.sleep_ms(duration_ms)  # type: ignore[attr-defined]
+    """Plays a tone on a free buzzer for a given duration, without waiting for it."""
+    allocator.play_note(frequency, duration_ms)
 
 
 def stop_tone():
     """Stops any sound from playing."""
-    buzzer_pin.duty_u16(0)  # 0% duty cycle means silence
-    buzzer_pin2.duty_u16(0)  # 0% duty cycle means silence
-
-
-async def play_api_note(frequency, duration_s):
-    """Coroutine to play a note from an API call, can be cancelled."""
-    try:
-        print(f"API playing note: {frequency}Hz for {duration_s}s")
-        buzzer_pin.freq(int(frequency))
-        buzzer_pin2.freq(int(frequency))
-        buzzer_pin.duty_u16(32768)  # 50% duty cycle
-        buzzer_pin2.duty_u16(32768)  # 50% duty cycle
-        await asyncio.sleep(duration_s)
-        stop_tone()
-        print("API note finished.")
-    except asyncio.CancelledError:
-        stop_tone()
-        print("API note cancelled.")
+    buzzers.off()
 
 
 def map_value(x, in_min, in_max, out_min, out_max):
@@ -108,143 +107,295 @@ def map_value(x, in_min, in_max, out_min, out_max):
     return (x - in_min) * (out_max - out_min) // (in_max - in_min) + out_min
 
 
-async def handle_request(reader, writer):
-    """Handles incoming HTTP requests."""
-    global api_note_task
-
-    print("Client connected")
-    request_line = await reader.readline()
-    # Skip headers
-    while await reader.readline() != b"\r\n":
-        pass
-
-    try:
-        request = str(request_line, "utf-8")
-        method, url, _ = request.split()
-        print(f"Request: {method} {url}")
-    except (ValueError, IndexError):
-        writer.write(b"HTTP/1.0 400 Bad Request\r\n\r\n")
-        await writer.drain()
-        writer.close()
-        await writer.wait_closed()
-        return
-
-    # Read current sensor value
-    light_value = photo_sensor_pin.read_u16()
-
-    response = ""
-    content_type = "text/html"
-
-    # --- API Endpoint Routing ---
-    if method == "GET" and url.startswith("/set_color"):
-        # Parse color from query string
-        import ure
-        match = ure.search(r"color=([a-zA-Z]+)", url)
-        color = match.group(1).lower() if match else ""
-        if color == "red":
-            set_rgb(255, 0, 0)
-        elif color == "green":
-            set_rgb(0, 0, 255)
-        elif color == "blue":
-            set_rgb(0, 255, 0)
-        else:
-            set_rgb(0, 0, 0)
-        response = f'{{"status": "ok", "color": "{color}"}}'
-        content_type = "application/json"
-    elif method == "GET" and url == "/":
-        html = f"""
+# --- HTTP Endpoints ---
+# Everything that doesn't change between requests is encoded once, here. The
+# bodies with a number in them are templates, filled in place per request.
+INDEX_HEAD = b"""
         <html>
             <body>
                 <h1>Pico Light Orchestra</h1>
-                <p>Current light sensor reading: {light_value}</p>
+                <p>Current light sensor reading: """
+INDEX_TAIL = b"""</p>
                 <button onclick=\"fetch('/set_color?color=red')\">Red</button>
                 <button onclick=\"fetch('/set_color?color=green')\">Green</button>
                 <button onclick=\"fetch('/set_color?color=blue')\">Blue</button>
             </body>
         </html>
         """
-        response = html
-    elif method == "POST" and url == "/play_note":
-        # This requires reading the request body, which is not trivial.
-        # A simple approach for a known content length:
-        # Note: A robust server would parse Content-Length header.
-        # For this student project, we'll assume a small, simple JSON body.
-        raw_data = await reader.read(1024)
-        try:
-            data = json.loads(raw_data)
-            freq = data.get("frequency", 0)
-            duration = data.get("duration", 0)
-
-            # If a note is already playing via API, cancel it first
-            if api_note_task:
-                api_note_task.cancel()
-
-            # Start the new note as a background task
-            api_note_task = asyncio.create_task(play_api_note(freq, duration))
-
-            response = '{"status": "ok", "message": "Note playing started."}'
-            content_type = "application/json"
-        except (ValueError, json.JSONDecodeError):
-            writer.write(b'HTTP/1.0 400 Bad Request\r\n\r\n{"error": "Invalid JSON"}\r\n')
-            await writer.drain()
-            writer.close()
-            await writer.wait_closed()
-            return
-
-    elif method == "POST" and url == "/stop":
-        if api_note_task:
-            api_note_task.cancel()
-            api_note_task = None
-        stop_tone()  # Force immediate stop
-        response = '{"status": "ok", "message": "All sounds stopped."}'
-        content_type = "application/json"
+INDEX_BODY = webserver.Template(INDEX_HEAD, INDEX_TAIL)
+TONE_BODY = webserver.Template(b'{"playing": true, "until_ms_from_now": ', b"}")
+PLAY_NOTE_RESPONSE = (
+    webserver.STATUS_200,
+    webserver.APPLICATION_JSON,
+    b'{"status": "ok", "message": "Note playing started."}',
+)
+STOP_RESPONSE = (
+    webserver.STATUS_200,
+    webserver.APPLICATION_JSON,
+    b'{"status": "ok", "message": "All sounds stopped."}',
+)
+HEALTH_RESPONSE = (
+    webserver.STATUS_200,
+    webserver.APPLICATION_JSON,
+    deviceinfo.HEALTH_BODY,
+)
+SCORE_CONTENT_TYPE = score.CONTENT_TYPE.encode()
+# Color name -> (r, g, b) written to the LED
+COLORS = {
+    "red": (255, 0, 0),
+    "green": (0, 0, 255),
+    "blue": (0, 255, 0),
+}
+
+
+def route_set_color(request):
+    """GET /set_color?color=<name>: lights the RGB LED, or turns it off."""
+    # Parse color from query string
+    match = ure.search(r"color=([a-zA-Z]+)", request.query)
+    color = match.group(1).lower() if match else ""
+    set_rgb(*COLORS.get(color, (0, 0, 0)))
+    body = b'{"status": "ok", "color": "' + color.encode() + b'"}'
+    return webserver.STATUS_200, webserver.APPLICATION_JSON, body
+
+
+def route_index(request):
+    """GET /: a small status page with the light reading and color buttons."""
+    INDEX_BODY.set(0, photo_sensor_pin.read_u16())
+    return webserver.STATUS_200, webserver.TEXT_HTML, INDEX_BODY.body
+
+
+def route_health(request):
+    """GET /health: the device's status and identity."""
+    return HEALTH_RESPONSE
+
+
+def route_sensor(request):
+    """GET /sensor: the current light reading."""
+    body = deviceinfo.sensor_body(photo_sensor_pin.read_u16())
+    return webserver.STATUS_200, webserver.APPLICATION_JSON, body
+
+
+def route_status(request):
+    """GET /status: /health and /sensor in one response, for dashboards."""
+    body = deviceinfo.status_body(photo_sensor_pin.read_u16())
+    return webserver.STATUS_200, webserver.APPLICATION_JSON, body
+
+
+def route_sync(request):
+    """GET /sync: clock probe for the conductor (see src/main.py)."""
+    body = b'{"ticks_ms": %d}' % time.ticks_ms()  # type: ignore[attr-defined]
+    return webserver.STATUS_200, webserver.APPLICATION_JSON, body
+
+
+def route_play_note(request):
+    """POST /play_note: plays {"frequency", "duration"} (in seconds) right away.
+
+    The note goes to a free buzzer, or to buzzer "voice" (0 or 1) if given.
+    """
+    # The numbers are read straight out of the body, so nothing is allocated
+    freq = webserver.json_number(request, b'"frequency"', 0)
+    if not tone.playable(freq):
+        return webserver.OUT_OF_RANGE
+    duration_ms = webserver.json_number(request, b'"duration"', 0, 1000)
+    if duration_ms < 0:
+        return webserver.OUT_OF_RANGE
+    index = webserver.json_number(request, b'"voice"')
+    if index is not None and not allocator.has_voice(index):
+        return webserver.OUT_OF_RANGE
+
+    # With both buzzers busy, the note replaces the one that started first
+    allocator.play_note(freq, duration_ms, index=index)
+    return PLAY_NOTE_RESPONSE
+
+
+def route_tone(request):
+    """POST /tone: plays {"freq", "ms", "duty"}, optionally "at" a tick, on a "voice"."""
+    duration_ms = webserver.json_number(request, b'"ms"', 0)
+    duty = webserver.json_number(request, b'"duty"', tone.HALF_DUTY, tone.MAX_DUTY)
+    if duration_ms < 0 or not 0 <= duty <= tone.MAX_DUTY:
+        return webserver.OUT_OF_RANGE
+    start_at = webserver.json_number(request, b'"at"')
+    delay = voice.start_delay(start_at)
+    if delay is None:
+        return webserver.OUT_OF_RANGE
+    freq = webserver.json_number(request, b'"freq"', 0)
+    if not tone.playable(freq):
+        return webserver.OUT_OF_RANGE
+    index = webserver.json_number(request, b'"voice"')
+    if index is not None and not allocator.has_voice(index):
+        return webserver.OUT_OF_RANGE
+    allocator.play_note(freq, duration_ms, duty, start_at, index)
+    TONE_BODY.set(0, delay + duration_ms)
+    return webserver.STATUS_202, webserver.APPLICATION_JSON, TONE_BODY.body
+
+
+def route_chord(request):
+    """POST /chord: plays {"freqs": [f, f2], "ms", "duty"} at once, maybe "at" a tick."""
+    data = request.json()
+    freqs = [int(f) for f in data["freqs"]]
+    for f in freqs:
+        if not tone.playable(f):
+            return webserver.OUT_OF_RANGE
+    duration_ms = _member_number(data, "ms", 0)
+    duty = _member_number(data, "duty", tone.HALF_DUTY, tone.MAX_DUTY)
+    if duration_ms < 0 or not 0 <= duty <= tone.MAX_DUTY:
+        return webserver.OUT_OF_RANGE
+    start_at = _member_number(data, "at")
+    delay = voice.start_delay(start_at)
+    if delay is None:
+        return webserver.OUT_OF_RANGE
+    allocator.play_chord(freqs, duration_ms, duty, start_at)
+    body = b'{"playing": %d, "until_ms_from_now": %d}' % (len(freqs), delay + duration_ms)
+    return webserver.STATUS_202, webserver.APPLICATION_JSON, body
+
+
+def _member_number(data, key, default=None, scale=1):
+    """Reads a number from a decoded JSON object the way json_number() reads a body.
+
+    Returns the member times scale as an int, or default if it is missing or
+    null. Raises ValueError if it isn't a number, before anything is scaled.
+    """
+    value = data.get(key)
+    if value is None:
+        return default
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError("not a number")
+    return int(value * scale)
+
+
+def route_melody(request):
+    """POST /melody[?voice=]: plays a JSON note list or a packed binary score.
+
+    A two-voice score plays one part on each buzzer. A one-voice score goes
+    to a free buzzer, or to the one given by ?voice= or "voice".
+    """
+    # The body lives in the connection's buffer, so the score gets its own copy
+    index = webserver.query_int(request, "voice", None)
+    if request.content_type == SCORE_CONTENT_TYPE:
+        melody = bytes(request.body)
     else:
-        writer.write(b"HTTP/1.0 404 Not Found\r\n\r\n")
-        await writer.drain()
-        writer.close()
-        await writer.wait_closed()
-        return
-
-    # Send response
-    writer.write(
-        f"HTTP/1.0 200 OK\r\nContent-type: {content_type}\r\n\r\n".encode("utf-8")
-    )
-    writer.write(response.encode("utf-8"))
-    await writer.drain()
-    writer.close()
-    await writer.wait_closed()
-    print("Client disconnected")
+        data = request.json()
+        try:
+            melody = score.from_json(data)
+        except ValueError:
+            return webserver.OUT_OF_RANGE
+        if data.get("voice") is not None:
+            index = data["voice"]
+    if index is not None and not allocator.has_voice(index):
+        return webserver.OUT_OF_RANGE
+    count, _, start_at = score.read_header(melody)
+    if voice.start_delay(start_at) is None:
+        return webserver.OUT_OF_RANGE
+    if not score.frequencies_within(melody, tone.MIN_FREQ, tone.MAX_FREQ):
+        return webserver.OUT_OF_RANGE
+    allocator.play_melody(melody, index)
+    return webserver.STATUS_202, webserver.APPLICATION_JSON, b'{"queued": %d}' % count
+
+
+def route_stop(request):
+    """POST /stop: silences both buzzers and cancels any API note."""
+    allocator.stop()
+    return STOP_RESPONSE
+
+
+def route_logs(request):
+    """GET /logs[?level=]: the device's recent log messages, oldest first.
+
+    With ?level= (debug, info, warning or error), only messages at that level
+    or above are kept from then on.
+    """
+    name = webserver.query_param(request, "level")
+    if name is not None:
+        try:
+            devlog.set_level(devlog.level_named(name))
+        except ValueError:
+            return webserver.INVALID_QUERY
+    body = "\n".join(devlog.recent()).encode()
+    return webserver.STATUS_200, webserver.TEXT_PLAIN, body
+
+
+def route_metrics(request):
+    """GET /metrics: the device's counters and gauges, as text (see metrics.py)."""
+    return webserver.STATUS_200, webserver.TEXT_PLAIN, metrics.render()
+
+
+ROUTES = {
+    ("GET", "/set_color"): route_set_color,
+    ("GET", "/"): route_index,
+    ("GET", "/health"): route_health,
+    ("GET", "/sensor"): route_sensor,
+    ("GET", "/status"): route_status,
+    ("GET", "/sync"): route_sync,
+    ("POST", "/play_note"): route_play_note,
+    ("POST", "/tone"): route_tone,
+    ("POST", "/chord"): route_chord,
+    ("POST", "/melody"): route_melody,
+    ("POST", "/stop"): route_stop,
+    ("GET", "/logs"): route_logs,
+    ("GET", "/metrics"): route_metrics,
+}
+metrics.add_routes(ROUTES)
+
+
+def record_request(request):
+    """Queues a logs.db entry for a request that has been answered."""
+    url = request.path
+    if request.query:
+        url += "?" + request.query
+    log_request(request.method, url, photo_sensor_pin.read_u16())
+
+
+async def handle_request(reader, writer):
+    """Handles an HTTP connection, serving requests until the client is done."""
+    devlog.debug("Client connected")
+    await webserver.serve(reader, writer, ROUTES, record_request)
+    devlog.debug("Client disconnected")
+
+
+async def light_to_buzzer():
+    """Sets both voices' ambient pitch from the filtered light level."""
+    pitch_table = pitchmap.build_table(AMBIENT_SCALE)
+    light_filter = sensor.LightFilter(photo_sensor_pin)
+    pitch = sensor.Hysteresis()
+    # Samples faster while the light is changing, slower while it sits still
+    interval = sensor.AdaptiveInterval()
+    while True:
+        light_value = light_filter.read()
+        frequency = pitch_table[light_value >> pitchmap.LUT_SHIFT]
+        if frequency:
+            # The held pitch only moves on a real change, and buzzers skips
+            # the PWM writes entirely while it stays put
+            pitch.update(frequency)
+            frequency = pitch.value
+        for v in voices:
+            v.set_ambient(frequency)  # 0 when it's very dark, to be quiet
+        if not allocator.busy():
+            gcpolicy.idle()  # Nothing is playing that a pause could be heard in
+
+        sleep_ms = interval.update(light_value, time.ticks_ms())
+        metrics.loop_sleeping(sleep_ms)  # To record how late the loop wakes up
+        await asyncio.sleep_ms(sleep_ms)
+        metrics.loop_woke()
 
 
 async def main():
     """Main execution loop."""
+    for v in voices:
+        v.start()
+    gcpolicy.collect()  # Start from a clean heap, and time a first collection
     # Try to connect to WiFi and start web server if successful
     try:
         ip = connect_to_wifi()
         print(f"Web server running at http://{ip}/")
         server = await asyncio.start_server(handle_request, "0.0.0.0", 80)
         print("Web server started. Waiting for connections...")
-        # Start a background task for buzzer/light logic
-        async def light_to_buzzer():
-            min_light = 1000
-            max_light = 65000
-            min_freq = 261  # C4
-            max_freq = 1046  # C6
-            while True:
-                light_value = photo_sensor_pin.read_u16()
-                clamped_light = max(min_light, min(light_value, max_light))
-                if clamped_light > min_light:
-                    frequency = map_value(
-                        clamped_light, min_light, max_light, min_freq, max_freq
-                    )
-                    buzzer_pin.freq(frequency)
-                    buzzer_pin2.freq(frequency)
-                    buzzer_pin.duty_u16(32768)
-                    buzzer_pin2.duty_u16(32768)
-                else:
-                    stop_tone()
-                await asyncio.sleep_ms(50)
-        # Start the background task
+        # Let conductors and dashboards find this device without its IP
+        asyncio.create_task(beacon.run(deviceinfo.beacon_body(80)))
+        # Notes the conductor broadcasts over UDP instead of sending over HTTP
+        asyncio.create_task(notecast.run(allocator.play_melody))
+        # Request log entries are batched in RAM and written out on a timer
+        asyncio.create_task(flush_periodically())
+        # Start the background task for buzzer/light logic
         asyncio.create_task(light_to_buzzer())
         while True:
             await asyncio.sleep(1)  # Keeps the event loop running
@@ -254,24 +405,7 @@ async def main():
         print("Use light sensor to control musical tones!")
         print("RGB LED will smoothly transition through the color spectrum.")
         rgb_task = asyncio.create_task(rgb_one_at_a_time())
-        while True:
-            light_value = photo_sensor_pin.read_u16()
-            min_light = 1000
-            max_light = 65000
-            min_freq = 261  # C4
-            max_freq = 1046  # C6
-            clamped_light = max(min_light, min(light_value, max_light))
-            if clamped_light > min_light:
-                frequency = map_value(
-                    clamped_light, min_light, max_light, min_freq, max_freq
-                )
-                buzzer_pin.freq(frequency)
-                buzzer_pin2.freq(frequency)
-                buzzer_pin.duty_u16(32768)
-                buzzer_pin2.duty_u16(32768)
-            else:
-                stop_tone()
-            await asyncio.sleep_ms(50)
+        await light_to_buzzer()
 
 
 # Run the main event loop
@@ -281,3 +415,5 @@ if __name__ == "__main__":
     except KeyboardInterrupt:
         print("Program stopped.")
         stop_tone()
+    finally:
+        flush()  # Don't lose log entries still waiting in RAM
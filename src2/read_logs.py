@@ -0,0 +1,129 @@
+# read_logs.py
+# To be run on a computer (not the Pico), on logs pulled off the devices.
+#
+# Reads the fixed-width binary logs.db records written by logging.py. The file
+# is memory-mapped and only the records inside the requested time range are
+# decoded: a sparse index holding every INDEX_STRIDE-th timestamp narrows the
+# range down by binary search first. Records are appended in time order, so
+# the timestamps in a file never go backwards.
+#
+# Usage: python read_logs.py [--since T] [--until T] [--urls logs.urls] logs.db.1 logs.db
+
+import argparse
+import mmap
+import struct
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+
+# Must match logging.py
+RECORD_FORMAT = "<IBBH"
+RECORD_SIZE = 8
+METHODS = ("GET", "POST", "PUT", "DELETE", "HEAD", "OPTIONS", "PATCH")
+
+INDEX_STRIDE = 256  # Records between two sparse index entries
+
+LogEntry = namedtuple("LogEntry", ["timestamp", "method", "url", "light_value"])
+
+
+def load_urls(path="logs.urls"):
+    """Reads the URL table, where line n holds the URL with id n."""
+    try:
+        with open(path, "r") as f:
+            return [line.rstrip("\n") for line in f]
+    except FileNotFoundError:
+        return []
+
+
+class LogFile:
+    """A memory-mapped logs.db file that can be searched by time."""
+
+    def __init__(self, path, urls=()):
+        self.urls = list(urls)
+        self._file = open(path, "rb")
+        self.count = 0
+        self._map = None
+        self._index = []
+        size = self._file.seek(0, 2)
+        if size >= RECORD_SIZE:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            # Ignore a partly written record at the end, if a write was cut short
+            self.count = size // RECORD_SIZE
+            self._index = [
+                self._timestamp(i) for i in range(0, self.count, INDEX_STRIDE)
+            ]
+
+    def close(self):
+        """Unmaps and closes the file."""
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _timestamp(self, i):
+        """Returns the timestamp of record i without decoding the rest of it."""
+        return struct.unpack_from("<I", self._map, i * RECORD_SIZE)[0]
+
+    def _first_at_or_after(self, timestamp):
+        """Returns the index of the first record with a timestamp >= timestamp."""
+        # The block before the first index entry >= timestamp holds the boundary
+        i = max(0, bisect_left(self._index, timestamp) - 1) * INDEX_STRIDE
+        while i < self.count and self._timestamp(i) < timestamp:
+            i += 1
+        return i
+
+    def _first_after(self, timestamp):
+        """Returns the index of the first record with a timestamp > timestamp."""
+        i = max(0, bisect_right(self._index, timestamp) - 1) * INDEX_STRIDE
+        while i < self.count and self._timestamp(i) <= timestamp:
+            i += 1
+        return i
+
+    def _decode(self, method_code, url_id):
+        """Turns the stored codes back into a method name and URL."""
+        method = METHODS[method_code] if method_code < len(METHODS) else "OTHER"
+        url = self.urls[url_id] if url_id < len(self.urls) else f"<url {url_id}>"
+        return method, url
+
+    def entries(self, since=None, until=None):
+        """Yields the LogEntry records with since <= timestamp <= until."""
+        if self.count == 0:
+            return
+        start = 0 if since is None else self._first_at_or_after(since)
+        stop = self.count if until is None else self._first_after(until)
+        if start >= stop:
+            return
+        view = memoryview(self._map)[start * RECORD_SIZE : stop * RECORD_SIZE]
+        try:
+            for timestamp, method_code, url_id, light_value in struct.iter_unpack(
+                RECORD_FORMAT, view
+            ):
+                method, url = self._decode(method_code, url_id)
+                yield LogEntry(timestamp, method, url, light_value)
+        finally:
+            view.release()
+
+
+def read_logs(paths, since=None, until=None, urls_path="logs.urls"):
+    """Yields the entries in a time range from several log files, oldest file first."""
+    urls = load_urls(urls_path)
+    for path in paths:
+        with LogFile(path, urls) as log:
+            yield from log.entries(since, until)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Print request logs pulled off a Pico.")
+    parser.add_argument("paths", nargs="+", help="log files, oldest first")
+    parser.add_argument("--since", type=int, help="first timestamp to show")
+    parser.add_argument("--until", type=int, help="last timestamp to show")
+    parser.add_argument("--urls", default="logs.urls", help="the URL table file")
+    args = parser.parse_args()
+
+    for entry in read_logs(args.paths, args.since, args.until, args.urls):
+        print(f"{entry.timestamp} {entry.method:<7} {entry.url:<30} {entry.light_value}")
@@ -0,0 +1,337 @@
+"""
+benchmark.py
+------------
+
+HTTP throughput and latency benchmark for the firmware's request handler.
+
+The firmware runs unmodified in the simulator (see picosim/), in a separate
+process serving on a local port. Concurrent clients then hammer one endpoint
+at a time, each with its own keep-alive connection, and the benchmark
+reports requests/s and p50/p95/p99 latency per endpoint. Meanwhile the
+device times every sleep of its ambient light loop, so the report also
+shows how late that loop wakes up under load, next to how late it wakes
+when idle.
+
+Results can be saved as JSON and compared with an earlier run, e.g. one
+taken before a firmware change. Run it from the repository root:
+
+    python testing/benchmark.py --json before.json
+    python testing/benchmark.py --json after.json --compare before.json
+
+The simulator runs on a computer, so absolute numbers are far higher than
+a Pico's; compare runs taken on the same machine.
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+TESTING_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(TESTING_DIR)
+
+# (method, path, JSON body) for every endpoint benchmarked
+ENDPOINTS = [
+    ("GET", "/", None),
+    ("POST", "/play_note", {"frequency": 440, "duration": 0.05}),
+    ("POST", "/stop", None),
+    ("GET", "/sensor", None),
+]
+
+# Coroutines running the ambient light loop: src/main.py's main() and
+# src2/main.py's light_to_buzzer()
+AMBIENT_LOOPS = ("main", "light_to_buzzer")
+
+REQUEST_TIMEOUT = 5.0
+STARTUP_TIMEOUT = 10.0
+
+
+# --- The device, in its own process ---
+
+
+def serve_device(firmware, port, workdir, pipe):
+    """Runs the firmware in the simulator, timing its ambient loop's sleeps.
+
+    Answers "reset" (forget the lag samples so far) and "report" (send them)
+    on pipe, from a thread, while the device runs on the main one.
+    """
+    sys.path.insert(0, TESTING_DIR)
+    import picosim
+
+    sys.stdout = open(os.devnull, "w")  # The firmware's own messages
+    main = picosim.boot(firmware, http_port=port, workdir=workdir)
+
+    lags = []
+    sleep_ms = asyncio.sleep_ms
+
+    async def timed_sleep_ms(ms):
+        task = asyncio.current_task()
+        if task is None or task.get_coro().__name__ not in AMBIENT_LOOPS:
+            return await sleep_ms(ms)
+        start = time.perf_counter()
+        await sleep_ms(ms)
+        lags.append((time.perf_counter() - start) * 1000 - ms)
+
+    asyncio.sleep_ms = timed_sleep_ms
+
+    def answer():
+        while True:
+            command = pipe.recv()
+            if command == "reset":
+                lags.clear()
+            elif command == "report":
+                pipe.send(list(lags))
+
+    threading.Thread(target=answer, daemon=True).start()
+    asyncio.run(main.main())
+
+
+class Device:
+    """A simulated device in a child process, and the way to ask it for its lag."""
+
+    def __init__(self, firmware, port):
+        self.url = "http://127.0.0.1:%d" % port
+        self.pipe, child_pipe = multiprocessing.Pipe()
+        workdir = tempfile.mkdtemp(prefix="benchmark-")
+        self.process = multiprocessing.Process(
+            target=serve_device, args=(firmware, port, workdir, child_pipe), daemon=True
+        )
+
+    def start(self):
+        self.process.start()
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while time.monotonic() < deadline:
+            try:
+                requests.get(self.url + "/health", timeout=1)
+                return
+            except requests.ConnectionError:
+                time.sleep(0.1)
+        raise RuntimeError("The device didn't start")
+
+    def reset_lag(self):
+        self.pipe.send("reset")
+
+    def loop_lag(self):
+        self.pipe.send("report")
+        return self.pipe.recv()
+
+    def stop(self):
+        self.process.terminate()
+        self.process.join()
+
+
+# --- Measuring ---
+
+
+def percentile(sorted_values, p):
+    """The nearest-rank p-th percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * p // 100))  # Rounded up
+    return sorted_values[int(rank) - 1]
+
+
+def summarize(values_ms):
+    values = sorted(values_ms)
+    return {
+        "samples": len(values),
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": values[-1] if values else None,
+    }
+
+
+def client(url, method, body, deadline):
+    """Sends requests one after another until deadline.
+
+    Returns (latencies in ms, error count).
+    """
+    latencies = []
+    errors = 0
+    with requests.Session() as session:
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                response = session.request(
+                    method, url, json=body, timeout=REQUEST_TIMEOUT
+                )
+                ok = response.status_code == 200
+            except requests.RequestException:
+                ok = False
+            if ok:
+                latencies.append((time.perf_counter() - start) * 1000)
+            else:
+                errors += 1
+    return latencies, errors
+
+
+def bench_endpoint(device, method, path, body, clients, duration):
+    """Runs clients against one endpoint for duration seconds."""
+    device.reset_lag()
+    start = time.perf_counter()
+    deadline = start + duration
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        futures = [
+            executor.submit(client, device.url + path, method, body, deadline)
+            for _ in range(clients)
+        ]
+        results = [f.result() for f in futures]
+    elapsed = time.perf_counter() - start
+
+    latencies = [ms for latencies, _ in results for ms in latencies]
+    return {
+        "requests": len(latencies),
+        "errors": sum(errors for _, errors in results),
+        "rps": len(latencies) / elapsed,
+        "latency_ms": summarize(latencies),
+        "loop_lag_ms": summarize(device.loop_lag()),
+    }
+
+
+def revision():
+    """The commit the firmware was benchmarked at, marked if it had local changes."""
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=REPO_ROOT, capture_output=True, text=True, check=True,
+        ).stdout.strip()  # fmt: skip
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(firmware, port, clients, duration):
+    device = Device(firmware, port)
+    device.start()
+    try:
+        # How late the ambient loop wakes with nothing else going on
+        device.reset_lag()
+        time.sleep(duration)
+        idle_lag = summarize(device.loop_lag())
+
+        endpoints = {}
+        for method, path, body in ENDPOINTS:
+            endpoints[method + " " + path] = bench_endpoint(
+                device, method, path, body, clients, duration
+            )
+    finally:
+        device.stop()
+
+    return {
+        "firmware": os.path.relpath(firmware, REPO_ROOT),
+        "revision": revision(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "clients": clients,
+        "duration_s": duration,
+        "idle_loop_lag_ms": idle_lag,
+        "endpoints": endpoints,
+    }
+
+
+# --- Reporting ---
+
+
+def format_ms(value):
+    return "-" if value is None else "%.2f" % value
+
+
+def print_report(results, baseline=None):
+    print(
+        "%s at %s, %d clients, %gs per endpoint"
+        % (
+            results["firmware"],
+            results["revision"],
+            results["clients"],
+            results["duration_s"],
+        )
+    )
+    idle = results["idle_loop_lag_ms"]
+    print(
+        "Ambient loop lag when idle: p50 %s, p99 %s ms"
+        % (format_ms(idle["p50"]), format_ms(idle["p99"]))
+    )
+    print()
+    columns = ("Endpoint", "req/s", "errors", "p50 ms", "p95 ms", "p99 ms")
+    print("%-16s %9s %7s %8s %8s %8s %12s %12s" % (columns + ("lag p50 ms", "lag p99 ms")))
+    for name, result in results["endpoints"].items():
+        latency = result["latency_ms"]
+        lag = result["loop_lag_ms"]
+        print(
+            "%-16s %9.1f %7d %8s %8s %8s %12s %12s"
+            % (
+                name,
+                result["rps"],
+                result["errors"],
+                format_ms(latency["p50"]),
+                format_ms(latency["p95"]),
+                format_ms(latency["p99"]),
+                format_ms(lag["p50"]),
+                format_ms(lag["p99"]),
+            )
+        )
+        old = baseline["endpoints"].get(name) if baseline else None
+        if old:
+            print(
+                "%-16s %+8.1f%% %7s %8s %8s %+7.1f%%"
+                % (
+                    "  vs baseline",
+                    change(old["rps"], result["rps"]),
+                    "",
+                    "",
+                    "",
+                    change(old["latency_ms"]["p99"], latency["p99"]),
+                )
+            )
+
+
+def change(old, new):
+    """Percent change from old to new."""
+    if not old or new is None:
+        return 0.0
+    return (new - old) / old * 100
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the firmware's HTTP server.")
+    parser.add_argument(
+        "--firmware",
+        default=os.path.join(REPO_ROOT, "src", "main.py"),
+        help="firmware to run (default: src/main.py)",
+    )
+    parser.add_argument(
+        "--port", type=int, default=8095, help="port the device serves on"
+    )
+    parser.add_argument("--clients", type=int, default=8, help="concurrent clients")
+    parser.add_argument(
+        "--duration", type=float, default=5.0, help="seconds spent on each endpoint"
+    )
+    parser.add_argument("--json", help="file to save the results to")
+    parser.add_argument("--compare", help="results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    results = run_benchmark(
+        os.path.abspath(args.firmware), args.port, args.clients, args.duration
+    )
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(results, baseline)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
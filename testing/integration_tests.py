@@ -1,4 +1,4 @@
-# AI DISCLAIMER: GPT-5 was used to write documentation, all code was written by people 
+# AI DISCLAIMER: GPT-5 was used to write documentation, all code was written by people
 
 """
 integration_test.py
@@ -6,8 +6,9 @@ integration_test.py
 
 Asynchronous integration test suite for the Pico project.
 
-This script launches the web server from `server.py` and interacts with
-its endpoints over HTTP to verify end-to-end functionality. It simulates
+This script boots `src2/main.py` in the simulator (see picosim/) as a
+separate process, serving on a local port, and interacts with its
+endpoints over HTTP to verify end-to-end functionality. It simulates
 real client behavior using GET and POST requests, then checks both the
 HTTP responses and the persistence of log data.
 
@@ -15,57 +16,83 @@ Tests include:
 - GET `/` to confirm the server is running and returning a valid page.
 - GET `/set_color` to verify color-setting functionality.
 - POST `/play_note` to confirm note playback handling.
-- Validation that `logs.db` is updated with request entries.
-"""
+- Validation that `logs.db` is updated with request entries once the
+  device is stopped.
 
-import uasyncio as asyncio
-import ujson as json
-import os
-import time
+Run it from the repository root:
 
-try:
-    import urequests as requests  # MicroPython
-except ImportError:
-    import requests  # CPython for local testing
+    python testing/integration_tests.py
+"""
 
-# Start the server as a background task
-import server  # your main file with start_server()
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import tempfile
 
-async def run_server():
-    await server.start_server()
+import requests
 
-async def integration_test():
-    # Give server time to start
-    await asyncio.sleep(1)
+TESTING_DIR = os.path.dirname(os.path.abspath(__file__))
+FIRMWARE = os.path.join(os.path.dirname(TESTING_DIR), "src2", "main.py")
+PORT = int(os.environ.get("PICOSIM_PORT", "8090"))
+BASE_URL = f"http://127.0.0.1:{PORT}"
 
-    # Clear logs if they exist
-    try:
-        os.remove("logs.db")
-    except OSError:
-        pass
 
-    # Test 1: GET /
-    r = requests.get("http://192.168.4.1:80/")
-    assert r.status_code == 200, f"Expected 200, got {r.status_code}"
-    assert "Hello" in r.text or "Color" in r.text, "Unexpected response body"
+def start_device(workdir):
+    """Starts a simulated device serving on PORT, in its own process.
 
-    # Test 2: GET /set_color
-    r = requests.get("http://192.168.4.1:80/set_color?color=red")
-    assert r.status_code == 200, f"Expected 200, got {r.status_code}"
-    assert "LED" in r.text or "color" in r.text, "Unexpected response body"
+    Its console output goes to console.log in workdir.
+    """
+    env = dict(os.environ, PYTHONPATH=TESTING_DIR)
+    command = [
+        sys.executable, "-m", "picosim", FIRMWARE,
+        "--base-port", str(PORT), "--host", "127.0.0.1", "--workdir", workdir,
+    ]  # fmt: skip
+    console = open(os.path.join(workdir, "console.log"), "w")
+    return subprocess.Popen(command, env=env, stdout=console, stderr=subprocess.STDOUT)
 
-    # Test 3: POST /play_note
-    r = requests.post("http://192.168.4.1:80/play_note", data="C")
-    assert r.status_code == 200, f"Expected 200, got {r.status_code}"
 
-    # Wait for logs to flush
-    await asyncio.sleep(1)
+async def wait_until_up(timeout_s=10):
+    for _ in range(timeout_s * 10):
+        try:
+            requests.get(f"{BASE_URL}/health", timeout=1)
+            return
+        except requests.ConnectionError:
+            await asyncio.sleep(0.1)
+    raise AssertionError("Device didn't start")
 
-    # Check logs.db contains at least 3 entries
-    with open("logs.db") as f:
-        logs = [json.loads(line) for line in f]
-    assert len(logs) >= 3, f"Expected >=3 logs, got {len(logs)}"
 
-    print("Integration test passed)
+async def integration_test():
+    workdir = tempfile.mkdtemp(prefix="integration-tests-")
+    device = start_device(workdir)
+    try:
+        # Give server time to start
+        await wait_until_up()
+
+        # Test 1: GET /
+        r = requests.get(f"{BASE_URL}/")
+        assert r.status_code == 200, f"Expected 200, got {r.status_code}"
+        assert "Light Orchestra" in r.text, "Unexpected response body"
+
+        # Test 2: GET /set_color
+        r = requests.get(f"{BASE_URL}/set_color?color=red")
+        assert r.status_code == 200, f"Expected 200, got {r.status_code}"
+        assert "LED" in r.text or "color" in r.text, "Unexpected response body"
+
+        # Test 3: POST /play_note
+        r = requests.post(f"{BASE_URL}/play_note", json={"frequency": 440, "duration": 0.1})
+        assert r.status_code == 200, f"Expected 200, got {r.status_code}"
+    finally:
+        # Log entries still waiting in RAM are written out when it stops
+        device.send_signal(signal.SIGINT)
+        device.wait(timeout=10)
+
+    # Check logs.db contains at least 3 entries (fixed-width 8-byte records)
+    with open(os.path.join(workdir, "logs.db"), "rb") as f:
+        count = len(f.read()) // 8
+    assert count >= 3, f"Expected >=3 logs, got {count}"
+
+    print("Integration test passed")
 
 asyncio.run(integration_test())
@@ -0,0 +1,257 @@
+"""
+picosim
+-------
+
+CPython simulator that runs the Pico firmware (`src/main.py` or
+`src2/main.py`) unmodified, so one computer can host dozens of virtual
+devices for load and integration testing.
+
+`install()` puts fakes of the MicroPython-only modules in place: `machine`
+(scriptable ADC, recorded PWM writes, see machine.py), `network`, the
+`u`-prefixed aliases (`uasyncio`, `ujson`, `ure`, ...) and the extra
+functions MicroPython adds to `time`, `asyncio` and `gc`. It also wraps `socket`
+and `asyncio.start_server` so the ports the firmware asks for can be mapped
+to others, letting many devices share one machine.
+
+`boot()` loads a firmware file as the module `main` without starting it,
+for tests that want to call its functions. `run()` boots a device the way
+the Pico does, running the firmware's `__main__` block. To start devices
+from the command line, see __main__.py.
+"""
+
+import asyncio
+import binascii
+import gc
+import json
+import os
+import re
+import runpy
+import select
+import socket as _socket
+import struct
+import sys
+import time
+import types
+import importlib.util
+
+from . import machine, network, signals
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+SHARED_DIR = os.path.join(REPO_ROOT, "src")  # Modules every firmware imports
+
+HTTP_PORT = 80
+TICKS_PERIOD = 2**30
+HEAP_SIZE = 1 << 20  # What gc.mem_free() and gc.mem_alloc() add up to
+
+# Port the firmware asks for -> port it actually gets, for this device
+ports: dict[int, int] = {}
+# Address the firmware's web server really listens on, whatever it asks for
+listen_host = "127.0.0.1"
+
+_installed = False
+
+
+# --- MicroPython additions to time ---
+
+
+def ticks_ms():
+    return int(time.monotonic() * 1000) % TICKS_PERIOD
+
+
+def ticks_us():
+    return int(time.monotonic() * 1000000) % TICKS_PERIOD
+
+
+def ticks_diff(a, b):
+    return (a - b + TICKS_PERIOD // 2) % TICKS_PERIOD - TICKS_PERIOD // 2
+
+
+def ticks_add(ticks, delta):
+    return (ticks + delta) % TICKS_PERIOD
+
+
+def sleep_ms(ms):
+    time.sleep(max(0, ms) / 1000)
+
+
+def sleep_us(us):
+    time.sleep(max(0, us) / 1000000)
+
+
+# --- MicroPython additions to asyncio ---
+
+
+def _asyncio_sleep_ms(ms):
+    return asyncio.sleep(max(0, ms) / 1000)
+
+
+async def _readinto(self, buf):
+    """StreamReader.readinto(), which CPython's StreamReader lacks."""
+    data = await self.read(len(buf))
+    buf[: len(data)] = data
+    return len(data)
+
+
+_real_start_server = asyncio.start_server
+
+
+async def _start_server(callback, host, port, *args, **kwargs):
+    """asyncio.start_server(), listening where the simulator says instead."""
+    return await _real_start_server(
+        callback, listen_host, ports.get(port, port), *args, **kwargs
+    )
+
+
+# --- MicroPython additions to gc ---
+# CPython has no heap of its own to report, so its count of allocated memory
+# blocks stands in for the bytes allocated. As on MicroPython, the figure only
+# goes down when the garbage collector runs.
+
+_allocated = 0
+
+
+def mem_alloc():
+    global _allocated
+    _allocated = min(max(_allocated, sys.getallocatedblocks()), HEAP_SIZE)
+    return _allocated
+
+
+def mem_free():
+    return HEAP_SIZE - mem_alloc()
+
+
+def _collected(phase, info):
+    global _allocated
+    if phase == "stop":
+        _allocated = min(sys.getallocatedblocks(), HEAP_SIZE)
+
+
+# --- socket ---
+
+
+class SimSocket(_socket.socket):
+    """A socket whose bind() goes through the simulator's port map.
+
+    Datagram sockets may share their port, so every simulated device can
+    listen for discovery queries and broadcast notes on the standard ports.
+    """
+
+    def bind(self, address):
+        host, port = address
+        if self.type == _socket.SOCK_DGRAM:
+            self.setsockopt(_socket.SOL_SOCKET, _socket.SO_REUSEADDR, 1)
+            if hasattr(_socket, "SO_REUSEPORT"):
+                self.setsockopt(_socket.SOL_SOCKET, _socket.SO_REUSEPORT, 1)
+        super().bind((host, ports.get(port, port)))
+
+
+def _socket_module():
+    module = types.ModuleType("socket")
+    module.__dict__.update(_socket.__dict__)
+    module.socket = SimSocket
+    return module
+
+
+def install():
+    """Puts the fake MicroPython modules in place; safe to call more than once."""
+    global _installed
+    if _installed:
+        return
+    _installed = True
+
+    time.ticks_ms = ticks_ms
+    time.ticks_us = ticks_us
+    time.ticks_cpu = ticks_us
+    time.ticks_diff = ticks_diff
+    time.ticks_add = ticks_add
+    time.sleep_ms = sleep_ms
+    time.sleep_us = sleep_us
+
+    gc.mem_alloc = mem_alloc
+    gc.mem_free = mem_free
+    gc.callbacks.append(_collected)
+
+    asyncio.sleep_ms = _asyncio_sleep_ms
+    asyncio.StreamReader.readinto = _readinto
+    asyncio.start_server = _start_server
+
+    sim_socket = _socket_module()
+    sys.modules.update(
+        {
+            "machine": machine,
+            "network": network,
+            "socket": sim_socket,
+            "usocket": sim_socket,
+            "uasyncio": asyncio,
+            "ujson": json,
+            "ure": re,
+            "uos": os,
+            "ustruct": struct,
+            "utime": time,
+            "uselect": select,
+            "ubinascii": binascii,
+        }
+    )
+
+
+def _prepare(firmware, http_port, workdir, uid, adc, host):
+    """Sets up everything a device needs before its firmware is imported."""
+    global listen_host
+    install()
+    firmware = os.path.abspath(firmware)
+    listen_host = host
+    if http_port is not None:
+        ports[HTTP_PORT] = http_port
+    network.address = "127.0.0.1" if host == "0.0.0.0" else host
+    if uid is not None:
+        machine.device_uid = uid
+    if adc is not None:
+        machine.adc_source = adc
+
+    if workdir is not None:
+        os.makedirs(workdir, exist_ok=True)
+        os.chdir(workdir)
+    if not os.path.exists("wifi_config.json"):
+        with open("wifi_config.json", "w") as f:
+            json.dump({"ssid": "picosim", "password": "picosim"}, f)
+
+    firmware_dir = os.path.dirname(firmware)
+    for path in (SHARED_DIR, firmware_dir):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+    if os.path.exists(os.path.join(firmware_dir, "logging.py")):
+        # src2 has its own logging module. The standard one, already loaded by
+        # asyncio, must make way for it.
+        sys.modules.pop("logging", None)
+
+    # The beacon advertises the port the firmware thinks it serves on, which
+    # has to be the one it really serves on
+    import deviceinfo
+
+    beacon_body = deviceinfo.beacon_body
+    deviceinfo.beacon_body = lambda port=HTTP_PORT: beacon_body(ports.get(port, port))
+    return firmware
+
+
+def boot(firmware, http_port=None, workdir=None, uid=None, adc=None, host="127.0.0.1"):
+    """Loads a firmware file as the module `main` and returns it, without starting it.
+
+    http_port is where the web server really listens (the firmware asks for
+    80), workdir the directory it runs in, uid its machine.unique_id() and
+    adc its light source (see signals.py).
+    """
+    firmware = _prepare(firmware, http_port, workdir, uid, adc, host)
+    spec = importlib.util.spec_from_file_location("main", firmware)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["main"] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def run(firmware, http_port=None, workdir=None, uid=None, adc=None, host="127.0.0.1"):
+    """Runs a firmware file as the Pico does at power-on, until it exits."""
+    firmware = _prepare(firmware, http_port, workdir, uid, adc, host)
+    runpy.run_path(firmware, run_name="__main__")
+
+
+__all__ = ["boot", "install", "machine", "network", "ports", "run", "signals"]
@@ -0,0 +1,116 @@
+"""
+Starts simulated devices from the command line:
+
+    PYTHONPATH=testing python -m picosim src/main.py --count 20 --base-port 8000
+
+Each device serves HTTP on its own port (8000, 8001, ...) and runs in its own
+process and working directory, with its own device ID. They all share the
+discovery and note broadcast ports, so fleet.py and the conductor find them
+the same way they find real devices. Ctrl+C stops every device.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+import picosim
+from picosim import machine, signals
+
+PACKAGE_PARENT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def device_uid(index):
+    """A machine.unique_id() for each simulated device, distinct from real ones."""
+    return b"\x5e\x51" + index.to_bytes(4, "big")
+
+
+def run_device(args, index, port, workdir):
+    """Runs one device in this process, until it exits."""
+    if args.pwm_log:
+        os.makedirs(args.pwm_log, exist_ok=True)
+        path = os.path.join(args.pwm_log, "device-%d.csv" % port)
+        machine.pwm_log_file = open(path, "w", buffering=1)
+    try:
+        picosim.run(
+            args.firmware,
+            http_port=port,
+            workdir=workdir,
+            uid=device_uid(index),
+            adc=signals.parse(args.adc),
+            host=args.host,
+        )
+    except KeyboardInterrupt:
+        pass
+
+
+def spawn_devices(args, workdir):
+    """Runs each device in a child process, until Ctrl+C."""
+    env = dict(os.environ)
+    paths = [PACKAGE_PARENT, env.get("PYTHONPATH")]
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, paths))
+    children = []
+    for index in range(args.count):
+        port = args.base_port + index
+        device_dir = os.path.join(workdir, "device-%d" % port)
+        os.makedirs(device_dir, exist_ok=True)
+        command = [
+            sys.executable, "-m", "picosim", os.path.abspath(args.firmware),
+            "--base-port", str(port), "--index", str(index),
+            "--adc", args.adc, "--host", args.host, "--workdir", device_dir,
+        ]  # fmt: skip
+        if args.pwm_log:
+            command += ["--pwm-log", os.path.abspath(args.pwm_log)]
+        # A device's console output goes to a file in its directory
+        console = open(os.path.join(device_dir, "console.log"), "w")
+        children.append(
+            subprocess.Popen(command, env=env, stdout=console, stderr=subprocess.STDOUT)
+        )
+        print("Device %d: port %d (%s)" % (index, port, device_dir))
+
+    try:
+        for child in children:
+            child.wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for child in children:
+            child.terminate()
+        for child in children:
+            child.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="picosim", description=__doc__.split("\n\n")[0])
+    parser.add_argument("firmware", help="Firmware to run, e.g. src/main.py")
+    parser.add_argument("--count", type=int, default=1, help="Number of devices")
+    parser.add_argument(
+        "--base-port", type=int, default=8000, help="First device's HTTP port"
+    )
+    parser.add_argument(
+        "--host", default="0.0.0.0", help="Address devices listen on (default: all)"
+    )
+    parser.add_argument(
+        "--adc",
+        default="30000",
+        help='Light level, e.g. "30000" or "sine:5000:60000:10000"',
+    )
+    parser.add_argument(
+        "--pwm-log", help="Directory to write each device's PWM writes to"
+    )
+    parser.add_argument(
+        "--workdir", help="Directory devices run in (default: a temporary one)"
+    )
+    parser.add_argument("--index", type=int, default=0, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="picosim-")
+    if args.count == 1:
+        run_device(args, args.index, args.base_port, workdir)
+    else:
+        spawn_devices(args, workdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+machine.py
+----------
+
+Fake `machine` module for the simulator.
+
+Pins and PWMs remember what the firmware last wrote to them, and every PWM
+write is also appended to `pwm_log` (and to `pwm_log_file`, if set) as a
+`(ticks_ms, pin, field, value)` tuple, so a test can check what the buzzer
+played. Like the RP2's, a PWM refuses frequencies it can't make. ADC
+readings come from `adc_source`, a function of the time in milliseconds
+since boot (see signals.py), so light levels can be scripted.
+"""
+
+import collections
+import time
+
+from . import signals
+
+# What every ADC reads: a function of ms since boot returning a read_u16() value
+adc_source = signals.constant(30000)
+
+# Every PWM write, oldest first: (ticks_ms, pin, "freq" or "duty", value)
+pwm_log: collections.deque = collections.deque(maxlen=100000)
+# An open text file that PWM writes are also written to as CSV lines, or None
+pwm_log_file = None
+
+# What unique_id() returns; the simulator sets one per device
+device_uid = b"\x00\x00\x00\x00\x00\x01"
+
+# The frequencies the RP2's PWM can run at; freq() raises ValueError outside them
+PWM_MIN_FREQ = 8
+PWM_MAX_FREQ = 62_500_000
+
+_boot = time.monotonic()
+
+
+def _ms_since_boot():
+    return int((time.monotonic() - _boot) * 1000)
+
+
+def unique_id():
+    return device_uid
+
+
+def freq(hz=None):
+    return 150_000_000
+
+
+def reset():
+    raise SystemExit("machine.reset()")
+
+
+class Pin:
+    IN = 0
+    OUT = 1
+    OPEN_DRAIN = 2
+    PULL_UP = 1
+    PULL_DOWN = 2
+    IRQ_FALLING = 4
+    IRQ_RISING = 8
+
+    def __init__(self, id, mode=-1, pull=-1, value=None):
+        self.id = id
+        self._value = 0 if value is None else value
+
+    def init(self, *args, **kwargs):
+        pass
+
+    def value(self, v=None):
+        if v is None:
+            return self._value
+        self._value = 1 if v else 0
+
+    def on(self):
+        self._value = 1
+
+    def off(self):
+        self._value = 0
+
+    def toggle(self):
+        self._value ^= 1
+
+    def irq(self, *args, **kwargs):
+        pass
+
+    __call__ = value
+
+
+class PWM:
+    def __init__(self, pin, freq=None, duty_u16=None):
+        self.pin = pin
+        self._freq = 0
+        self._duty = 0
+        if freq is not None:
+            self.freq(freq)
+        if duty_u16 is not None:
+            self.duty_u16(duty_u16)
+
+    def _record(self, field, value):
+        entry = (time.ticks_ms(), self.pin.id, field, value)  # type: ignore[attr-defined]
+        pwm_log.append(entry)
+        if pwm_log_file is not None:
+            pwm_log_file.write("%d,%s,%s,%d\n" % entry)
+
+    def freq(self, value=None):
+        if value is None:
+            return self._freq
+        if value < PWM_MIN_FREQ:
+            raise ValueError("freq too small")
+        if value > PWM_MAX_FREQ:
+            raise ValueError("freq too large")
+        self._freq = int(value)
+        self._record("freq", self._freq)
+
+    def duty_u16(self, value=None):
+        if value is None:
+            return self._duty
+        self._duty = int(value)
+        self._record("duty", self._duty)
+
+    def deinit(self):
+        self.duty_u16(0)
+
+
+class ADC:
+    CORE_TEMP = 4
+
+    def __init__(self, pin):
+        self.pin = pin
+
+    def read_u16(self):
+        return max(0, min(65535, int(adc_source(_ms_since_boot()))))
@@ -0,0 +1,53 @@
+"""
+network.py
+----------
+
+Fake `network` module for the simulator. Both station and access point
+interfaces come up at once, with the address the simulator gives them.
+"""
+
+STA_IF = 0
+AP_IF = 1
+
+STAT_IDLE = 0
+STAT_CONNECTING = 1
+STAT_GOT_IP = 3
+
+# What ifconfig() reports; the simulator sets the address it serves on
+address = "127.0.0.1"
+
+
+class WLAN:
+    def __init__(self, interface=STA_IF):
+        self.interface = interface
+        self._active = False
+        self._connected = False
+        self._config = {}
+
+    def active(self, state=None):
+        if state is None:
+            return self._active
+        self._active = bool(state)
+
+    def connect(self, ssid=None, password=None, **kwargs):
+        self._connected = True
+
+    def disconnect(self):
+        self._connected = False
+
+    def isconnected(self):
+        return self._connected or self.interface == AP_IF
+
+    def status(self, param=None):
+        return STAT_GOT_IP if self.isconnected() else STAT_IDLE
+
+    def config(self, *args, **kwargs):
+        if args:
+            return self._config.get(args[0])
+        self._config.update(kwargs)
+
+    def ifconfig(self, config=None):
+        return (address, "255.255.255.0", address, address)
+
+    def scan(self):
+        return []
@@ -0,0 +1,74 @@
+"""
+signals.py
+----------
+
+Scripted light levels for the simulated photoresistor.
+
+Each function returns a source: a function of the milliseconds since boot
+that returns a 16-bit ADC reading. Assign one to `machine.adc_source`, or
+describe one on the command line with `parse()`.
+"""
+
+import bisect
+import math
+import random
+
+
+def constant(value):
+    """Always the same reading."""
+    return lambda t_ms: value
+
+
+def sine(low, high, period_ms):
+    """A reading sweeping smoothly between low and high and back."""
+    middle = (low + high) / 2
+    amplitude = (high - low) / 2
+    return lambda t_ms: middle + amplitude * math.sin(2 * math.pi * t_ms / period_ms)
+
+
+def steps(points):
+    """Holds each (t_ms, value) point's value from its time until the next one."""
+    points = sorted(points)
+    times = [t for t, _ in points]
+    values = [v for _, v in points]
+
+    def source(t_ms):
+        i = bisect.bisect_right(times, t_ms) - 1
+        return values[max(i, 0)]
+
+    return source
+
+
+def noisy(source, spread):
+    """Adds uniform noise of up to +-spread to another source."""
+    return lambda t_ms: source(t_ms) + random.randint(-spread, spread)
+
+
+def from_csv(path):
+    """Steps through "t_ms,value" lines read from a file."""
+    with open(path) as f:
+        points = [
+            (int(t), int(v))
+            for t, v in (line.split(",") for line in f if line.strip())
+        ]
+    return steps(points)
+
+
+def parse(spec):
+    """Builds a source from a command-line description.
+
+    "30000" is constant, "sine:LOW:HIGH:PERIOD_MS" sweeps, "csv:PATH" replays
+    a file, and a "+noise:SPREAD" suffix adds noise to any of them.
+    """
+    spec, _, noise = spec.partition("+noise:")
+    kind, _, args = spec.partition(":")
+    if kind == "sine":
+        low, high, period_ms = (int(x) for x in args.split(":"))
+        source = sine(low, high, period_ms)
+    elif kind == "csv":
+        source = from_csv(args)
+    else:
+        source = constant(int(kind))
+    if noise:
+        source = noisy(source, int(noise))
+    return source
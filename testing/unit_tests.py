@@ -1,4 +1,4 @@
-# AI DISCLAIMER: GPT-5 was used to write documentation, all code was written by people 
+# AI DISCLAIMER: GPT-5 was used to write documentation, all code was written by people
 
 """
 unit_tests.py
@@ -7,60 +7,54 @@ unit_tests.py
 Lightweight unit test suite for the Pico project.
 
 This script provides a minimal test runner and a collection of tests for
-core functions in `main.py`. It mocks hardware-specific components 
-(e.g., PWM, ADC, and Pin) so the logic can be tested without requiring
-a Raspberry Pi Pico. Functions tested include color conversion, RGB 
-control, tone playback, API note playback, value mapping, and request 
-logging.
+core functions in `src2/main.py` and the shared modules in `src/` it
+imports. The firmware is loaded unmodified in the simulator (see picosim/),
+whose fake `machine` module records every PWM write, so the logic can be
+tested without requiring a Raspberry Pi Pico. Functions tested include RGB
+control, tone and chord playback, value mapping, request logging, the HTTP
+routes and the packed score format.
+
+Run it from the repository root:
+
+    python testing/unit_tests.py
 
 The script tracks test results, printing a summary of passed and failed
 tests when executed directly.
 """
 
-import math
-import ujson as json
+import asyncio
+import gc
+import json
+import os
+import socket
+import struct
+import sys
+import tempfile
 import time
 
-# --- Mock machine module ---
-class MockPWM:
-    def __init__(self, pin):
-        self.pin = pin
-        self._freq = None
-        self._duty = None
-    def freq(self, f=None):
-        if f is not None:
-            self._freq = f
-        return self._freq
-    def duty_u16(self, d):
-        self._duty = d
-        return d
-
-class MockPin:
-    def __init__(self, num):
-        self.num = num
-
-class MockADC:
-    def __init__(self, pin):
-        self.pin = pin
-        self._value = 12345
-    def read_u16(self):
-        return self._value
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import picosim
+from picosim import machine, signals
 
-# --- Import functions from main file ---
-from main import (
-    hsv_to_rgb, set_rgb, rgb_one_at_a_time,
-    connect_to_wifi, play_tone, stop_tone,
-    play_api_note, map_value, log_request
+FIRMWARE = os.path.join(picosim.REPO_ROOT, "src2", "main.py")
+
+# --- Boot the firmware in the simulator, in a scratch directory ---
+main = picosim.boot(
+    FIRMWARE, workdir=tempfile.mkdtemp(prefix="unit-tests-"), adc=signals.constant(12345)
 )
 
-# Replace hardware-dependent globals with mocks
-import main
-main.red_pwm = MockPWM(MockPin(2))
-main.green_pwm = MockPWM(MockPin(3))
-main.blue_pwm = MockPWM(MockPin(15))
-main.buzzer_pin = MockPWM(MockPin(10))
-main.buzzer_pin2 = MockPWM(MockPin(13))
-main.photo_sensor_pin = MockADC(26)
+# src2's logging.py, not the standard library's
+from logging import flush, METHODS, RECORD_FORMAT  # type: ignore[attr-defined]
+import devlog
+import gcpolicy
+import events
+import notecast
+import pitchmap
+import read_logs
+import score
+import sensor
+import tone
+import webserver
 
 # --- Test Runner ---
 results = {"passed": 0, "failed": 0}
@@ -77,57 +71,762 @@ def run_test(name, fn):
         print(f"[ERROR] {name} - {e}")
         results["failed"] += 1
 
-# --- Tests ---
+# Every async test runs on this one loop, where the voices' tasks live
+loop = asyncio.new_event_loop()
+asyncio.set_event_loop(loop)
+
+def run_async(coro):
+    """Runs a coroutine on the test loop, with both voices running and quiet."""
+    async def wrapper():
+        if not main.voices[0].task:
+            for v in main.voices:
+                v.start()
+        try:
+            return await coro
+        finally:
+            main.allocator.stop()
+            await asyncio.sleep_ms(0)
+    return loop.run_until_complete(wrapper())
+
+def request(method, path, query="", body=b""):
+    req = webserver.Request()
+    req.method, req.path, req.query, req.body = method, path, query, body
+    req.body_buf, req.body_start, req.body_end = body, 0, len(body)
+    return req
+
+class FakeStream:
+    """Both ends of a connection for webserver.serve(): replays what a client
+    sent, a few bytes at a time, and keeps everything written back."""
+
+    def __init__(self, data, chunk=7):
+        self.data = data
+        self.chunk = chunk
+        self.sent = bytearray()
+        self.closed = False
+
+    async def readinto(self, buf):
+        n = min(len(buf), self.chunk, len(self.data))
+        buf[:n] = self.data[:n]
+        self.data = self.data[n:]
+        return n
 
-def test_hsv_to_rgb():
-    assert hsv_to_rgb(0, 1, 1) == (255, 0, 0)
-    assert hsv_to_rgb(120, 1, 1) == (0, 255, 0)
-    assert hsv_to_rgb(240, 1, 1) == (0, 0, 255)
+    def write(self, data):
+        self.sent.extend(data)
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    async def wait_closed(self):
+        pass
+
+def route_echo(req):
+    return webserver.STATUS_200, webserver.TEXT_PLAIN, bytes(req.body)
+
+ECHO_ROUTES = {
+    ("GET", "/health"): lambda req: (webserver.STATUS_200, webserver.TEXT_PLAIN, b"ok"),
+    ("POST", "/echo"): route_echo,
+}
+
+def serve(data, chunk=7):
+    """Serves one connection on which the client sent data; returns [(status, body)]."""
+    stream = FakeStream(data, chunk)
+    loop.run_until_complete(webserver.serve(stream, stream, ECHO_ROUTES))
+    assert stream.closed, "the connection was left open"
+    responses = []
+    rest = bytes(stream.sent)
+    while rest:
+        head, _, rest = rest.partition(b"\r\n\r\n")
+        length = int(head.split(b"Content-Length:")[1].split(b"\r\n")[0])
+        responses.append((head.split(b" ")[1], rest[:length]))
+        rest = rest[length:]
+    return responses
+
+# --- Tests ---
 
 def test_set_rgb():
+    set_rgb = main.set_rgb
     set_rgb(128, 64, 32)
-    assert main.red_pwm._duty is not None
-    assert main.green_pwm._duty is not None
-    assert main.blue_pwm._duty is not None
+    assert main.red_pwm.duty_u16() == 65535 - 128 * 257
+    assert main.green_pwm.duty_u16() == 65535 - 64 * 257
+    assert main.blue_pwm.duty_u16() == 65535 - 32 * 257
 
 def test_map_value():
+    map_value = main.map_value
     assert map_value(5, 0, 10, 0, 100) == 50
     assert map_value(0, 0, 10, -1, 1) == -1
     assert map_value(10, 0, 10, -1, 1) == 1
 
 def test_play_tone_and_stop_tone():
-    play_tone(440, 10)
-    assert main.buzzer_pin._freq == 440
-    stop_tone()
-    assert main.buzzer_pin._duty == 0
+    async def play():
+        main.play_tone(440, 200)
+        await asyncio.sleep_ms(20)
+        assert main.buzzer_pin.freq() == 440, f"freq {main.buzzer_pin.freq()}"
+        assert main.buzzer_pin.duty_u16() > 0
+        main.stop_tone()
+        assert main.buzzer_pin.duty_u16() == 0
+    run_async(play())
+
+def test_play_chord():
+    async def play():
+        machine.pwm_log.clear()
+        main.allocator.play_chord((523, 659), 100)
+        await asyncio.sleep_ms(20)
+        played = {(pin, value) for _, pin, field, value in machine.pwm_log if field == "freq"}
+        assert played == {(10, 523), (13, 659)}, f"played {played}"
+    run_async(play())
 
 def test_log_request():
-    log_request("GET", "/", 12345)
-    with open("logs.db") as f:
-        lines = f.readlines()
-        last = json.loads(lines[-1])
-        assert last["method"] == "GET"
-        assert last["url"] == "/"
-        assert last["light_value"] == 12345
+    main.log_request("GET", "/", 12345)
+    flush()
+    with open("logs.db", "rb") as f:
+        _, method_code, url_id, light_value = struct.unpack(RECORD_FORMAT, f.read()[-8:])
+    with open("logs.urls") as f:
+        urls = [line.rstrip("\n") for line in f]
+    assert METHODS[method_code] == "GET"
+    assert urls[url_id] == "/"
+    assert light_value == 12345
+
+def test_read_logs_time_range():
+    # Several records share each timestamp, so some runs of equal timestamps
+    # straddle the sparse index's block boundaries
+    stride = read_logs.INDEX_STRIDE
+    timestamps = [1000 + i // 7 for i in range(stride * 3 + 50)]
+    path = os.path.join(tempfile.mkdtemp(prefix="unit-tests-"), "logs.db")
+    with open(path, "wb") as f:
+        for i, timestamp in enumerate(timestamps):
+            f.write(struct.pack(RECORD_FORMAT, timestamp, 0, 0, i))
+        f.write(b"\x01\x02\x03")  # A record cut short by a reset
+    with read_logs.LogFile(path, ["/"]) as log:
+        assert log.count == len(timestamps)
+        assert len(log._index) == 4
+        ranges = [(None, None), (1000, 1000), (1036, 1037), (1073, None), (None, 1001)]
+        ranges += [(900, 999), (2000, None), (1050, 1040)]  # Nothing in range
+        for since, until in ranges:
+            expected = [
+                i for i, t in enumerate(timestamps)
+                if (since is None or t >= since) and (until is None or t <= until)
+            ]
+            got = [entry.light_value for entry in log.entries(since, until)]
+            assert got == expected, f"since {since}, until {until}: {got[:3]}..."
+        entry = next(log.entries())
+        assert (entry.method, entry.url) == ("GET", "/")
 
 def test_rgb_one_at_a_time_coroutine():
-    # Just check that it is an async generator
-    coro = rgb_one_at_a_time(10)
-    assert hasattr(coro, "__await__")
+    async def cycle():
+        task = asyncio.create_task(main.rgb_one_at_a_time(10))
+        await asyncio.sleep_ms(5)
+        assert main.red_pwm.duty_u16() == 0, "red should be fully on first"
+        await asyncio.sleep_ms(10)
+        assert main.green_pwm.duty_u16() == 0, "green should be on second"
+        task.cancel()
+    run_async(cycle())
+
+def test_set_color_route():
+    req = request("GET", "/set_color", "color=red")
+    status, content_type, body = main.route_set_color(req)
+    assert status == webserver.STATUS_200
+    assert body == b'{"status": "ok", "color": "red"}'
+    assert main.red_pwm.duty_u16() == 0
+
+def test_sensor_route():
+    status, content_type, body = main.route_sensor(request("GET", "/sensor"))
+    assert status == webserver.STATUS_200
+    assert b'"raw": 12345' in body, body
+
+def test_metrics_route():
+    before = main.metrics.render()
+    main.metrics.count_route(("GET", "/sensor"))
+    status, content_type, body = main.route_metrics(request("GET", "/metrics"))
+    assert status == webserver.STATUS_200
+    assert b"mem_free_bytes " in body
+    line = b'route_requests_total{route="GET /sensor"} '
+    count = lambda text: int(text.split(line)[1].split(b"\n")[0])
+    assert count(body) == count(before) + 1
+
+def test_metrics_counters_wrap():
+    saved = main.metrics.values[main.metrics.BYTES_IN]
+    try:
+        main.metrics.values[main.metrics.BYTES_IN] = main.metrics.COUNTER_WRAP - 10
+        main.metrics.add(main.metrics.BYTES_IN, 25)
+        assert main.metrics.values[main.metrics.BYTES_IN] == 15
+    finally:
+        main.metrics.values[main.metrics.BYTES_IN] = saved
+
+def test_metrics_count_answered_requests():
+    before = main.metrics.values[main.metrics.REQUESTS]
+    stream = FakeStream(b"GET /health HTTP/1.1\r\n\r\nGET /nowhere HTTP/1.1\r\n\r\n")
+    loop.run_until_complete(webserver.serve(stream, stream, ECHO_ROUTES))
+    assert main.metrics.values[main.metrics.REQUESTS] == before + 2
+    stream = FakeStream(b"POST /echo HTTP/1.1\r\nContent-Length: -1\r\n\r\n")
+    loop.run_until_complete(webserver.serve(stream, stream, ECHO_ROUTES))
+    assert main.metrics.values[main.metrics.REQUESTS] == before + 2  # Not answered
+
+def test_play_note_route():
+    async def play():
+        body = b'{"frequency": 440, "duration": 0.25}'
+        main.route_play_note(request("POST", "/play_note", body=body))
+        await asyncio.sleep_ms(20)
+        assert main.allocator.busy()
+        assert main.voices[0].frequency == 440
+        assert main.voices[0].duration_ms == 250
+    run_async(play())
+    try:
+        main.route_play_note(request("POST", "/play_note", body=b'{"frequency": "A4"}'))
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("a frequency that isn't a number was accepted")
+
+def test_tone_route_start_time():
+    async def play():
+        at = time.ticks_add(time.ticks_ms(), 500)
+        body = b'{"freq": 440, "ms": 100, "at": %d}' % at
+        status, _, reply = main.route_tone(request("POST", "/tone", body=body))
+        assert status == webserver.STATUS_202
+        assert 400 < int(reply.split(b":")[-1].rstrip(b"}")) <= 600, reply
+    run_async(play())
+    for body in (
+        b'{"freq": 440, "ms": -100}',
+        b'{"freq": 440, "ms": 100, "duty": 1.5}',
+        b'{"freq": 440, "ms": 100, "duty": -0.5}',
+    ):
+        response = main.route_tone(request("POST", "/tone", body=body))
+        assert response == webserver.OUT_OF_RANGE, f"{body} was accepted"
+    for at in (99999999999, time.ticks_add(time.ticks_ms(), -120000)):
+        body = b'{"freq": 440, "ms": 100, "at": %d}' % at
+        response = main.route_tone(request("POST", "/tone", body=body))
+        assert response == webserver.OUT_OF_RANGE, f"at {at} was accepted"
+
+def test_score_round_trip():
+    notes = [(523, 200), (0, 100), (659, 400)]
+    packed = score.encode(notes, gap_ms=20)
+    assert len(packed) == score.HEADER_SIZE + 3 * score.RECORD_SIZE
+    assert score.read_header(packed) == (3, 20, None)
+    assert score.voices(packed) == 1
+    played = [(score.frequency(packed, i), score.duration_ms(packed, i)) for i in range(3)]
+    assert played == notes, played
+
+    started = score.with_start(packed, 123456)
+    assert score.read_header(started) == (3, 20, 123456)
+    assert started[score.HEADER_SIZE :] == packed[score.HEADER_SIZE :]
+
+def test_score_from_json_two_voices():
+    data = {
+        "notes": [{"freqs": [262, 330], "ms": 500}, {"freq": 392, "ms": 250}],
+        "gap_ms": 10,
+        "at": 4000,
+    }
+    packed = score.from_json(data)
+    assert score.read_header(packed) == (2, 10, 4000)
+    assert score.voices(packed) == 2
+    assert len(packed) == score.HEADER_SIZE + 2 * score.CHORD_RECORD_SIZE
+    assert [score.frequency(packed, 0, v) for v in (0, 1)] == [262, 330]
+    assert [score.frequency(packed, 1, v) for v in (0, 1)] == [392, 0]  # Second part rests
+    assert [score.duration_ms(packed, i) for i in (0, 1)] == [500, 250]
+
+def test_score_malformed():
+    packed = score.encode([(440, 100), (880, 100)])
+    bad = {
+        "too short": packed[: score.HEADER_SIZE - 1],
+        "bad magic": b"XX" + packed[2:],
+        "bad version": packed[:2] + bytes([score.VERSION + 1]) + packed[3:],
+        "truncated": packed[:-1],
+    }
+    for name, melody in bad.items():
+        try:
+            score.read_header(melody)
+        except ValueError:
+            continue
+        raise AssertionError(f"a score that is {name} was accepted")
+    for data in ({"notes": [{"freqs": [1, 2, 3], "ms": 100}]}, {"notes": [{"ms": 100}]}):
+        try:
+            score.from_json(data)
+        except (ValueError, KeyError):
+            continue
+        raise AssertionError(f"{data} was accepted")
+
+def test_parser_keep_alive():
+    data = (
+        b"POST /echo HTTP/1.1\r\nContent-Length: 5\r\n\r\nhello"
+        b"GET /health HTTP/1.1\r\nHost: pico\r\n\r\n"
+    )
+    for chunk in (1, 7, 4096):  # However the bytes arrive
+        responses = serve(data, chunk)
+        assert responses == [(b"200", b"hello"), (b"200", b"ok")], responses
+
+def test_parser_pipelining_and_close():
+    data = (
+        b"GET /health HTTP/1.1\r\n\r\n"
+        b"POST /echo HTTP/1.1\r\nContent-Length: 3\r\nConnection: close\r\n\r\nabc"
+        b"GET /health HTTP/1.1\r\n\r\n"  # Never read: the client asked to close
+    )
+    responses = serve(data, chunk=4096)
+    assert responses == [(b"200", b"ok"), (b"200", b"abc")], responses
+    responses = serve(b"GET /health HTTP/1.0\r\n\r\nGET /health HTTP/1.0\r\n\r\n")
+    assert responses == [(b"200", b"ok")], responses  # HTTP/1.0 closes by default
+
+def test_parser_large_body():
+    body = bytes(range(256)) * 8  # Too big for the header buffer, so it's allocated
+    data = b"POST /echo HTTP/1.1\r\nContent-Length: %d\r\n\r\n" % len(body) + body
+    assert serve(data + b"GET /health HTTP/1.1\r\n\r\n", chunk=1000) == [
+        (b"200", body),
+        (b"200", b"ok"),
+    ]
+    too_big = webserver.MAX_BODY_SIZE + 1
+    data = b"POST /echo HTTP/1.1\r\nContent-Length: %d\r\n\r\n" % too_big
+    assert serve(data) == [(b"413", b"")]
+
+def test_parser_headers_too_large():
+    data = b"GET /health HTTP/1.1\r\nX-Padding: " + b"x" * webserver.HEADER_BUFFER_SIZE
+    assert serve(data + b"\r\n\r\n") == [(b"431", b"")]
+
+def test_parser_bad_content_length():
+    for length in (b"-5", b"abc", b"", b"+5", b"5 5"):
+        data = (
+            b"POST /echo HTTP/1.1\r\nContent-Length: " + length + b"\r\n\r\nhello"
+            b"GET /health HTTP/1.1\r\n\r\n"
+        )
+        responses = serve(data)
+        assert responses == [(b"400", b"")], f"Content-Length {length}: {responses}"
+    responses = serve(b"NONSENSE\r\n\r\n")
+    assert responses == [(b"400", b"")], responses
+
+def test_logs_route_level():
+    try:
+        response = main.route_logs(request("GET", "/logs", "level=loud"))
+        assert response == webserver.INVALID_QUERY, response
+        main.route_logs(request("GET", "/logs", "level=debug"))
+        assert devlog.level == devlog.DEBUG
+        devlog.debug("Heard at %s", "debug")
+        _, _, body = main.route_logs(request("GET", "/logs"))
+        assert body.endswith(b"DEBUG Heard at debug"), body
+    finally:
+        devlog.set_level(devlog.INFO)
 
-def test_play_api_note_coroutine():
-    coro = play_api_note(440, 0.01)
-    assert hasattr(coro, "__await__")
+def test_history_summarize():
+    history = sensor.SensorHistory(size=8)
+    now = 100000
+    # Ages in ms; 1000 is just outside a 1000 ms window, 250 the start of bucket 2
+    readings = [(1500, 9), (1000, 7), (999, 100), (750, 300), (250, 40), (249, 20), (0, 60)]
+    for age, value in readings:
+        history.add(value, now - age)
+    summary = history.summarize(1000, 4, now)
+    assert summary == [(100, 300, 200), None, (40, 40, 40), (20, 60, 40)], summary
+    assert sensor.SensorHistory().summarize(1000, 3, now) == [None, None, None]
+
+    # Once the ring wraps, only the newest size readings are left
+    for i in range(10):
+        history.add(i, now + 10 + i)
+    summary = history.summarize(100, 1, now + 20)
+    assert summary == [(2, 9, 5)], summary
+
+class EventClient:
+    """The writer end of a GET /events connection, which can be made to stall."""
+
+    def __init__(self):
+        self.events = []
+        self.flowing = asyncio.Event()
+        self.flowing.set()
+
+    def write(self, data):
+        if data.startswith(b"data:"):
+            self.events.append(data)
+
+    async def drain(self):
+        await self.flowing.wait()
+
+def test_events_fan_out():
+    async def stream():
+        hub = events.EventStream(heartbeat_ms=1000, max_subscribers=2)
+        fine, coarse, turned_away = EventClient(), EventClient(), EventClient()
+        tasks = [
+            asyncio.create_task(hub.serve(request("GET", "/events", "delta=0.01"), fine)),
+            asyncio.create_task(hub.serve(request("GET", "/events", "delta=0.5"), coarse)),
+        ]
+        await asyncio.sleep_ms(0)
+        await hub.serve(request("GET", "/events"), turned_away)  # One too many
+        assert len(hub.subscribers) == 2
+        for raw, ticks in ((0, 0), (300, 10), (30000, 20), (30100, 30), (30100, 1100)):
+            hub.publish(raw, ticks)
+            await asyncio.sleep_ms(0)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        assert not hub.subscribers
+        return fine.events, coarse.events
+
+    fine, coarse = run_async(stream())
+    # Changes under a subscriber's delta are skipped until the heartbeat is due
+    assert [e.split(b'"ts": ')[1] for e in fine] == [b"0}\n\n", b"20}\n\n", b"1100}\n\n"]
+    assert [e.split(b'"ts": ')[1] for e in coarse] == [b"0}\n\n", b"1100}\n\n"]
+    assert fine[1].startswith(b'data: {"norm": 0.458,'), fine[1]
+
+def test_events_slow_client():
+    async def stream():
+        hub = events.EventStream()
+        slow, quick = EventClient(), EventClient()
+        tasks = [
+            asyncio.create_task(hub.serve(request("GET", "/events", "delta=0"), c))
+            for c in (slow, quick)
+        ]
+        await asyncio.sleep_ms(0)
+        hub.publish(100, 0)
+        await asyncio.sleep_ms(0)
+        slow.flowing.clear()  # The slow client stops reading mid-stream
+        for raw in range(200, 700, 100):
+            hub.publish(raw, raw)
+            await asyncio.sleep_ms(0)
+        assert len(quick.events) == 6, quick.events
+        slow_sub = hub.subscribers[0]
+        slow.flowing.set()
+        await asyncio.sleep_ms(0)
+        await asyncio.sleep_ms(0)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return slow.events, slow_sub.dropped
+
+    sent, dropped = run_async(stream())
+    # Stuck on the 200 event, it missed 300 to 500 and then got the newest one
+    assert [e.split(b'"ts": ')[1] for e in sent] == [b"0}\n\n", b"200}\n\n", b"600}\n\n"]
+    assert dropped == 3, dropped
+
+class ScriptedADC:
+    """An ADC whose read_u16() returns burst after burst of given readings."""
+
+    def __init__(self, bursts, oversample=sensor.OVERSAMPLE):
+        self.readings = [value for value in bursts for _ in range(oversample)]
+
+    def read_u16(self):
+        return self.readings.pop(0)
+
+def test_light_filter_settling():
+    light = sensor.LightFilter(ScriptedADC([20000] * 3 + [50000] * 30))
+    readings = [light.read() for _ in range(33)]
+    assert readings[:3] == [20000] * 3  # A steady light reads exactly
+    rising = readings[3:]
+    assert rising == sorted(rising), "the filter overshot or went backwards"
+    assert rising[0] == 20000, "a step passed the median of three at once"
+    assert 49900 <= rising[-1] <= 50000, f"not settled: {rising[-1]}"
+
+    spiky = sensor.LightFilter(ScriptedADC([30000, 30000, 65535, 30000, 0, 30000]))
+    assert [spiky.read() for _ in range(6)] == [30000] * 6  # Lone spikes vanish
+
+def test_hysteresis_threshold():
+    pitch = sensor.Hysteresis(band=6)
+    assert pitch.update(440) and pitch.value == 440
+    assert not pitch.update(445) and pitch.value == 440  # Less than band away
+    assert not pitch.update(435) and pitch.value == 440
+    assert pitch.update(446) and pitch.value == 446  # band away moves it
+    assert pitch.update(440) and pitch.value == 440
+
+def test_pitch_table_edges():
+    continuous = pitchmap.build_table("continuous")
+    assert len(continuous) == 1 << pitchmap.LUT_BITS
+    assert continuous[0] == 0  # Too dark: silent
+    assert continuous[pitchmap.MIN_LIGHT >> pitchmap.LUT_SHIFT] == 0
+    first = continuous[(pitchmap.MIN_LIGHT >> pitchmap.LUT_SHIFT) + 1]
+    assert pitchmap.MIN_FREQ <= first < pitchmap.MIN_FREQ + 20, first
+    assert continuous[-1] == pitchmap.MAX_FREQ  # Readings past MAX_LIGHT clamp
+    assert list(continuous) == sorted(continuous)
+
+    # Snapped, the edges land on C4 and C6 themselves
+    for name in ("chromatic", "major", "pentatonic"):
+        table = pitchmap.build_table(name)
+        notes = [f for f in table if f]
+        assert (notes[0], notes[-1]) == (262, 1047), (name, notes[0], notes[-1])
+        assert notes == sorted(notes)
+    pentatonic = {0, 262, 294, 330, 392, 440, 523, 587, 659, 784, 880, 1047}  # C, D, E, G, A
+    assert set(pitchmap.build_table("pentatonic")) == pentatonic
+    assert pitchmap.snap_to_scale(277, pitchmap.SCALES["major"]) in (262, 294)  # C#4
+    assert pitchmap.snap_to_scale(1046, pitchmap.SCALES["chromatic"]) == 1047
+
+def test_tone_output_skips_redundant_writes():
+    pins = (machine.PWM(machine.Pin(20)), machine.PWM(machine.Pin(21)))
+    out = tone.ToneOutput(pins)
+    machine.pwm_log.clear()
+    writes = lambda: [(pin, field, value) for _, pin, field, value in machine.pwm_log]
+
+    out.set(0, 440)
+    assert writes() == [(20, "freq", 440), (20, "duty", tone.HALF_DUTY)], writes()
+    machine.pwm_log.clear()
+    out.set(0, 440)  # Already playing
+    out.set(0, 0)
+    out.set(0, 0)  # Already silent
+    out.set(0, 440)  # The frequency is still set, only the duty comes back
+    out.set(0, 440, 1000)
+    assert writes() == [(20, "duty", 0), (20, "duty", tone.HALF_DUTY), (20, "duty", 1000)]
+    machine.pwm_log.clear()
+    out.off()
+    out.off()
+    out.set_all(0)
+    assert writes() == [(20, "duty", 0), (21, "duty", 0)], writes()
+
+def test_voice_survives_refused_note():
+    async def play():
+        v = main.voices[0]
+        v.play_note(5, 100)  # Below what the PWM can make, so freq() raises
+        await asyncio.sleep_ms(20)
+        assert not v.task.done(), "the voice's task died"
+        assert not v.busy()
+        v.play_note(440, 200)
+        await asyncio.sleep_ms(20)
+        assert main.buzzer_pin.freq() == 440, f"freq {main.buzzer_pin.freq()}"
+        assert main.buzzer_pin.duty_u16() > 0
+    run_async(play())
+
+def test_note_routes_reject_unplayable_frequencies():
+    bodies = {
+        "/tone": [b'{"freq": 5, "ms": 100}', b'{"freq": -440, "ms": 100}'],
+        "/play_note": [b'{"frequency": 7, "duration": 0.1}'],
+        "/chord": [b'{"freqs": [440, 3], "ms": 100}', b'{"freqs": [70000], "ms": 100}'],
+        "/melody": [
+            b'{"notes": [{"freq": 440, "ms": 100}, {"freq": 4, "ms": 100}]}',
+            b'{"notes": [{"freq": 70000, "ms": 100}]}',
+            b'{"notes": [{"freq": 440, "ms": -1}]}',
+            b'{"notes": [{"freq": 440, "ms": 100}], "gap_ms": 70000}',
+            b'{"notes": [{"freq": 440, "ms": 100}], "at": -5}',
+            b'{"notes": [{"freq": 440, "ms": 100}], "at": "x"}',
+        ],
+    }
+    for path, path_bodies in bodies.items():
+        route = main.ROUTES[("POST", path)]
+        for body in path_bodies:
+            response = route(request("POST", path, body=body))
+            assert response == webserver.OUT_OF_RANGE, f"{path} accepted {body}"
+    assert not main.allocator.busy()
+
+    async def rest():
+        body = b'{"freq": 0, "ms": 10}'
+        status, _, _ = main.route_tone(request("POST", "/tone", body=body))
+        assert status == webserver.STATUS_202  # 0 is a rest
+    run_async(rest())
+
+def test_note_routes_check_parameters():
+    out_of_range = [
+        ("/chord", b'{"freqs": [440], "ms": -100}'),
+        ("/chord", b'{"freqs": [440], "ms": 100, "duty": 3}'),
+        ("/tone", b'{"freq": 440, "ms": 100, "voice": 5}'),
+        ("/play_note", b'{"frequency": 440, "duration": 0.1, "voice": -1}'),
+        ("/melody", b'{"notes": [{"freq": 440, "ms": 100}], "voice": 2}'),
+    ]
+    for path, body in out_of_range:
+        response = main.ROUTES[("POST", path)](request("POST", path, body=body))
+        assert response == webserver.OUT_OF_RANGE, f"{path} accepted {body}"
+    melody = b'{"notes": [{"freq": 440, "ms": 100}]}'
+    response = main.route_melody(request("POST", "/melody", "voice=9", melody))
+    assert response == webserver.OUT_OF_RANGE
+    for body in (
+        b'{"freqs": [440], "ms": 100, "duty": "ab"}',
+        b'{"freqs": [440], "ms": [1], "duty": 0.5}',
+        b'{"freqs": [440], "ms": 100, "at": "x"}',
+    ):
+        try:
+            main.route_chord(request("POST", "/chord", body=body))
+        except ValueError:
+            continue
+        raise AssertionError(f"/chord accepted {body}")
+    assert not main.allocator.busy()
+
+    async def play():
+        body = b'{"notes": [{"freq": 440, "ms": 10}], "voice": null}'
+        status, _, _ = main.route_melody(request("POST", "/melody", body=body))
+        assert status == webserver.STATUS_202  # null picks any voice
+    run_async(play())
+
+def test_notecast_is_newer():
+    assert notecast.is_newer(2, 1)
+    assert not notecast.is_newer(1, 1)  # A duplicate
+    assert not notecast.is_newer(1, 2)  # Overtaken
+    assert notecast.is_newer(3, 0xFFFFFFFE)  # Across the wrap
+    assert not notecast.is_newer(0xFFFFFFFE, 3)
+    assert not notecast.is_newer(0x80000001, 1)  # Too far ahead counts as behind
+
+def test_notecast_decode():
+    melody = score.encode([(440, 100), (0, 50)])
+    assert notecast.decode(notecast.encode(7, melody, 300)) == (7, 300, melody)
+    datagram = notecast.encode(0xFFFFFFFF, melody, notecast.MAX_LEAD_MS)
+    assert notecast.decode(datagram) == (0xFFFFFFFF, notecast.MAX_LEAD_MS, melody)
+    for lead_ms in (-1, notecast.MAX_LEAD_MS + 1):
+        try:
+            notecast.encode(1, melody, lead_ms)
+        except ValueError:
+            continue
+        raise AssertionError(f"lead_ms {lead_ms} was encoded")
+
+    good = notecast.encode(1, melody, 0)
+    bad = {
+        "too short": good[: notecast.HEADER_SIZE - 1],
+        "bad magic": b"XX" + good[2:],
+        "bad version": good[:2] + bytes([notecast.VERSION + 1]) + good[3:],
+        "without a score": good[: notecast.HEADER_SIZE],
+        "truncated": good[:-1],
+    }
+    for name, datagram in bad.items():
+        try:
+            notecast.decode(datagram)
+        except ValueError:
+            continue
+        raise AssertionError(f"a datagram that is {name} was accepted")
+
+def test_notecast_receives():
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    probe.bind(("127.0.0.1", 0))
+    port = probe.getsockname()[1]  # A port nobody else is using
+    probe.close()
+    melody = score.encode([(440, 100)])
+
+    async def listen():
+        played = []
+        task = asyncio.create_task(notecast.run(played.append, port=port))
+        await asyncio.sleep_ms(0)
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for seq in (5, 5, 4, 6):  # A duplicate and a late arrival in between
+            sender.sendto(notecast.encode(seq, melody, 200), ("127.0.0.1", port))
+        sent = time.ticks_ms()
+        sender.sendto(b"not a note", ("127.0.0.1", port))
+        sender.close()
+        await asyncio.sleep_ms(notecast.POLL_MS * 4)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return played, sent
+
+    played, sent = run_async(listen())
+    assert len(played) == 2, played
+    for packed in played:
+        _, _, start_at = score.read_header(packed)
+        assert 200 <= time.ticks_diff(start_at, sent) <= 250, start_at
+
+def test_json_number():
+    def number(body, key, default=None, scale=1):
+        return webserver.json_number(request("POST", "/", body=body), key, default, scale)
+
+    body = b' { "freq" : 440, "ms":-12.5, "duty": null, "duration": 0.2500009 } '
+    assert number(body, b'"freq"') == 440
+    assert number(body, b'"ms"') == -12  # Rounded toward zero
+    assert number(body, b'"duty"', 7) == 7
+    assert number(body, b'"voice"', 3) == 3
+    assert number(body, b'"duration"', scale=1000) == 250
+    # The key's text as a string value, or inside one, isn't the member
+    assert number(b'{"note": "freq", "freq": 440, "ms": 100}', b'"freq"') == 440
+    assert number(b'{"name": "\\"freq\\": 1", "freq": 2}', b'"freq"') == 2
+    assert number(b'{"note": "freq"}', b'"freq"', 0) == 0
+    for body in (b"[1, 2]", b'{"freq": "A4"}', b'{"freq": }', b""):
+        try:
+            number(body, b'"freq"')
+        except ValueError:
+            continue
+        raise AssertionError(f"{body} was read as a number")
+
+def test_template():
+    template = webserver.Template(b'{"a": ', b', "b": ', b"}", width=4)
+    assert template.body == b'{"a":     , "b":     }'
+    template.set(0, 7)
+    template.set(1, -123)
+    assert template.body == b'{"a":    7, "b": -123}'
+    template.set(0, 9999)
+    template.set(1, 0)
+    assert template.body == b'{"a": 9999, "b":    0}'
+    assert json.loads(bytes(template.body)) == {"a": 9999, "b": 0}
+    for value in (10000, -1000):
+        try:
+            template.set(0, value)
+        except ValueError:
+            continue
+        raise AssertionError(f"{value} was squeezed into 4 digits")
+
+def test_gcpolicy():
+    scheduled = main.metrics.values[main.metrics.GC_SCHEDULED]
+    gcpolicy.collect()
+    assert main.metrics.values[main.metrics.GC_SCHEDULED] == scheduled + 1
+    assert main.metrics.values[main.metrics.GC_PAUSE_US] >= 0
+    assert not gcpolicy.due()  # Nothing allocated since
+    assert not gcpolicy.gap(1000)
+    gcpolicy.idle()
+    assert main.metrics.values[main.metrics.GC_SCHEDULED] == scheduled + 1
+
+    gcpolicy._collect_at = 0  # A collection is due
+    longest = max(main.metrics.values[main.metrics.GC_PAUSE_MAX_US], gcpolicy.EXPECTED_PAUSE_US)
+    too_short_ms = (longest + gcpolicy.PAUSE_MARGIN_US) // 1000 - 1
+    assert not gcpolicy.gap(too_short_ms), "collected in a gap it doesn't fit"
+    assert gcpolicy.gap(too_short_ms + 2)
+    assert main.metrics.values[main.metrics.GC_SCHEDULED] == scheduled + 2
+
+    gcpolicy._collect_at = 0
+    mem_free = gc.mem_free
+    gc.mem_free = lambda: gcpolicy.LOW_FREE_BYTES - 1  # Nearly out of heap
+    try:
+        assert gcpolicy.gap(0), "a nearly full heap waited for a longer gap"
+    finally:
+        gc.mem_free = mem_free
+    gcpolicy._collect_at = 0
+    gcpolicy.idle()
+    assert main.metrics.values[main.metrics.GC_SCHEDULED] == scheduled + 4
+
+def test_adaptive_interval():
+    interval = sensor.AdaptiveInterval(min_ms=20, max_ms=250)
+    ticks = 0
+    for _ in range(50):  # Still light backs off to the slowest rate
+        ms = interval.update(30000, ticks)
+        ticks += ms
+    assert ms == 250, f"interval {ms}"
+    ms = interval.update(50000, ticks + ms)  # A hand moves over the sensor
+    assert ms == 20, f"interval {ms}"
 
 # --- Run all tests ---
 if __name__ == "__main__":
-    run_test("HSV to RGB", test_hsv_to_rgb)
     run_test("Set RGB", test_set_rgb)
     run_test("Map Value", test_map_value)
     run_test("Play Tone and Stop Tone", test_play_tone_and_stop_tone)
+    run_test("Play Chord", test_play_chord)
     run_test("Log Request", test_log_request)
+    run_test("Read Logs Time Range", test_read_logs_time_range)
     run_test("RGB One At A Time Coroutine", test_rgb_one_at_a_time_coroutine)
-    run_test("Play API Note Coroutine", test_play_api_note_coroutine)
+    run_test("Set Color Route", test_set_color_route)
+    run_test("Sensor Route", test_sensor_route)
+    run_test("Metrics Route", test_metrics_route)
+    run_test("Metrics Counters Wrap", test_metrics_counters_wrap)
+    run_test("Metrics Count Answered Requests", test_metrics_count_answered_requests)
+    run_test("Play Note Route", test_play_note_route)
+    run_test("Tone Route Start Time", test_tone_route_start_time)
+    run_test("Score Round Trip", test_score_round_trip)
+    run_test("Score From JSON Two Voices", test_score_from_json_two_voices)
+    run_test("Score Malformed", test_score_malformed)
+    run_test("Parser Keep-Alive", test_parser_keep_alive)
+    run_test("Parser Pipelining and Close", test_parser_pipelining_and_close)
+    run_test("Parser Large Body", test_parser_large_body)
+    run_test("Parser Headers Too Large", test_parser_headers_too_large)
+    run_test("Parser Bad Content-Length", test_parser_bad_content_length)
+    run_test("Logs Route Level", test_logs_route_level)
+    run_test("History Summarize", test_history_summarize)
+    run_test("Events Fan Out", test_events_fan_out)
+    run_test("Events Slow Client", test_events_slow_client)
+    run_test("Light Filter Settling", test_light_filter_settling)
+    run_test("Hysteresis Threshold", test_hysteresis_threshold)
+    run_test("Pitch Table Edges", test_pitch_table_edges)
+    run_test("Tone Output Skips Redundant Writes", test_tone_output_skips_redundant_writes)
+    run_test("Voice Survives Refused Note", test_voice_survives_refused_note)
+    run_test(
+        "Note Routes Reject Unplayable Frequencies",
+        test_note_routes_reject_unplayable_frequencies,
+    )
+    run_test("Note Routes Check Parameters", test_note_routes_check_parameters)
+    run_test("Notecast Is Newer", test_notecast_is_newer)
+    run_test("Notecast Decode", test_notecast_decode)
+    run_test("Notecast Receives", test_notecast_receives)
+    run_test("JSON Number", test_json_number)
+    run_test("Template", test_template)
+    run_test("GC Policy", test_gcpolicy)
+    run_test("Adaptive Interval", test_adaptive_interval)
+
+    tasks = [v.task for v in main.voices if v.task]
+    for task in tasks:
+        task.cancel()
+    loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
 
     print("\nTest Summary:")
     print(f"Passed: {results['passed']}, Failed: {results['failed']}")
+    sys.exit(1 if results["failed"] else 0)